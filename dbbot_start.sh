@@ -19,4 +19,4 @@ export PYTHONPATH=$PYTHONPATH:$BASHABSDIR;
 
 FULLPATH=$BASHABSDIR"/webrequestmanager/mains/"$EXECFILE;
 
-exec python3 $FULLPATH &> $LOGFILE;
+exec python3 $FULLPATH "$@" &> $LOGFILE;
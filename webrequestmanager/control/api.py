@@ -4,6 +4,7 @@ Created on 01.02.2022
 @author: larsw
 '''
 from webrequestmanager.control.requesthandling import RequestHandler
+from webrequestmanager.control.submissionjournal import SubmissionJournal
 from flask import Flask, request, jsonify
 from pprint import pprint
 import json
@@ -23,6 +24,9 @@ DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 REQUESTID_KEY = "request_id"
 STATUSCODE_KEY = "status_code"
+CHANGED_SINCE_KEY = "changed_since"
+NEAR_DUPLICATES_KEY = "near_duplicates"
+METRICS_KEY = "metrics"
 
 def stringify_status_codes (status_code):
     if isinstance(status_code, int):
@@ -47,9 +51,20 @@ class WebRequestAPIServer ():
     # ? = %3F
     # / = %2F
     
-    def __init__ (self, storage, requester):
+    def __init__ (self, storage, requester, freshness=False, journal_path=None,
+                  coalesce_window=None):
         self._storage = storage
-        self._handler = RequestHandler(requester, self._storage)
+        self._handler = RequestHandler(requester, self._storage,
+                                       freshness=freshness,
+                                       coalesce_window=coalesce_window)
+        
+        # Write-behind mode, POSTs are journaled and answered
+        # with a provisional token instead of the request id
+        self._journal = None
+        
+        if journal_path is not None:
+            self._journal = SubmissionJournal(journal_path, self._handler)
+            self._journal.start()
         
         self._app = Flask(__name__)
         self._register_callbacks(self._app)
@@ -93,14 +108,55 @@ class WebRequestAPIServer ():
                 post_request = dict(request.form)
                 post_request = WebRequestAPIServer.decode_post_request(post_request)
                 
-                request_id = self._handler.add_request(post_request[URL_KEY], 
-                                          post_request[HEADER_KEY],
-                                          post_request[STATUSCODE_KEY],
-                                          post_request[MIN_DATE_KEY], 
-                                          post_request[MAX_DATE_KEY])
+                if self._journal is not None:
+                    request_id = self._journal.append(post_request[URL_KEY], 
+                                                      post_request[HEADER_KEY],
+                                                      post_request[STATUSCODE_KEY],
+                                                      post_request[MIN_DATE_KEY], 
+                                                      post_request[MAX_DATE_KEY])
+                else:
+                    request_id = self._handler.add_request(post_request[URL_KEY], 
+                                              post_request[HEADER_KEY],
+                                              post_request[STATUSCODE_KEY],
+                                              post_request[MIN_DATE_KEY], 
+                                              post_request[MAX_DATE_KEY])
                 return jsonify({REQUESTID_KEY : request_id})
+            elif CHANGED_SINCE_KEY in request.args:
+                since = dt.datetime.strptime(request.args.get(CHANGED_SINCE_KEY),
+                                             DATETIME_FORMAT)
+                
+                changed = self._handler.get_changed_urls(since).reset_index()
+                changed["Timestamp"] = changed["Timestamp"].apply(
+                        lambda x: x.strftime(DATETIME_FORMAT)
+                    )
+                return jsonify(changed.to_dict(orient="records"))
+            elif METRICS_KEY in request.args:
+                return jsonify(self._handler.get_metrics())
+            elif NEAR_DUPLICATES_KEY in request.args:
+                request_id = int(request.args.get(NEAR_DUPLICATES_KEY))
+                
+                cluster = self._handler.get_near_duplicates(request_id)
+                
+                if cluster is None:
+                    return jsonify([])
+                
+                cluster = cluster.reset_index()
+                cluster["Distance"] = cluster["Distance"].astype(int)
+                return jsonify(cluster.to_dict(orient="records"))
             else:
-                request_id = int(request.args.get(REQUESTID_KEY))
+                request_id = request.args.get(REQUESTID_KEY)
+                
+                if SubmissionJournal.is_token(request_id):
+                    if self._journal is None:
+                        return jsonify({})
+                    
+                    request_id = self._journal.resolve(request_id)
+                    
+                    # Not flushed yet, the client keeps polling
+                    if request_id is None:
+                        return jsonify({})
+                
+                request_id = int(request_id)
                 
                 response = self._handler.get_response(request_id=request_id)
                 
@@ -112,7 +168,11 @@ class WebRequestAPIServer ():
                     return jsonify({})
         
     def run (self, host=None, port=None):
-        self._app.run(host=host, port=port)
+        try:
+            self._app.run(host=host, port=port)
+        finally:
+            if self._journal is not None:
+                self._journal.stop()
         
 class WebRequestAPIClient ():
     def __init__ (self, host, port):
@@ -163,6 +223,40 @@ class WebRequestAPIClient ():
             status_code = ",".join(status_code)
             return status_code
     
+    def get_changed_urls (self, since):
+        '''
+        Returns the urls whose content changed after the
+        given UTC timestamp.
+        '''
+        params = {
+            CHANGED_SINCE_KEY : since.strftime(DATETIME_FORMAT)
+            }
+        
+        r = requests.get(self._url, params=params)
+        changed = json.loads(r.content.decode("utf-8"))
+        
+        df = pd.DataFrame(changed, columns=["UrlId", "URL", "ResponseId",
+                                            "RequestId", "Timestamp"])
+        df["Timestamp"] = pd.to_datetime(df["Timestamp"], format=DATETIME_FORMAT)
+        df = df.set_index("UrlId")
+        return df
+    
+    def get_near_duplicates (self, request_id):
+        '''
+        Returns the cluster of near-duplicate urls the
+        url of the given request belongs to.
+        '''
+        params = {
+            NEAR_DUPLICATES_KEY : request_id
+            }
+        
+        r = requests.get(self._url, params=params)
+        cluster = json.loads(r.content.decode("utf-8"))
+        
+        df = pd.DataFrame(cluster, columns=["UrlId", "URL", "Distance"])
+        df = df.set_index("UrlId")
+        return df
+    
     def get_response (self, url=None, header={}, min_date=None, max_date=None, request_id=None, wait=True):
         if url is None and request_id is None:
             errmsg = "Both URL and request id are None."
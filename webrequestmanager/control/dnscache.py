@@ -0,0 +1,324 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from urllib.parse import urlparse
+import ipaddress
+import socket
+import time
+import urllib3.util.connection as urllib3_connection
+
+try:
+    import dns.resolver
+    import dns.exception
+except ImportError:
+    dns = None
+
+class SystemResolver ():
+    '''
+    Resolves with the system resolver. getaddrinfo does not
+    expose the TTL of the records, every answer gets ttl.
+    '''
+
+    def __init__ (self, ttl=300.0):
+        self._ttl = ttl
+
+    def resolve (self, host, family):
+        '''
+        Returns the getaddrinfo tuples of the host without
+        a port and the time to live of the answer in seconds.
+        '''
+        return socket.getaddrinfo(host, None, family, socket.SOCK_STREAM), self._ttl
+
+class DNSPythonResolver ():
+    '''
+    Resolves A and AAAA records with dnspython,
+    honouring the TTLs of the answers.
+    '''
+
+    def __init__ (self, nameservers=None, lifetime=5.0):
+        if dns is None:
+            raise ImportError("The DNSPythonResolver requires dnspython.")
+
+        self._resolver = dns.resolver.Resolver()
+        self._resolver.lifetime = lifetime
+
+        if nameservers is not None:
+            self._resolver.nameservers = list(nameservers)
+
+    def resolve (self, host, family):
+        queries = []
+
+        if family in (socket.AF_UNSPEC, socket.AF_INET):
+            queries.append((socket.AF_INET, "A"))
+
+        if family in (socket.AF_UNSPEC, socket.AF_INET6):
+            queries.append((socket.AF_INET6, "AAAA"))
+
+        addrinfos = []
+        ttls = []
+
+        for af, rdtype in queries:
+            try:
+                answer = self._resolver.resolve(host, rdtype)
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+            except dns.exception.DNSException as e:
+                raise socket.gaierror(socket.EAI_AGAIN, str(e))
+
+            ttls.append(answer.rrset.ttl)
+
+            for record in answer:
+                sa = (record.address, 0) if af == socket.AF_INET else (record.address, 0, 0, 0)
+                addrinfos.append((af, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", sa))
+
+        if len(addrinfos) == 0:
+            raise socket.gaierror(socket.EAI_NONAME, "No address for {:s}".format(host))
+
+        return addrinfos, min(ttls)
+
+class DNSCache ():
+    '''
+    In-process cache of host name resolutions for the HTTP transport.
+    Answers live for their TTL (clamped to min_ttl and max_ttl), failed
+    lookups for negative_ttl. Concurrent misses of a host share a single
+    lookup. Hosts of domains about to be fetched can be prefetched in
+    the background. install() routes all new urllib3 connections, and
+    with them the ones of requests, through the cache.
+    '''
+
+    def __init__ (self, resolver=None, min_ttl=5.0, max_ttl=3600.0,
+                  negative_ttl=30.0, max_entries=10000, prefetch_margin=10.0,
+                  prefetch_workers=8):
+        if resolver is None:
+            resolver = SystemResolver()
+
+        self._resolver = resolver
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        # Entries expiring within the margin are refreshed by prefetches
+        self._prefetch_margin = prefetch_margin
+
+        self._lock = Lock()
+        # (Host, Family) -> [expires, addrinfos or error], least recently used first
+        self._entries = OrderedDict()
+        # (Host, Family) -> Future of the running lookup
+        self._pending = {}
+
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers,
+                                            thread_name_prefix="dnsprefetch")
+        self._original_create_connection = None
+
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._errors = 0
+        self._prefetches = 0
+
+    @classmethod
+    def _is_ip_address (cls, host):
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            return False
+
+        return True
+
+    def _lookup (self, key):
+        '''
+        Resolves the key and stores the answer. Returns
+        the addrinfos or the error of the resolver.
+        '''
+        host, family = key
+
+        try:
+            addrinfos, ttl = self._resolver.resolve(host, family)
+            value = list(addrinfos)
+            ttl = min(max(ttl, self._min_ttl), self._max_ttl)
+        except (socket.gaierror, socket.herror, UnicodeError) as e:
+            value = e
+            ttl = self._negative_ttl
+        except Exception as e:
+            # Not an answer about the host, nothing is cached
+            with self._lock:
+                self._errors += 1
+                future = self._pending.pop(key)
+
+            future.set_result(e)
+            return e
+
+        with self._lock:
+            if isinstance(value, Exception):
+                self._errors += 1
+
+            self._entries[key] = [time.monotonic() + ttl, value]
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+            future = self._pending.pop(key)
+
+        future.set_result(value)
+        return value
+
+    def _get (self, host, family):
+        key = (host.lower(), family)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+
+                if isinstance(entry[1], Exception):
+                    self._negative_hits += 1
+                else:
+                    self._hits += 1
+
+                return entry[1]
+
+            self._misses += 1
+            future = self._pending.get(key, None)
+
+            if future is None:
+                future = Future()
+                self._pending[key] = future
+                owner = True
+            else:
+                owner = False
+
+        if owner:
+            return self._lookup(key)
+
+        return future.result()
+
+    def getaddrinfo (self, host, port, family=socket.AF_UNSPEC):
+        '''
+        Cached counterpart of socket.getaddrinfo for stream sockets.
+        '''
+        if self._is_ip_address(host):
+            return socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+
+        value = self._get(host, family)
+
+        if isinstance(value, Exception):
+            # A fresh error, raising the cached one piles up tracebacks
+            raise type(value)(*value.args)
+
+        return [
+                (af, socktype, proto, canonname, (sa[0], port) + tuple(sa[2:]))
+                for af, socktype, proto, canonname, sa in value
+            ]
+
+    def prefetch (self, hosts, family=None):
+        '''
+        Resolves the given netlocs in the background unless their
+        entries are fresh. Returns the number of started lookups.
+        '''
+        if family is None:
+            # The family new connections resolve with
+            family = urllib3_connection.allowed_gai_family()
+
+        started = []
+        now = time.monotonic()
+
+        with self._lock:
+            for netloc in set(hosts):
+                host = urlparse("//" + netloc).hostname
+
+                if host is None or self._is_ip_address(host):
+                    continue
+
+                key = (host.lower(), family)
+                entry = self._entries.get(key, None)
+
+                if entry is not None and entry[0] - self._prefetch_margin > now:
+                    continue
+
+                if key in self._pending:
+                    continue
+
+                self._pending[key] = Future()
+                started.append(key)
+
+            self._prefetches += len(started)
+
+        for key in started:
+            self._executor.submit(self._lookup, key)
+
+        return len(started)
+
+    def create_connection (self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                           source_address=None, socket_options=None):
+        '''
+        urllib3.util.connection.create_connection resolving through the cache.
+        '''
+        host, port = address
+
+        if host.startswith("["):
+            host = host.strip("[]")
+
+        err = None
+        family = urllib3_connection.allowed_gai_family()
+
+        for af, socktype, proto, _, sa in self.getaddrinfo(host, port, family):
+            sock = None
+
+            try:
+                sock = socket.socket(af, socktype, proto)
+                urllib3_connection._set_socket_options(sock, socket_options)
+
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+
+                if source_address:
+                    sock.bind(source_address)
+
+                sock.connect(sa)
+                return sock
+            except OSError as e:
+                err = e
+
+                if sock is not None:
+                    sock.close()
+
+        if err is not None:
+            raise err
+
+        raise OSError("getaddrinfo returns an empty list")
+
+    def install (self):
+        if self._original_create_connection is None:
+            self._original_create_connection = urllib3_connection.create_connection
+            urllib3_connection.create_connection = self.create_connection
+
+    def uninstall (self):
+        if self._original_create_connection is not None:
+            urllib3_connection.create_connection = self._original_create_connection
+            self._original_create_connection = None
+
+    def clear (self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_metrics (self):
+        with self._lock:
+            lookups = self._hits + self._negative_hits + self._misses
+
+            return {
+                    "Entries" : len(self._entries),
+                    "Hits" : self._hits,
+                    "NegativeHits" : self._negative_hits,
+                    "Misses" : self._misses,
+                    "Errors" : self._errors,
+                    "Prefetches" : self._prefetches,
+                    "HitRatio" : (self._hits + self._negative_hits) / lookups if lookups != 0 else 0.0
+                }
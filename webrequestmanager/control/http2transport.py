@@ -0,0 +1,331 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urlparse
+from requests.structures import CaseInsensitiveDict
+import requests
+import ssl
+import time
+import weakref
+
+try:
+    import httpx
+    import httpcore
+except ImportError:
+    httpx = None
+
+class DNSCacheBackend ():
+    '''
+    httpcore network backend resolving host names through a DNSCache,
+    as httpx connects without urllib3 and so without the installed
+    cache. The cached addresses are tried in turn, TLS still checks
+    the certificate against the host name.
+    '''
+
+    def __init__ (self, dns_cache):
+        self._dns_cache = dns_cache
+        self._backend = httpcore.SyncBackend()
+
+    def connect_tcp (self, host, port, timeout=None, local_address=None,
+                     socket_options=None):
+        try:
+            addrinfos = self._dns_cache.getaddrinfo(host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e))
+
+        error = None
+
+        for _, _, _, _, sa in addrinfos:
+            try:
+                return self._backend.connect_tcp(sa[0], port, timeout, local_address,
+                                                 socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+
+        if error is not None:
+            raise error
+
+        raise httpcore.ConnectError("No address for {:s}".format(host))
+
+    def connect_unix_socket (self, path, timeout=None, socket_options=None):
+        return self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    def sleep (self, seconds):
+        self._backend.sleep(seconds)
+
+class HTTP2Response ():
+    '''
+    requests like view on a streamed httpx response, as far as
+    the Requester and Response.of_response use it. Closing the
+    response frees its stream slot of the origin.
+    '''
+
+    def __init__ (self, response, release):
+        self._response = response
+        self._release = release
+
+        self.status_code = response.status_code
+        self.headers = CaseInsensitiveDict(response.headers)
+        self.url = str(response.url)
+        self.reason = response.reason_phrase
+        self.http_version = response.http_version
+        self._content = None
+
+    def iter_content (self, chunk_size=1):
+        try:
+            for chunk in self._response.iter_bytes(chunk_size):
+                yield chunk
+        except httpx.HTTPError as e:
+            raise HTTP2Transport.map_error(e, reading=True)
+        finally:
+            self.close()
+
+    @property
+    def content (self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content(64 * 1024))
+
+        return self._content
+
+    def close (self):
+        self._response.close()
+
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+    def __repr__ (self):
+        return "<Response [{:d}]>".format(self.status_code)
+
+class HTTP2Transport ():
+    '''
+    HTTP/2 counterpart of the SessionPool. Concurrent fetches of an
+    origin are multiplexed as streams over a single connection, at
+    most max_streams (or the limit of its domain) at a time. Origins
+    without h2 in ALPN are fetched with HTTP/1.1, so are origins whose
+    h2 connections failed with protocol errors. One client is kept
+    per proxy, the least recently used ones beyond max_clients and
+    those idle for longer than max_idle are closed. Host names are
+    resolved through the dns_cache if one is given.
+    '''
+
+    def __init__ (self, max_streams=100, max_connections=1000, max_idle=90.0,
+                  max_clients=256, verify=True, dns_cache=None):
+        if httpx is None:
+            raise ImportError("The HTTP2Transport requires httpx with http2 support.")
+
+        self._max_streams = max_streams
+        self._max_connections = max_connections
+        self._max_idle = max_idle
+        self._max_clients = max_clients
+        self._verify = verify
+        self._dns_cache = dns_cache
+
+        self._lock = Lock()
+        # (Proxy, HTTP2) -> [client, last use], least recently used first
+        self._clients = OrderedDict()
+        # Netloc -> [limit, semaphore]
+        self._streams = {}
+        # Netloc -> Limit of its domain
+        self._stream_limits = {}
+        # Origins falling back to HTTP/1.1
+        self._http1_origins = set()
+
+        # Connections seen so far, to count the new ones
+        self._network_streams = weakref.WeakSet()
+
+        self._requests = 0
+        self._connections = 0
+        self._http2_requests = 0
+        self._evicted = 0
+
+    @classmethod
+    def map_error (cls, e, reading=False):
+        '''
+        Returns the requests exception corresponding to an httpx
+        one, so that callers classify both transports alike.
+        '''
+        if isinstance(e, httpx.ConnectTimeout):
+            return requests.exceptions.ConnectTimeout(str(e))
+
+        if isinstance(e, httpx.TimeoutException):
+            return requests.exceptions.ReadTimeout(str(e))
+
+        if isinstance(e, httpx.ProxyError):
+            return requests.exceptions.ProxyError(str(e))
+
+        if isinstance(e, httpx.ConnectError):
+            if isinstance(e.__context__, ssl.SSLError):
+                return requests.exceptions.SSLError(str(e))
+
+            return requests.exceptions.ConnectionError(str(e))
+
+        if isinstance(e, httpx.TooManyRedirects):
+            return requests.exceptions.TooManyRedirects(str(e))
+
+        if isinstance(e, httpx.UnsupportedProtocol):
+            return requests.exceptions.InvalidSchema(str(e))
+
+        if isinstance(e, (httpx.InvalidURL, httpx.LocalProtocolError)):
+            return requests.exceptions.InvalidURL(str(e))
+
+        if reading:
+            return requests.exceptions.ChunkedEncodingError(str(e))
+
+        return requests.exceptions.ConnectionError(str(e))
+
+    def _create_client (self, proxy, http2):
+        limits = httpx.Limits(max_connections=self._max_connections,
+                              max_keepalive_connections=self._max_connections,
+                              keepalive_expiry=self._max_idle)
+
+        transport = httpx.HTTPTransport(http1=True, http2=http2, proxy=proxy, limits=limits,
+                                        verify=self._verify, trust_env=False)
+
+        if self._dns_cache is not None:
+            # httpx has no option for it, the pool is the one place
+            # all connections (proxied ones too) are opened from
+            transport._pool._network_backend = DNSCacheBackend(self._dns_cache)
+
+        client = httpx.Client(transport=transport, trust_env=False)
+        # Clients are shared by all origins and headers, like
+        # with the SessionPool no cookies carry over
+        client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        
+        return client
+
+    def _get_client (self, proxy, http2):
+        key = (proxy, http2)
+        now = time.monotonic()
+
+        with self._lock:
+            if key in self._clients:
+                entry = self._clients[key]
+                self._clients.move_to_end(key)
+            else:
+                entry = [self._create_client(proxy, http2), now]
+                self._clients[key] = entry
+
+            entry[1] = now
+            self._evict(now)
+
+            return entry[0]
+
+    def _evict (self, now):
+        while len(self._clients) != 0:
+            key, (client, last_use) = next(iter(self._clients.items()))
+
+            if now - last_use <= self._max_idle and len(self._clients) <= self._max_clients:
+                break
+
+            del self._clients[key]
+            self._evicted += 1
+            client.close()
+
+    def _acquire_stream (self, netloc, timeout):
+        with self._lock:
+            limit = self._stream_limits.get(netloc, self._max_streams)
+            entry = self._streams.get(netloc, None)
+
+            # Holders of a replaced semaphore release into the old one
+            if entry is None or entry[0] != limit:
+                entry = [limit, BoundedSemaphore(limit)]
+                self._streams[netloc] = entry
+
+            semaphore = entry[1]
+
+        if not semaphore.acquire(timeout=timeout):
+            raise requests.exceptions.ConnectTimeout(
+                    "No free stream for {:s} within {:.1f}s".format(netloc, timeout)
+                )
+
+        return semaphore.release
+
+    def set_stream_limits (self, limits):
+        '''
+        Sets the concurrent streams per netloc of the domains.
+        '''
+        with self._lock:
+            self._stream_limits.update({
+                    netloc.lower() : max(int(limit), 1)
+                    for netloc, limit in limits.items()
+                })
+
+    def get (self, url, proxy_dict=None, headers=None, allow_redirects=True,
+             timeout=None, stream=False):
+        parsed = urlparse(url)
+        netloc = parsed.netloc.lower()
+        proxy = None
+
+        if proxy_dict is not None:
+            proxy = proxy_dict.get(parsed.scheme, None)
+
+        with self._lock:
+            http2 = netloc not in self._http1_origins
+
+        client = self._get_client(proxy, http2)
+        release = self._acquire_stream(netloc, timeout)
+
+        try:
+            request = client.build_request("GET", url, headers=headers, timeout=timeout)
+            response = client.send(request, stream=True, follow_redirects=allow_redirects)
+        except httpx.HTTPError as e:
+            release()
+
+            if http2 and isinstance(e, httpx.RemoteProtocolError):
+                with self._lock:
+                    self._http1_origins.add(netloc)
+
+            raise self.map_error(e)
+        except:
+            release()
+            raise
+
+        network_stream = response.extensions.get("network_stream", None)
+
+        with self._lock:
+            self._requests += 1
+
+            if response.http_version == "HTTP/2":
+                self._http2_requests += 1
+
+            if network_stream is not None and network_stream not in self._network_streams:
+                self._network_streams.add(network_stream)
+                self._connections += 1
+
+        response = HTTP2Response(response, release)
+
+        if not stream:
+            response.content
+
+        return response
+
+    def evict_idle (self):
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def close (self):
+        with self._lock:
+            while len(self._clients) != 0:
+                _, (client, _) = self._clients.popitem(last=False)
+                client.close()
+
+    def get_metrics (self):
+        with self._lock:
+            reused = max(self._requests - self._connections, 0)
+
+            return {
+                    "Sessions" : len(self._clients),
+                    "EvictedSessions" : self._evicted,
+                    "Requests" : self._requests,
+                    "Connections" : self._connections,
+                    "ReusedConnections" : reused,
+                    "ReuseRatio" : reused / self._requests if self._requests != 0 else 0.0,
+                    "HTTP2Requests" : self._http2_requests,
+                    "HTTP1Origins" : len(self._http1_origins)
+                }
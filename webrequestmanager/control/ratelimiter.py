@@ -0,0 +1,135 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from threading import Lock
+import time
+
+class TokenBucket ():
+    '''
+    Tokens refill at rate per second up to capacity. The balance
+    may go negative, consumptions beyond it are owed and delay
+    the next admission.
+    '''
+    __slots__ = ["rate", "capacity", "tokens", "last"]
+
+    def __init__ (self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = now
+
+    def refill (self, now):
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.capacity)
+        self.last = now
+
+    def consume (self, amount, now):
+        self.refill(now)
+        self.tokens -= amount
+
+    def get_wait (self, amount, now):
+        '''
+        Returns the seconds until amount tokens are available.
+        '''
+        self.refill(now)
+
+        if self.tokens >= amount:
+            return 0.0
+
+        return (amount - self.tokens) / self.rate
+
+class RateLimiter ():
+    '''
+    Token buckets per domain for bytes and requests per second and
+    an optional global one for bytes per second. Bytes are charged
+    as they arrive, so a domain is admitted again once its debt is
+    paid off. Requests are charged when they start. Buckets hold up
+    to burst_seconds worth of tokens (at least one request).
+    '''
+
+    def __init__ (self, global_bps=None, burst_seconds=1.0):
+        self._burst_seconds = burst_seconds
+        self._lock = Lock()
+
+        now = time.monotonic()
+        self._global_bytes = None
+
+        if global_bps is not None:
+            self._global_bytes = TokenBucket(global_bps, global_bps * burst_seconds, now)
+
+        # DomainId -> TokenBucket
+        self._domain_bytes = {}
+        self._domain_requests = {}
+
+    def _set_bucket (self, buckets, domain_id, rate, capacity, now):
+        if rate is None or rate <= 0:
+            buckets.pop(domain_id, None)
+            return
+
+        bucket = buckets.get(domain_id, None)
+
+        if bucket is None:
+            buckets[domain_id] = TokenBucket(rate, capacity, now)
+        elif bucket.rate != rate:
+            bucket.refill(now)
+            bucket.rate = rate
+            bucket.capacity = capacity
+            bucket.tokens = min(bucket.tokens, capacity)
+
+    def set_domain_limits (self, domain_id, bps=None, rps=None):
+        '''
+        Sets the limits of a domain, None lifts a limit.
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            self._set_bucket(self._domain_bytes, domain_id, bps,
+                             None if bps is None else bps * self._burst_seconds, now)
+            self._set_bucket(self._domain_requests, domain_id, rps,
+                             None if rps is None else max(rps * self._burst_seconds, 1.0), now)
+
+    def put_bytes (self, domain_id, size):
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._domain_bytes.get(domain_id, None)
+
+            if bucket is not None:
+                bucket.consume(size, now)
+
+            if self._global_bytes is not None:
+                self._global_bytes.consume(size, now)
+
+    def put_request (self, domain_id):
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._domain_requests.get(domain_id, None)
+
+            if bucket is not None:
+                bucket.consume(1, now)
+
+    def get_wait (self, domain_id):
+        '''
+        Returns the seconds until the domain may start its
+        next request, 0 if it may start right away.
+        '''
+        now = time.monotonic()
+        wait = 0.0
+
+        with self._lock:
+            bucket = self._domain_bytes.get(domain_id, None)
+
+            if bucket is not None:
+                wait = max(wait, bucket.get_wait(0, now))
+
+            bucket = self._domain_requests.get(domain_id, None)
+
+            if bucket is not None:
+                wait = max(wait, bucket.get_wait(1, now))
+
+            if self._global_bytes is not None:
+                wait = max(wait, self._global_bytes.get_wait(0, now))
+
+        return wait
@@ -11,6 +11,28 @@ import requests
 from bs4 import BeautifulSoup
 import numpy as np
 from pprint import pprint
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import RLock, Lock, Event, Thread
+from urllib.parse import urlparse
+import heapq
+import itertools
+import logging
+import time
+from webrequestmanager.control.sessionpool import SessionPool
+from webrequestmanager.control.http2transport import HTTP2Transport
+
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+class ResponseTooLarge (Exception):
+    '''
+    The body of a response exceeds the byte limit of its domain.
+    '''
+    pass
 
 class ProxyList (ABC):
     TYPE_INDEX = "Type"
@@ -128,7 +150,7 @@ class HideMyNameProxyList (ProxyList):
         r = requests.get(url, headers=HideMyNameProxyList.HEADER)
         
         if r.status_code == 200:
-            content = BeautifulSoup(r.content, "html.parser")
+            content = BeautifulSoup(r.content, HTML_PARSER)
             
             if content is not None:
                 return cls._scrape_list(content)
@@ -138,85 +160,398 @@ class HideMyNameProxyList (ProxyList):
     def _create_updated_proxy_dataframe (self):        
         start = 0
         step = 64
+        # Pages fetched at once
+        batch = 4
         
         dfs = []
         
-        while True:
-            url = HideMyNameProxyList.FULL_URL_FORMAT+("&start={:d}".format(start))
-            df = HideMyNameProxyList._request_url(url)
+        with ThreadPoolExecutor(max_workers=batch) as executor:
+            while True:
+                urls = [
+                        HideMyNameProxyList.FULL_URL_FORMAT+("&start={:d}".format(start + i * step))
+                        for i in range(batch)
+                    ]
+                pages = list(executor.map(HideMyNameProxyList._request_url, urls))
+                done = False
+                
+                for df in pages:
+                    if len(df) != 0:
+                        dfs.append(df)
+                    else:
+                        done = True
+                        break
+                    
+                if done:
+                    break
+                
+                start += batch * step
             
-            if len(df) != 0:
-                dfs.append(df)
-                start += step
-            else:
-                break
+        if len(dfs) == 0:
+            return HideMyNameProxyList.create_empty_proxy_dataframe()
             
         dfs = pd.concat(dfs, axis=0)
         
         return dfs
     
+class StaticProxyList (ProxyList):
+    '''
+    Fixed proxies, given as tuples of type, ip and port.
+    '''
+    def __init__ (self, proxies):
+        super().__init__()
+        self._proxies = list(proxies)
+        
+    def _create_updated_proxy_dataframe (self):
+        indx = pd.Index([x[0] for x in self._proxies], name=StaticProxyList.TYPE_INDEX)
+        df = pd.DataFrame({
+                StaticProxyList.IP_COLUMN : [str(x[1]) for x in self._proxies],
+                StaticProxyList.PORT_COLUMN : [str(x[2]) for x in self._proxies]
+            }, index=indx)
+        return df
+    
 class MultiProxyList (ProxyList):
-    def __init__ (self, proxy_lists):
+    '''
+    Aggregates several proxy lists. All sources are refreshed at once,
+    each within the source timeout. A source which fails or times out
+    max_failures times in a row is skipped for skip_duration. The last
+    good proxies of a failing source stay in the merged list.
+    '''
+    SOURCE_COLUMN = "Source"
+    FAILURES_COLUMN = "Failures"
+    LAST_DURATION_COLUMN = "LastDuration"
+    LAST_SUCCESS_COLUMN = "LastSuccess"
+    SKIPPED_UNTIL_COLUMN = "SkippedUntil"
+    PROXIES_COLUMN = "Proxies"
+    
+    def __init__ (self, proxy_lists, source_timeout=60.0, max_failures=3,
+                  skip_duration=dt.timedelta(minutes=30)):
         super().__init__()
         self._proxy_lists = proxy_lists
+        self._source_timeout = source_timeout
+        self._max_failures = max_failures
+        self._skip_duration = skip_duration
+        
+        self._logger = logging.getLogger("multiproxylist")
+        
+        # Timed out refreshes keep running in the background and
+        # are not started again before they finished
+        self._executor = ThreadPoolExecutor(max_workers=max(len(proxy_lists), 1),
+                                            thread_name_prefix="proxylist")
+        self._futures = [None for _ in proxy_lists]
+        self._health = [
+                {
+                    MultiProxyList.FAILURES_COLUMN : 0,
+                    MultiProxyList.LAST_DURATION_COLUMN : None,
+                    MultiProxyList.LAST_SUCCESS_COLUMN : None,
+                    MultiProxyList.SKIPPED_UNTIL_COLUMN : None
+                }
+                for _ in proxy_lists
+            ]
+        
+    @classmethod
+    def _update_source (cls, proxy_list):
+        start = time.perf_counter()
+        proxy_list.update_proxy_dataframe()
+        
+        return time.perf_counter() - start
+    
+    def _put_failure (self, i, reason):
+        health = self._health[i]
+        health[MultiProxyList.FAILURES_COLUMN] += 1
+        
+        self._logger.warning("Proxy list {:s} {:s}.".format(
+                type(self._proxy_lists[i]).__name__, reason
+            ))
+        
+        if health[MultiProxyList.FAILURES_COLUMN] >= self._max_failures:
+            health[MultiProxyList.SKIPPED_UNTIL_COLUMN] = dt.datetime.now() + self._skip_duration
+            
+    def _put_success (self, i, duration):
+        health = self._health[i]
+        health[MultiProxyList.FAILURES_COLUMN] = 0
+        health[MultiProxyList.LAST_DURATION_COLUMN] = duration
+        health[MultiProxyList.LAST_SUCCESS_COLUMN] = dt.datetime.now()
+        health[MultiProxyList.SKIPPED_UNTIL_COLUMN] = None
+        
+    @classmethod
+    def _merge (cls, dfs):
+        dfs = [x for x in dfs if len(x) != 0]
+        
+        if len(dfs) == 0:
+            return cls.create_empty_proxy_dataframe()
+        
+        df = pd.concat(dfs, axis=0).reset_index()
+        df[cls.TYPE_INDEX] = df[cls.TYPE_INDEX].astype(str).str.lower()
+        df[cls.IP_COLUMN] = df[cls.IP_COLUMN].astype(str)
+        df[cls.PORT_COLUMN] = df[cls.PORT_COLUMN].astype(str)
+        
+        # Sources knowing the delay of a proxy keep the best entry
+        if ProxyManager.DELAY_COLUMN in df.columns:
+            df = df.sort_values(by=ProxyManager.DELAY_COLUMN, na_position="last",
+                                kind="stable")
+        
+        df = df.drop_duplicates(subset=[cls.TYPE_INDEX, cls.IP_COLUMN, cls.PORT_COLUMN],
+                                keep="first")
+        
+        return df.set_index(cls.TYPE_INDEX)
         
     def _create_updated_proxy_dataframe (self):
-        all_updated = []
+        now = dt.datetime.now()
+        started = {}
+        
+        for i, proxy_list in enumerate(self._proxy_lists):
+            skipped_until = self._health[i][MultiProxyList.SKIPPED_UNTIL_COLUMN]
+            
+            if skipped_until is not None and now < skipped_until:
+                continue
+            
+            if self._futures[i] is not None and not self._futures[i].done():
+                self._put_failure(i, "is still refreshing")
+                continue
+            
+            self._futures[i] = self._executor.submit(MultiProxyList._update_source, proxy_list)
+            started[self._futures[i]] = i
+            
+        done, not_done = wait(started.keys(), timeout=self._source_timeout)
         
-        for proxy_list in self._proxy_lists:
+        for future in done:
             try:
-                proxy_list.update_proxy_dataframe()
-            except:
-                errmsg = """The update of proxy list {:s} caused an error at
-                {:s}!""".format(str(proxy_list), str(dt.datetime.now()))
-                print(errmsg)
-                tb.print_exc()
+                self._put_success(started[future], future.result())
+            except Exception as e:
+                self._put_failure(started[future], "failed: {:s}".format(str(e)))
                 
-            updated = proxy_list.get_proxy_dataframe()
-            all_updated.append(updated)
+        for future in not_done:
+            self._put_failure(started[future], "timed out")
             
+        return self._merge([x.get_proxy_dataframe() for x in self._proxy_lists])
+    
+    def get_source_health (self):
+        rows = [
+                dict(health, **{
+                        MultiProxyList.SOURCE_COLUMN : type(proxy_list).__name__,
+                        MultiProxyList.PROXIES_COLUMN : len(proxy_list.get_proxy_dataframe())
+                    })
+                for proxy_list, health in zip(self._proxy_lists, self._health)
+            ]
+        
+        return pd.DataFrame(rows, columns=[
+                MultiProxyList.SOURCE_COLUMN, MultiProxyList.PROXIES_COLUMN,
+                MultiProxyList.FAILURES_COLUMN, MultiProxyList.LAST_DURATION_COLUMN,
+                MultiProxyList.LAST_SUCCESS_COLUMN, MultiProxyList.SKIPPED_UNTIL_COLUMN
+            ])
                 
+
+class _ProxyScore ():
+    def __init__ (self):
+        # Exponentially weighted, None until the first success
+        self.latency = None
+        self.failure_rate = 0.0
+        self.samples = 0
+        # Identifies the current heap entry of the proxy
+        self.version = 0
+
 class ProxyManager ():
+    '''
+    Registry of the proxies of a proxy list, scored by exponentially
+    weighted latency and failure rate. Per protocol, a heap ordered
+    by score yields the best proxy in O(log n). A score update pushes
+    a new heap entry, outdated entries are dropped when they surface.
+    Thread-safe, so concurrent fetchers can share one manager.
+    '''
     DELAY_COLUMN = "Delay"
+    FAILURE_RATE_COLUMN = "FailureRate"
+    SCORE_COLUMN = "Score"
     
-    def __init__ (self, proxy_list, max_age=dt.timedelta(minutes=5)):
+    def __init__ (self, proxy_list, max_age=dt.timedelta(minutes=5), alpha=0.3,
+                  unknown_latency=5000.0, failure_penalty=10000.0):
         self._proxy_list = proxy_list
         self._max_age = max_age
         
-        self._proxy_data = None
+        # Weight of the newest sample
+        self._alpha = alpha
+        # Latencies in ms, untested proxies rank behind well
+        # performing ones but ahead of failing ones
+        self._unknown_latency = unknown_latency
+        self._failure_penalty = failure_penalty
         
-    def _create_proxy_data (self):
-        print("Called Create Proxy Data! "+str(self._proxy_data is None))
-        proxy_df = self._proxy_list.get_proxy_dataframe().copy()
+        self._lock = RLock()
+        # (Protocol, IP, Port) -> _ProxyScore
+        self._proxies = {}
+        # Protocol -> Heap of (Score, Version, IP, Port)
+        self._heaps = defaultdict(list)
+        self._counts = defaultdict(int)
+        self._loaded = False
+        # Refreshed by a ProxyMaintainer, never inline
+        self._maintained = False
+        
+    def _get_score (self, score):
+        latency = self._unknown_latency if score.latency is None else score.latency
+        return latency + score.failure_rate * self._failure_penalty
+    
+    def _rebuild_heaps (self):
+        heaps = defaultdict(list)
+        counts = defaultdict(int)
+        
+        for (protocol, ip, port), score in self._proxies.items():
+            heaps[protocol].append((self._get_score(score), score.version, ip, port))
+            counts[protocol] += 1
+            
+        for heap in heaps.values():
+            heapq.heapify(heap)
+            
+        self._heaps = heaps
+        self._counts = counts
         
-        proxy_df[ProxyManager.DELAY_COLUMN] = np.nan
-        proxy_df = proxy_df.set_index([
-                ProxyList.IP_COLUMN,
-                ProxyList.PORT_COLUMN
-            ], append=True)
-        proxy_df = proxy_df.sort_index()
-        proxy_df = proxy_df[~proxy_df.index.duplicated(keep='first')]
+    def _is_current (self, protocol, entry):
+        _, version, ip, port = entry
+        score = self._proxies.get((protocol, ip, port), None)
         
+        return score is not None and score.version == version
         
-        if self._proxy_data is None:
-            self._proxy_data = proxy_df
-        else:
-            old_data = self._proxy_data
+    @classmethod
+    def get_proxy_keys (cls, proxy_df):
+        '''
+        Returns the protocol, ip and port tuples of a proxy DataFrame.
+        '''
+        return [
+                (str(protocol).lower(), str(ip), str(port))
+                for protocol, ip, port in zip(
+                        proxy_df.index.get_level_values(ProxyList.TYPE_INDEX),
+                        proxy_df[ProxyList.IP_COLUMN], proxy_df[ProxyList.PORT_COLUMN]
+                    )
+            ]
+    
+    def publish (self, keys, latencies={}):
+        '''
+        Replaces the registry by the given proxies. Scores of proxies
+        which are still listed are kept, new ones start with their
+        latency from the dict, if there is one.
+        '''
+        with self._lock:
+            old_proxies = self._proxies
+            
+        proxies = {}
+        
+        for key in keys:
+            score = old_proxies.get(key, None)
+            
+            if score is None:
+                score = _ProxyScore()
+                score.latency = latencies.get(key, None)
+                
+            proxies[key] = score
+            
+        # Heaps are rebuilt under the lock, as scores may have
+        # changed in the meantime
+        with self._lock:
+            self._proxies = proxies
+            self._rebuild_heaps()
+            self._loaded = True
+            
+    def get_known_keys (self):
+        with self._lock:
+            return set(self._proxies.keys())
+        
+    def get_proxy_list (self):
+        return self._proxy_list
+    
+    def set_maintained (self, maintained):
+        self._maintained = maintained
+        
+    def _create_proxy_data (self):
+        proxy_df = self._proxy_list.get_proxy_dataframe()
+        self.publish(ProxyManager.get_proxy_keys(proxy_df))
+            
+    def get_best_proxy (self, protocol, exclude=()):
+        '''
+        Returns the IP and port of the best scored proxy of the
+        protocol, which is not excluded, or None.
+        '''
+        if not self._loaded and not self._maintained:
+            self.update()
+            
+        with self._lock:
+            heap = self._heaps[protocol]
+            excluded = []
+            best = None
+            
+            while len(heap) != 0:
+                entry = heap[0]
+                
+                if not self._is_current(protocol, entry):
+                    heapq.heappop(heap)
+                elif (entry[2], entry[3]) in exclude:
+                    excluded.append(heapq.heappop(heap))
+                else:
+                    best = (entry[2], entry[3])
+                    break
+                
+            for entry in excluded:
+                heapq.heappush(heap, entry)
+                
+            return best
+        
+    def put_result (self, protocol, ip, port, delay):
+        '''
+        Scores a request through the proxy. The delay is given
+        in ms, None or NaN for failed requests.
+        '''
+        failed = delay is None or np.isnan(delay)
+        key = (protocol, str(ip), str(port))
+        
+        with self._lock:
+            score = self._proxies.get(key, None)
             
-            selector = ~old_data[ProxyManager.DELAY_COLUMN].isna().values
-            selector = old_data[selector]
-            selector = selector[~selector.index.duplicated(keep='first')]
-            print("Selector:\n"+str(selector))
+            if score is None:
+                return
+            
+            alpha = self._alpha
+            score.failure_rate = (1 - alpha) * score.failure_rate + alpha * float(failed)
+            
+            if not failed:
+                if score.latency is None:
+                    score.latency = float(delay)
+                else:
+                    score.latency = (1 - alpha) * score.latency + alpha * delay
+                    
+            score.samples += 1
+            score.version += 1
             
-            proxy_df.update(selector)
-            self._proxy_data = proxy_df
+            heap = self._heaps[protocol]
+            heapq.heappush(heap, (self._get_score(score), score.version, key[1], key[2]))
             
+            # Bound the outdated entries
+            if len(heap) > 2 * self._counts[protocol] + 64:
+                self._heaps[protocol] = [x for x in heap if self._is_current(protocol, x)]
+                heapq.heapify(self._heaps[protocol])
         
     def get_proxy_data (self):
-        if self._proxy_data is None:
+        '''
+        Returns the registry as DataFrame, indexed by protocol,
+        IP and port, for inspection.
+        '''
+        if not self._loaded:
             self.update()
+            
+        with self._lock:
+            items = list(self._proxies.items())
+            
+            rows = [
+                    (protocol, ip, port,
+                     np.nan if score.latency is None else score.latency,
+                     score.failure_rate, self._get_score(score))
+                    for (protocol, ip, port), score in items
+                ]
+            
+        proxy_df = pd.DataFrame(rows, columns=[
+                ProxyList.TYPE_INDEX, ProxyList.IP_COLUMN, ProxyList.PORT_COLUMN,
+                ProxyManager.DELAY_COLUMN, ProxyManager.FAILURE_RATE_COLUMN,
+                ProxyManager.SCORE_COLUMN
+            ])
+        proxy_df = proxy_df.set_index([ProxyList.TYPE_INDEX, ProxyList.IP_COLUMN,
+                                       ProxyList.PORT_COLUMN])
         
-        return self._proxy_data
+        return proxy_df.sort_values(by=ProxyManager.SCORE_COLUMN)
         
     def update (self, force=False):
         elapsed_time = self._proxy_list.time_elapsed_since_update()
@@ -227,9 +562,106 @@ class ProxyManager ():
         elif (elapsed_time > self._max_age) or force:
             self._proxy_list.update_proxy_dataframe()
             self._create_proxy_data()
+        elif not self._loaded:
+            self._create_proxy_data()
             
     def set_proxy_data_delay (self, protocol, ip, port, delay):
-        self._proxy_data.loc[(protocol, ip, port)] = delay
+        self.put_result(protocol, ip, port, delay)
+        
+class ProxyMaintainer ():
+    '''
+    Refreshes the proxy list of a ProxyManager in a background thread,
+    so that fetches never wait for a scrape. New proxies are probed
+    concurrently against the check url and only those answering it
+    are published, with their probe latency as initial score.
+    '''
+    def __init__ (self, proxy_manager, check_url, interval=dt.timedelta(minutes=5),
+                  check_timeout=5.0, check_workers=32):
+        self._proxy_manager = proxy_manager
+        self._check_url = check_url
+        self._interval = interval
+        self._check_timeout = check_timeout
+        self._check_workers = check_workers
+        
+        self._logger = logging.getLogger("proxymaintainer")
+        
+        self._stop_event = Event()
+        self._thread = None
+        
+    def _probe (self, key):
+        '''
+        Returns the latency of the check url through
+        the proxy in ms or None if it failed.
+        '''
+        protocol, ip, port = key
+        proxy_dict = {protocol : "{:s}://{:s}:{:s}".format(protocol, ip, port)}
+        check_url = protocol + ":" + self._check_url.split(":", 1)[1]
+        
+        try:
+            start = time.perf_counter()
+            r = requests.get(check_url, proxies=proxy_dict, timeout=self._check_timeout)
+            latency = (time.perf_counter() - start) * 1000
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+        
+        if r.status_code != 200:
+            return None
+        
+        return latency
+        
+    def refresh (self):
+        '''
+        Updates the proxy list and publishes the listed proxies
+        which are either known or pass the probe. Returns the
+        number of new and of validated new proxies.
+        '''
+        proxy_list = self._proxy_manager.get_proxy_list()
+        proxy_list.update_proxy_dataframe()
+        
+        keys = list(dict.fromkeys(ProxyManager.get_proxy_keys(proxy_list.get_proxy_dataframe())))
+        known = self._proxy_manager.get_known_keys()
+        new_keys = [x for x in keys if x not in known]
+        
+        latencies = {}
+        
+        if len(new_keys) != 0:
+            with ThreadPoolExecutor(max_workers=self._check_workers) as executor:
+                for key, latency in zip(new_keys, executor.map(self._probe, new_keys)):
+                    if latency is not None:
+                        latencies[key] = latency
+                        
+        validated = [x for x in keys if x in known or x in latencies]
+        self._proxy_manager.publish(validated, latencies)
+        
+        return len(new_keys), len(latencies)
+    
+    def _run (self):
+        while not self._stop_event.is_set():
+            try:
+                new_count, validated_count = self.refresh()
+                self._logger.info("Validated {:d} of {:d} new proxies.".format(
+                        validated_count, new_count
+                    ))
+            except Exception as e:
+                # The previous proxies stay published
+                self._logger.error("Refreshing proxies failed: {:s}".format(str(e)))
+                
+            self._stop_event.wait(self._interval.total_seconds())
+            
+    def start (self):
+        self._proxy_manager.set_maintained(True)
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="proxymaintainer", daemon=True)
+        self._thread.start()
+        
+    def stop (self):
+        self._stop_event.set()
+        
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            
+        self._proxy_manager.set_maintained(False)
         
         
 class RequestModule (ABC):
@@ -279,10 +711,33 @@ class DefaultRequestMethod (RequestModule):
             return None, None
     
 class Requester ():
-    def __init__ (self, proxy_manager=None):
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__ (self, proxy_manager=None, session_pool=None,
+                  latency_history_length=100, hedge_min_samples=10,
+                  hedge_workers=32, dns_cache=None):
         self._proxy_manager = proxy_manager
-        self._session = requests.Session()
+        
+        # A SessionPool or an HTTP2Transport
+        if session_pool is None:
+            session_pool = SessionPool()
+            
+        self._session_pool = session_pool
         self._cookies = None
+        
+        # Installed for all urllib3 connections of the process
+        self._dns_cache = dns_cache
+        
+        if dns_cache is not None:
+            dns_cache.install()
+        
+        # Host -> Latencies of the last valid responses in ms
+        self._latency_lock = Lock()
+        self._latency_history = defaultdict(lambda: deque(maxlen=latency_history_length))
+        # Hedging starts once a host has this many latencies
+        self._hedge_min_samples = hedge_min_samples
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers,
+                                                  thread_name_prefix="hedge")
     
     def _prepare_accepted_status_codes (self, accepted_status_codes):
         if isinstance(accepted_status_codes, (list, tuple)):
@@ -299,76 +754,239 @@ class Requester ():
         else:
             return response.status_code in accepted_status_codes
         
-    def _request (self, url, header, allow_redirects, timeout, proxy_dict=None):
+    def _read_body (self, r, accepted_status_codes, max_bytes, byte_callback,
+                    cancel_event=None):
+        '''
+        Reads the body of a streamed response chunk by chunk. Bodies
+        of not accepted status codes are skipped. Returns None if the
+        fetch was cancelled and raises ResponseTooLarge if the body
+        is larger than max_bytes.
+        '''
+        if accepted_status_codes is not None and r.status_code not in accepted_status_codes:
+            r.close()
+            r._content = b""
+            return r
+        
+        content_length = r.headers.get("Content-Length", None)
+        
+        if max_bytes is not None and content_length is not None and content_length.isdigit():
+            if int(content_length) > max_bytes:
+                r.close()
+                raise ResponseTooLarge(content_length)
+        
+        chunks = []
+        size = 0
+        
+        for chunk in r.iter_content(chunk_size=Requester.CHUNK_SIZE):
+            size += len(chunk)
+            
+            if max_bytes is not None and size > max_bytes:
+                r.close()
+                raise ResponseTooLarge(size)
+            
+            if cancel_event is not None and cancel_event.is_set():
+                r.close()
+                return None
+            
+            chunks.append(chunk)
+            
+            if byte_callback is not None:
+                byte_callback(len(chunk))
+                
+        r._content = b"".join(chunks)
+        return r
+        
+    def _request (self, url, header, allow_redirects, timeout, proxy_dict=None,
+                  accepted_status_codes=None, max_bytes=None, byte_callback=None,
+                  cancel_event=None, errors=None):
+        '''
+        A single attempt, retries are up to the caller. The error of a
+        failed attempt is appended to errors.
+        '''
+        if cancel_event is not None and cancel_event.is_set():
+            return None, None
+        
+        # r2 = s.get(..., cookies=r1.cookies)
+        d = dt.datetime.utcnow()
+        
         try:
-            # r2 = s.get(..., cookies=r1.cookies)
-            d = dt.datetime.utcnow()
-
-            for _ in range(3):
-                try:
-                    r = requests.get(url, headers=header, 
-                              proxies=proxy_dict, allow_redirects=allow_redirects,
-                              timeout=timeout)
-                except requests.exceptions.ConnectionError as e:
-                    r = None
-                except requests.exceptions.ReadTimeout as e:
-                    r = None
-                except Exception as e:
-                    raise e
+            r = self._session_pool.get(url, proxy_dict, headers=header,
+                                       allow_redirects=allow_redirects,
+                                       timeout=timeout, stream=True)
+            r = self._read_body(r, accepted_status_codes, max_bytes,
+                                byte_callback, cancel_event)
+        except Exception as e:
+            if not isinstance(e, (requests.exceptions.RequestException, ResponseTooLarge)):
+                tb.print_exc()
                 
-            if r is None:
-                d = None
-            else:
-                # self._cookies = r.cookies                
-                d = (dt.datetime.utcnow() - d).total_seconds() * 1000
+            if errors is not None:
+                errors.append(e)
+                
+            return None, None
             
-            return r, d
-        except:
-            tb.print_exc()
+        if r is None:
             return None, None
+        
+        # self._cookies = r.cookies                
+        d = (dt.datetime.utcnow() - d).total_seconds() * 1000
+        
+        return r, d
     
-    def _proxy_request (self, url, header, accepted_status_codes, timeout):
-        # Returns: Result of requests.get(...) / requests.Session().get(...)
+    def _proxy_attempts (self, url, header, accepted_status_codes, timeout,
+                         max_bytes=None, byte_callback=None, errors=None):
+        '''
+        Yields one attempt per proxy, best scored first. An attempt
+        is called with a cancel event and returns response and delay.
+        '''
         allow_redirects = 301 not in accepted_status_codes
         url = url.replace("https:", "http:")
         required_protocol = url.split(":")[0]
         
-        sorted_data = self._proxy_manager.get_proxy_data().sort_values(by=ProxyManager.DELAY_COLUMN)
-        available_protocols = sorted_data.index.get_level_values(ProxyList.TYPE_INDEX).unique()
-        sorted_data = sorted_data.xs(required_protocol, level=ProxyList.TYPE_INDEX)
+        tried = set()
         
-        for indx_value in sorted_data.index:
+        while True:
+            indx_value = self._proxy_manager.get_best_proxy(required_protocol, tried)
+            
+            if indx_value is None:
+                break
+            
+            tried.add(indx_value)
+            
             proxy_url = "{:s}://{:s}:{:s}".format(required_protocol, indx_value[0], indx_value[1])
             proxy_dict = {required_protocol : proxy_url}
             
-            response, duration = self._request(url, header, allow_redirects, timeout,
-                                               proxy_dict=proxy_dict)
+            def attempt (cancel_event, indx_value=indx_value, proxy_dict=proxy_dict):
+                response, duration = self._request(url, header, allow_redirects, timeout,
+                                                   proxy_dict=proxy_dict,
+                                                   accepted_status_codes=accepted_status_codes,
+                                                   max_bytes=max_bytes,
+                                                   byte_callback=byte_callback,
+                                                   cancel_event=cancel_event,
+                                                   errors=errors)
+                
+                # A cancelled loser says nothing about the proxy
+                if not cancel_event.is_set():
+                    self._proxy_manager.put_result(required_protocol, indx_value[0],
+                                                   indx_value[1], duration)
+                    
+                return response, duration
+            
+            yield attempt
+            
+    def _proxy_request (self, url, header, accepted_status_codes, timeout,
+                        max_bytes=None, byte_callback=None, errors=None):
+        # Returns: Result of requests.get(...) / requests.Session().get(...)
+        for attempt in self._proxy_attempts(url, header, accepted_status_codes, timeout,
+                                            max_bytes, byte_callback, errors):
+            response, duration = attempt(Event())
             
             if response is None:
-                self._proxy_manager.set_proxy_data_delay(required_protocol, 
-                                                         indx_value[0], 
-                                                         indx_value[1],
-                                                         np.nan)
                 continue
-            else:
-                self._proxy_manager.set_proxy_data_delay(required_protocol, 
-                                                         indx_value[0], 
-                                                         indx_value[1],
-                                                         duration)
                 
             if response.status_code in accepted_status_codes:
                 return response, duration
             
         return None, None
-            
-    def _direct_request (self, url, header, accepted_status_codes, timeout):
-        # Returns: Result of requests.get(...) / requests.Session().get(...)
+    
+    def _direct_attempt (self, url, header, accepted_status_codes, timeout,
+                         max_bytes=None, byte_callback=None, errors=None):
         allow_redirects = 301 not in accepted_status_codes
         
-        response, secs = self._request(url, header, allow_redirects, timeout, 
-                                    proxy_dict=None)
+        def attempt (cancel_event):
+            return self._request(url, header, allow_redirects, timeout, 
+                                 proxy_dict=None,
+                                 accepted_status_codes=accepted_status_codes,
+                                 max_bytes=max_bytes,
+                                 byte_callback=byte_callback,
+                                 cancel_event=cancel_event,
+                                 errors=errors)
+        
+        return attempt
+            
+    def _direct_request (self, url, header, accepted_status_codes, timeout,
+                         max_bytes=None, byte_callback=None, errors=None):
+        # Returns: Result of requests.get(...) / requests.Session().get(...)
+        attempt = self._direct_attempt(url, header, accepted_status_codes, timeout,
+                                       max_bytes, byte_callback, errors)
+        response, secs = attempt(Event())
                 
         return response, secs
+    
+    def _hedged_request (self, attempts, hedge_delay, accepted_status_codes):
+        '''
+        Runs the attempts one after another, but starts the next one
+        already if the running one takes longer than the hedge delay.
+        At most two attempts run at once. The first valid response is
+        returned, the other attempt is cancelled.
+        '''
+        attempts = iter(attempts)
+        # Future -> Cancel event
+        running = {}
+        last_response = None, None
+        
+        def launch ():
+            attempt = next(attempts, None)
+            
+            if attempt is None:
+                return False
+            
+            cancel_event = Event()
+            running[self._hedge_executor.submit(attempt, cancel_event)] = cancel_event
+            return True
+        
+        launch()
+        
+        try:
+            while len(running) != 0:
+                timeout = hedge_delay if len(running) < 2 else None
+                done, _ = wait(running.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+                
+                # No response within the hedge delay
+                if len(done) == 0:
+                    launch()
+                    continue
+                
+                for future in done:
+                    del running[future]
+                    response, secs = future.result()
+                    
+                    if self._response_valid(response, accepted_status_codes):
+                        return response, secs
+                    
+                    if response is not None:
+                        last_response = response, secs
+                        
+                if len(running) == 0:
+                    launch()
+        finally:
+            for cancel_event in running.values():
+                cancel_event.set()
+                
+        return last_response
+    
+    def _get_hedge_delay (self, url, hedge_percentile):
+        '''
+        Returns the given percentile of the host's latencies
+        in seconds or None if there are not enough of them.
+        '''
+        if hedge_percentile is None:
+            return None
+        
+        host = urlparse(url).netloc.lower()
+        
+        with self._latency_lock:
+            latencies = list(self._latency_history.get(host, ()))
+            
+        if len(latencies) < self._hedge_min_samples:
+            return None
+        
+        return np.percentile(latencies, hedge_percentile) / 1000
+    
+    def _put_latency (self, url, latency):
+        host = urlparse(url).netloc.lower()
+        
+        with self._latency_lock:
+            self._latency_history[host].append(latency)
             
     def old_request (self, url, header, accepted_status_codes):
         if isinstance(accepted_status_codes, (list, tuple)):
@@ -402,20 +1020,89 @@ class Requester ():
        
 
     def request (self, url, header, accepted_status_codes,
-                        timeout, force_proxy):
+                        timeout, force_proxy, max_bytes=None, byte_callback=None,
+                        hedge_percentile=None, errors=None):
+        '''
+        Downloads are streamed. Bodies of not accepted status codes
+        are skipped, bodies larger than max_bytes abort the fetch and
+        byte_callback is called with the size of every received chunk.
+        With a hedge percentile, a second attempt is started if the
+        first one takes longer than that percentile of the host's
+        latencies. Bytes of both attempts go to the byte callback.
+        Each call is a single attempt per route, the errors of failed
+        attempts are appended to errors for the caller's retry engine.
+        '''
         accepted_status_codes = self._prepare_accepted_status_codes(accepted_status_codes)
+        hedge_delay = self._get_hedge_delay(url, hedge_percentile)
 
         if force_proxy:
             if self._proxy_manager is None:
                 errmsg = "Proxy usage is forced by default, but no manager is given."
                 raise ValueError(errmsg)
             
-            response, secs = self._proxy_request(url, header,
-                                                 accepted_status_codes, timeout)
-        else:
+            if hedge_delay is None:
+                response, secs = self._proxy_request(url, header,
+                                                     accepted_status_codes, timeout,
+                                                     max_bytes, byte_callback, errors)
+            else:
+                attempts = self._proxy_attempts(url, header, accepted_status_codes,
+                                                timeout, max_bytes, byte_callback,
+                                                errors)
+                response, secs = self._hedged_request(attempts, hedge_delay,
+                                                      accepted_status_codes)
+        elif hedge_delay is None:
             response, secs = self._direct_request(url, header, 
-                                                  accepted_status_codes, timeout)
+                                                  accepted_status_codes, timeout,
+                                                  max_bytes, byte_callback, errors)
+        else:
+            # Hedge a direct fetch through a proxy or a second direct fetch
+            attempts = [self._direct_attempt(url, header, accepted_status_codes,
+                                             timeout, max_bytes, byte_callback,
+                                             errors)]
+            
+            if self._proxy_manager is not None:
+                attempts = itertools.chain(attempts, itertools.islice(
+                        self._proxy_attempts(url, header, accepted_status_codes,
+                                             timeout, max_bytes, byte_callback,
+                                             errors), 1
+                    ))
+            else:
+                attempts.append(self._direct_attempt(url, header, accepted_status_codes,
+                                                     timeout, max_bytes, byte_callback,
+                                                     errors))
+                
+            response, secs = self._hedged_request(attempts, hedge_delay,
+                                                  accepted_status_codes)
 
         valid = self._response_valid(response, accepted_status_codes)
+        
+        if valid and secs is not None:
+            self._put_latency(url, secs)
 
         return response, secs, valid
+    
+    def evict_idle_sessions (self):
+        self._session_pool.evict_idle()
+        
+    def prefetch_hosts (self, netlocs):
+        '''
+        Resolves the hosts of domains about to be fetched ahead.
+        '''
+        if self._dns_cache is not None:
+            self._dns_cache.prefetch(netlocs)
+            
+    def set_stream_limits (self, limits):
+        '''
+        Concurrent streams per netloc, only HTTP/2 multiplexes.
+        '''
+        if isinstance(self._session_pool, HTTP2Transport):
+            self._session_pool.set_stream_limits(limits)
+            
+    def get_dns_metrics (self):
+        if self._dns_cache is None:
+            return None
+        
+        return self._dns_cache.get_metrics()
+    
+    def get_session_metrics (self):
+        return self._session_pool.get_metrics()
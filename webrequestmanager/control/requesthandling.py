@@ -3,7 +3,10 @@ Created on 13.01.2022
 
 @author: larsw
 '''
-from webrequestmanager.model.storage import URL, RequestHeader, Request, Response
+from webrequestmanager.model.storage import URL, RequestHeader, Request, Response, Storage
+from webrequestmanager.control.requester import Requester, ResponseTooLarge
+from webrequestmanager.control.retryengine import RetryEngine
+from webrequestmanager.control.ratelimiter import RateLimiter
 import datetime as dt
 import json
 import requests
@@ -11,21 +14,34 @@ import time
 import numpy as np
 import pandas as pd
 import logging
-from collections import defaultdict
+import os
+import socket
+import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 class _StatusManager ():
     '''
     Manages the requestability of certain domains
-    and used header ids.
+    and used header ids. The BPSLimit and RPSLimit
+    of the domains are enforced by a rate limiter,
+    which may be shared by several managers.
     '''
 
-    def __init__ (self, logger, bps_buffer_length=25):
+    def __init__ (self, logger, rate_limiter=None):
         self._logger = logger
 
-        self._bps_buffer_length = bps_buffer_length
-        # UTC Timestamps
-        self._bps_buffer_timestamps = defaultdict(list)
-        self._bps_buffer_sizes = defaultdict(list)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+
+        self._rate_limiter = rate_limiter
 
         self._domain_status = None
         self._status_changed = None
@@ -38,22 +54,25 @@ class _StatusManager ():
         self._domain_status = domain_status
         self._status_changed = status_changed
         self._domain_policy_df = domain_policy_df
+        
+        for domain_id, bps_limit, rps_limit in zip(domain_policy_df.index,
+                                                   domain_policy_df["BPSLimit"],
+                                                   domain_policy_df["RPSLimit"]):
+            self._rate_limiter.set_domain_limits(
+                    domain_id,
+                    None if pd.isnull(bps_limit) else float(bps_limit),
+                    None if pd.isnull(rps_limit) else float(rps_limit)
+                )
     
-    def put_bps_info (self, domain_id, timestamp, size):
-        self._bps_buffer_timestamps[domain_id].append(timestamp)
-        self._bps_buffer_sizes[domain_id].append(size)
-
-        clen = len(self._bps_buffer_timestamps[domain_id])
-        size_diff = self._bps_buffer_length - clen
-
-        if size_diff < 0:
-            new_timestamps = self._bps_buffer_timestamps[domain_id][-size_diff:]
-            new_sizes = self._bps_buffer_sizes[domain_id][-size_diff:]
-
-            self._bps_buffer_timestamps[domain_id] = new_timestamps
-            self._bps_buffer_sizes[domain_id] = new_sizes
-
-        self._logger.info(f"StatusManager: Putting BPSInfo {domain_id} {timestamp} {size}")
+    def put_bps_info (self, domain_id, size):
+        self._rate_limiter.put_bytes(domain_id, size)
+        self._logger.debug(f"StatusManager: Putting BPSInfo {domain_id} {size}")
+        
+    def put_request (self, domain_id):
+        '''
+        Charges the start of a request to the domain.
+        '''
+        self._rate_limiter.put_request(domain_id)
     
     def put_domain_status (self, domain_id, header_id, valid):
         key = (domain_id, header_id)
@@ -68,43 +87,29 @@ class _StatusManager ():
         t = self._domain_status
         self._logger.info(f"StatusManager: New Domain Status table:\n{t}")
 
-    def get_domain_bps (self, domain_id):
-        if len(self._bps_buffer_timestamps[domain_id]) == 0:
-            bps = 0.0
-        else:
-            buf = self._bps_buffer_sizes[domain_id]
-            start_timestamp = self._bps_buffer_timestamps[domain_id][0]
-            utc_now = dt.datetime.utcnow()
-            secs = (utc_now - start_timestamp).total_seconds()
-            
-            self._logger.info(f"DomainBPS: {start_timestamp} {utc_now} {secs} {buf}")
-    
-            bps = np.sum(buf) / secs
-
-        return bps
-
-
-    def _get_domain_mask (self):
+    def get_domain_wait (self, domain_id):
         '''
-        Returns a series with a domain id index
-        and boolean values describing which
-        domains can be requested at the moment.
+        Returns the seconds until the domain may start its next
+        request or None if the domain has no policy.
         '''
-        bps_limits = self._domain_policy_df["BPSLimit"]
-
-        domain_ids = self._domain_policy_df.index.values
-
-        bps_mask = [self.get_domain_bps(x) for x in domain_ids]
-        bps_mask = [
-                    True
-                    if bps_limits[x] is None or np.isnan(bps_limits[x])
-                    else bps < bps_limits[x]
-                    for bps, x in zip(bps_mask, domain_ids)
-                ]
+        if domain_id not in self._domain_policy_df.index:
+            return None
         
-        indx = pd.Index(domain_ids, name="DomainId")
+        return self._rate_limiter.get_wait(domain_id)
 
-        return pd.DataFrame({"DomainMask" : bps_mask}, index=indx)
+    def is_domain_requestable (self, domain_id):
+        return self.get_domain_wait(domain_id) == 0
+    
+    def is_domain_header_requestable (self, domain_id, header_id):
+        '''
+        Single pair variant of the domain header mask.
+        '''
+        key = (domain_id, header_id)
+        
+        if key not in self._status_changed:
+            return False
+        
+        return self._domain_status.at[key, "Status"] == 2 or not self._status_changed[key]
 
     def _get_domain_header_mask (self):
         '''
@@ -127,42 +132,237 @@ class _StatusManager ():
         return pd.DataFrame({"DomainHeaderMask" : status_mask}, index=indx) 
 
     def pick_request (self, request_df):
-        # DomainId -> DomainMask
-        domain_mask = self._get_domain_mask()
+        '''
+        Returns a random requestable request id and None. If only rate
+        limited requests are left, None and the seconds until the first
+        of them becomes requestable. None and None if none is left.
+        The start of the picked request is charged to its domain.
+        '''
         # DomainId, HeaderId -> DomainHeaderMask
         domain_header_mask = self._get_domain_header_mask()
-        
-        joined = domain_header_mask.join(domain_mask, on="DomainId")
-        joined = (joined["DomainMask"] & joined["DomainHeaderMask"]).to_frame("Mask")
-        joined = joined[joined["Mask"] == True]
+        domain_header_mask = domain_header_mask[domain_header_mask["DomainHeaderMask"] == True]
 
-        self._logger.info(f"StatusManager - Picking a request - Joined Options:\n{joined}")
+        joined = request_df.join(domain_header_mask, how="inner", on=["DomainId", "HeaderId"])
 
-        joined = request_df.join(joined, how="inner", on=["DomainId", "HeaderId"])
+        self._logger.info(f"StatusManager - Picking a request - Options:\n{joined}")
 
-        self._logger.info(f"StatusManager - Picking a request - Final options:\n{joined}")
+        domain_ids = joined.index.get_level_values("DomainId")
+        waits = {
+                domain_id : self.get_domain_wait(domain_id)
+                for domain_id in domain_ids.unique()
+            }
+        waits = {x : wait for x, wait in waits.items() if wait is not None}
+        
+        requestable = domain_ids.isin([x for x, wait in waits.items() if wait == 0])
+        candidates = joined.index.get_level_values("RequestId").values[requestable]
+        
+        self._logger.info(f"StatusManager - Picking a request - Final IDs:\n{candidates}")
 
-        joined = joined.index.get_level_values("RequestId").values
+        if len(candidates) != 0:
+            position = np.random.randint(0, len(candidates))
+            request_id = candidates[position]
+            self.put_request(domain_ids[requestable][position])
+            
+            return request_id, None
+        
+        if len(waits) != 0:
+            return None, min(waits.values())
         
-        self._logger.info(f"StatusManager - Picking a request - Final IDs:\n{joined}")
+        return None, None
+
+class _LeaseKeeper ():
+    '''
+    Holds the leases of the requests claimed by one worker,
+    so that several workers can share the same database.
+    Leases of crashed workers simply expire.
+    '''
+
+    def __init__ (self, storage, owner, lease_duration):
+        self._storage = storage
+        self._owner = owner
+        self._lease_duration = lease_duration
+
+        self._claimed = []
+        self._last_renewal = None
+
+    def claim (self, request_df):
+        '''
+        Returns the part of the request DataFrame which
+        could be claimed for this worker.
+        '''
+        request_ids = request_df.index.get_level_values("RequestId").values
+        claimed = self._storage.claim_request_leases(self._owner, request_ids,
+                                                     self._lease_duration)
+
+        self._claimed = list(claimed)
+        self._last_renewal = time.monotonic()
+
+        selector = request_df.index.get_level_values("RequestId").isin(claimed)
+        return request_df[selector]
 
-        candidates_count = len(joined)
+    def renew_if_due (self):
+        if self._last_renewal is None or len(self._claimed) == 0:
+            return
 
-        if candidates_count != 0:
-            randint = np.random.randint(0, candidates_count)
-            return joined[randint]
+        elapsed = time.monotonic() - self._last_renewal
+
+        # Renew well before the lease runs out
+        if elapsed > self._lease_duration.total_seconds() / 3:
+            self._storage.renew_request_leases(self._owner, self._claimed,
+                                               self._lease_duration)
+            self._last_renewal = time.monotonic()
+
+    def release (self):
+        self._storage.release_request_leases(self._owner, self._claimed)
+
+        self._claimed = []
+        self._last_renewal = None
+
+class _PendingSet ():
+    '''
+    In-memory copy of the new and failed requests, kept across
+    cycles. Each refresh only pulls requests with a higher id and
+    status changes since the last high-water mark. Url and header
+    merges mark the requests they rewrite as changed, requests they
+    delete are discarded once a claim skips them. A periodic full
+    resync repairs any other drift.
+    '''
+
+    def __init__ (self, storage, logger, resync_interval,
+                  overlap=dt.timedelta(seconds=5)):
+        self._storage = storage
+        self._logger = logger
+        self._resync_interval = resync_interval
+        # Changes committed late with an earlier timestamp
+        # are still found within this window.
+        self._overlap = overlap
+
+        self._requests = None
+        self._last_request_id = 0
+        self._since = None
+        self._last_resync = None
+
+    def _resync (self):
+        # Marks are taken first, so nothing in between is missed
+        self._last_request_id, now = self._storage.get_request_status_marks()
+        self._since = now - self._overlap
+
+        self._requests = self._storage.get_executable_requests()
+        self._last_resync = time.monotonic()
+
+        self._logger.info(f"PendingSet: full resync with {len(self._requests)} requests")
+
+    def _apply_changes (self):
+        changes = self._storage.get_request_status_changes(self._last_request_id,
+                                                           self._since)
+
+        if len(changes) == 0:
+            return
+
+        self._last_request_id = max(self._last_request_id, int(changes["RequestId"].max()))
+        self._since = changes["Changed"].max() - self._overlap
+
+        changed_ids = changes["RequestId"].values
+        kept = ~self._requests.index.get_level_values("RequestId").isin(changed_ids)
+
+        executable = changes[changes["Status"] != 2]["RequestId"].values
+        fetched = self._storage.get_full_requests(executable)
+
+        self._requests = pd.concat([self._requests[kept], fetched], axis=0)
+
+        self._logger.info(f"PendingSet: {len(changes)} changes, {len(fetched)} executable")
+
+    def discard (self, request_ids):
+        '''
+        Drops requests which could not be claimed, they are done,
+        deleted by a merge or just leased by another worker. The
+        latter come back with their next status change.
+        '''
+        if len(request_ids) == 0:
+            return
+
+        selector = self._requests.index.get_level_values("RequestId").isin(request_ids)
+        self._requests = self._requests[~selector]
+
+    def refresh (self):
+        resync_due = (self._last_resync is None or
+                      time.monotonic() - self._last_resync > self._resync_interval.total_seconds())
+
+        if resync_due:
+            self._resync()
         else:
-            return None
+            self._apply_changes()
+
+    def get_requests (self, status, domain_policy_df):
+        '''
+        Returns the requests of the given status which may be executed
+        now, at most PendingLimit per domain. Requests of paths with
+        near-duplicate query variants are ranked last.
+        '''
+        self.refresh()
+
+        df = self._requests[self._requests[Storage.STATUS_COLUMN] == status]
+
+        if len(df) == 0:
+            return df
+
+        blocked = self._storage.get_blocked_domain_headers()
+        leased = self._storage.get_leased_request_ids()
+
+        domain_ids = df.index.get_level_values("DomainId")
+        header_ids = df.index.get_level_values("HeaderId")
+        request_ids = df.index.get_level_values("RequestId")
+
+        selector = np.array([
+                x not in blocked
+                for x in zip(domain_ids, header_ids)
+            ], dtype=bool)
+        selector &= ~request_ids.isin(list(leased))
+        df = df[selector]
+
+        if len(df) == 0:
+            return df
+
+        paths = self._storage.get_near_duplicate_paths()
+        paths = set(zip(paths["DomainId"], paths["Path"]))
+        near_duplicate = np.array([
+                x in paths
+                for x in zip(df.index.get_level_values("DomainId"), df["Path"])
+            ], dtype=bool)
+
+        order = np.lexsort((df.index.get_level_values("RequestId").values, near_duplicate))
+        df = df.iloc[order]
+
+        limits = domain_policy_df["PendingLimit"].reindex(df.index.get_level_values("DomainId"))
+        ranks = df.groupby(level="DomainId").cumcount().values
+        selector = limits.isnull().values | (ranks < limits.fillna(0).values)
+
+        return df[selector]
 
 class RequestOrchestrator ():
-    def __init__ (self, storage, requester, logger,
-                  bps_buffer_length=25):
+    '''
+    Fetches the requests one at a time. Domains over their BPSLimit
+    or RPSLimit, or all of them over the global_bps_limit, are waited
+    for exactly as long as needed, unless that exceeds max_wait.
+    '''
+    def __init__ (self, storage, requester, logger, global_bps_limit=None,
+                  burst_seconds=1.0, max_wait=60.0, retry_engine=None):
         self._storage = storage
         self._requester = requester
         
         self._logger = logger
-        self._manager = _StatusManager(self._logger,
-                                       bps_buffer_length=bps_buffer_length)
+        self._rate_limiter = RateLimiter(global_bps_limit, burst_seconds)
+        self._max_wait = max_wait
+        self._manager = _StatusManager(self._logger, self._rate_limiter)
+        
+        if retry_engine is None:
+            retry_engine = RetryEngine()
+            
+        self._retry_engine = retry_engine
+        
+        # Leading RequestId -> RequestIds sharing its fetch in this cycle
+        self._followers = {}
+        self._coalesced_fetches = 0
 
     def _split_request_df (self, request_df):
         splitted = {}
@@ -176,106 +376,195 @@ class RequestOrchestrator ():
 
         return splitted
     
-    def _random_delay (self, mindelay, maxdelay):
-        delay_span = maxdelay - mindelay
-        random_delay = np.random.rand() * delay_span + mindelay
-        time.sleep(random_delay)
-
-
     def _try_get_size_of_response (self, response):
         if response is None:
             return 0.0
         else:
             return len(response.content)
     
-    def _request_retry (self, single_request_df, accepted_status_codes,
-                        policy, bytecounter):
-        timeout = policy["Timeout"]
-        force_proxy = bool(policy["ProxyDefault"])
-        url = single_request_df["URL"].iloc[0]
-        header = json.loads(single_request_df["Header"].iloc[0])
+    @classmethod
+    def _get_max_bytes (cls, policy):
+        max_bytes = policy.get("MaxBytes", None)
         
-        is_https = "https:" in url.lower()
-        url_http = url.replace("https:", "http:")
+        if max_bytes is None or np.isnan(max_bytes):
+            return None
         
-
-        retries = policy["Retries"]
-        retry_mindelay = policy["RetryMinDelay"]
-        retry_maxdelay = policy["RetryMaxDelay"]
-        retry_http = bool(policy["RetryHTTP"]) and is_https
-        # retry_proxies = bool(policy["RetryProxies"]) and not force_proxy
-
-        self._logger.info(f"RequestOrchestrator: Reattempt routine started with {retries} - {url} - {url_http}")
+        return int(max_bytes)
+    
+    @classmethod
+    def _get_hedge_percentile (cls, policy):
+        hedge_percentile = policy.get("HedgePercentile", None)
         
-        for _ in range(retries):
-            self._random_delay(retry_mindelay, retry_maxdelay)
-            response, _, valid = self._requester.request(
-                                        url, header, accepted_status_codes,
-                                        timeout, force_proxy
-                                    )
-            bytecounter += self._try_get_size_of_response(response)
-            
-            self._logger.info(f"RequestOrchestrator: basic reattempt yielded {response} {valid} with {bytecounter}")
-
-            if valid:
-                return response, bytecounter, valid
-            
-            # Additional policy attempts
-            # HTTP attempt
-            if retry_http:
-                alt_response, _, valid = self._requester.request(
-                                        url_http, header, accepted_status_codes,
-                                        timeout, force_proxy
-                                    )
-                bytecounter += self._try_get_size_of_response(alt_response)
-                
-                self._logger.info(f"RequestOrchestrator: HTTP reattempt yielded {alt_response} {valid} with {bytecounter}")
-
-                if valid:
-                    return alt_response, bytecounter, valid
-
-        return response, bytecounter, valid
-
+        if hedge_percentile is None or np.isnan(hedge_percentile):
+            return None
+        
+        # Rows written before the range was checked, no hedging
+        if hedge_percentile <= 0 or hedge_percentile > 100:
+            return None
+        
+        return float(hedge_percentile)
+    
+    @classmethod
+    def _get_retry_urls (cls, url, policy):
+        '''
+        The urls the retry engine attempts in turn, with
+        RetryHTTP the http variant of an https url.
+        '''
+        if bool(policy["RetryHTTP"]) and "https:" in url.lower():
+            return [url, url.replace("https:", "http:")]
+        
+        return [url]
 
-    def _request (self, single_request_df, accepted_status_codes, policy):
+    def _request (self, single_request_df, accepted_status_codes, policy,
+                  byte_callback=None):
         '''
         Gets a DataFrame with a single request and a
         policy series. Returns response information.
+        The byte callback receives the size of every
+        downloaded chunk. All attempts go through
+        the retry engine.
         '''
         bytecounter = 0
 
-        timeout = policy["Timeout"]
         force_proxy = bool(policy["ProxyDefault"])
+        max_bytes = self._get_max_bytes(policy)
+        hedge_percentile = self._get_hedge_percentile(policy)
         url = single_request_df["URL"].iloc[0]
         header = json.loads(single_request_df["Header"].iloc[0])
-        self._logger.info(f"RequestOrchestrator: General request of {url}\nwith Timeout={timeout}, ForceProxy={force_proxy}")
-        response, _, valid = self._requester.request(
-                    url, header, accepted_status_codes,
-                    timeout, force_proxy
-                )
+        domain_id = single_request_df.index.get_level_values("DomainId")[0]
+        self._logger.info(f"RequestOrchestrator: General request of {url}\nwith Timeout={policy['Timeout']}, ForceProxy={force_proxy}")
         
-        self._logger.info(f"RequestOrchestrator: Received: {response}, {valid}")
+        def attempt (attempt_url, timeout):
+            nonlocal bytecounter
+            errors = []
+            
+            response, _, valid = self._requester.request(
+                        attempt_url, header, accepted_status_codes,
+                        timeout, force_proxy, max_bytes, byte_callback,
+                        hedge_percentile, errors
+                    )
+            bytecounter += self._try_get_size_of_response(response)
+            error = errors[-1] if len(errors) != 0 else None
+            
+            self._logger.info(f"RequestOrchestrator: Attempt of {attempt_url} yielded {response} {valid} {error!r}")
+            
+            return response, valid, error
         
-        bytecounter += self._try_get_size_of_response(response)
-
-        if not valid:
-           response, bytecounter, valid = self._request_retry(single_request_df,
-                                                              accepted_status_codes,
-                                                              policy, bytecounter)
+        response, valid, _ = self._retry_engine.run(domain_id, policy,
+                                                     self._get_retry_urls(url, policy),
+                                                     attempt)
 
         return response, bytecounter, valid
+    
+    def get_retry_metrics (self):
+        return self._retry_engine.get_metrics()
+    
+    def get_coalesced_fetch_count (self):
+        return self._coalesced_fetches
+    
+    def _coalesce_requests (self, request_df):
+        '''
+        Keeps the first request of every url and header of the cycle,
+        the others get the response of its fetch. Only requests with
+        the same accepted status codes share a fetch, as those decide
+        how a request is fetched and when it is done.
+        '''
+        self._followers = {}
+        
+        if len(request_df) == 0:
+            return request_df
+        
+        request_ids = request_df.index.get_level_values("RequestId")
+        keys = pd.MultiIndex.from_arrays([request_df.index.get_level_values("UrlId"),
+                                          request_df.index.get_level_values("HeaderId")])
+        candidates = keys.duplicated(keep=False)
+        
+        if not candidates.any():
+            return request_df
+        
+        if Storage.ACCEPTED_STATUS_COLUMN in request_df.columns:
+            accepted_status = request_df[Storage.ACCEPTED_STATUS_COLUMN].values
+        else:
+            accepted_status = [
+                    self._storage.get_accepted_status(request_ids[i]) if x else None
+                    for i, x in enumerate(candidates)
+                ]
+        
+        # (UrlId, HeaderId, AcceptedStatus) -> Positions, the kept request first
+        groups = {}
+        
+        for i in np.flatnonzero(candidates):
+            codes = accepted_status[i]
+            codes = frozenset(codes if isinstance(codes, (list, tuple, set)) else [codes])
+            groups.setdefault(keys[i] + (codes,), []).append(i)
+            
+        duplicated = np.zeros(len(request_df), dtype=bool)
+        
+        for positions in groups.values():
+            if len(positions) == 1:
+                continue
+            
+            self._followers[request_ids[positions[0]]] = [request_ids[i] for i in positions[1:]]
+            duplicated[positions[1:]] = True
+            
+        coalesced = int(duplicated.sum())
+        
+        if coalesced == 0:
+            return request_df
+        
+        self._coalesced_fetches += coalesced
+        self._logger.info(f"RequestOrchestrator: {coalesced} requests share the fetch of another one")
+        
+        return request_df[~duplicated]
                     
     def _store_response(self, request_id, response, timestamp):
         if response is not None:
             response = Response.of_response(None, response, timestamp)
-            self._storage.direct_insert_response(request_id, response)        
+            self._storage.direct_insert_response(request_id, response)
+            
+            for follower_id in self._followers.get(request_id, []):
+                self._storage.direct_insert_response(follower_id, response)
 
-    def orchestrate (self, request_df):
+    def _prepare_hosts (self, request_df, domain_policy_df):
+        '''
+        Prefetches the hosts of the requests and hands the
+        stream limits of their domains to the requester.
+        '''
+        if "Netloc" not in request_df.columns or len(request_df) == 0:
+            return
+        
+        netlocs = request_df["Netloc"].reset_index()[["DomainId", "Netloc"]].drop_duplicates()
+        self._requester.prefetch_hosts(netlocs["Netloc"].unique())
+        
+        limits = domain_policy_df["MaxStreams"].reindex(netlocs["DomainId"]).values
+        self._requester.set_stream_limits({
+                netloc : int(limit)
+                for netloc, limit in zip(netlocs["Netloc"].values, limits)
+                if not pd.isnull(limit)
+            })
+
+    def _set_base_infos (self):
+        '''
+        Loads the domain status and policies for an orchestration
+        cycle. Returns the domain policy DataFrame.
+        '''
+        domain_status = self._storage.get_domain_status()
+        status_changed = {
+                (domain_id, header_id) : False
+                for domain_id, header_id in domain_status.index.values
+            }
+        domain_policy_df = self._storage.get_domain_policy()
+        self._manager.set_base_infos(domain_status, status_changed,
+                                     domain_policy_df)
+        
+        return domain_policy_df
+
+    def orchestrate (self, request_df, lease_keeper=None):
         # request_df:
         #   Index:      RequestId, UrlId, DomainId, HeaderId
         #   Content:    Scheme, Netloc, Path, Query, 
         #               Header, Timestamp, URL, CompletingResponseId,
-        #               ResponseCount
+        #               ResponseCount, AcceptedStatus (optional)
         #   Only new or retryable requests in the dataframe
         #
         # domain_policy_df:
@@ -289,14 +578,9 @@ class RequestOrchestrator ():
         #   Content:    Scheme, Netloc, Header, Timestamp, Status
         #   Status:     1: Error
         #               2: OK
-        domain_status = self._storage.get_domain_status()
-        status_changed = {
-                (domain_id, header_id) : False
-                for domain_id, header_id in domain_status.index.values
-            }
-        domain_policy_df = self._storage.get_domain_policy()
-        self._manager.set_base_infos(domain_status, status_changed,
-                                     domain_policy_df)
+        request_df = self._coalesce_requests(request_df)
+        domain_policy_df = self._set_base_infos()
+        self._prepare_hosts(request_df, domain_policy_df)
             
         # while has something:
         #   check which requests can be requested
@@ -308,33 +592,47 @@ class RequestOrchestrator ():
         success_count = 0
 
         while True:
-            request_id = self._manager.pick_request(request_df)
+            request_id, wait = self._manager.pick_request(request_df)
             
             if request_id is None:
-                break
+                # Rate limited requests are waited for, unless it takes too long
+                if wait is None or wait > self._max_wait:
+                    break
+                
+                time.sleep(wait)
+                continue
  
-            accepted_status_codes = self._storage.get_accepted_status(request_id)
+            selected_request = request_df.xs(request_id, level="RequestId",
+                                             drop_level=False)
+            
+            if Storage.ACCEPTED_STATUS_COLUMN in selected_request.columns:
+                accepted_status_codes = selected_request[Storage.ACCEPTED_STATUS_COLUMN].iloc[0]
+            else:
+                accepted_status_codes = self._storage.get_accepted_status(request_id)
             
             self._logger.info(f"RequestOrchestrator: Picking request: {request_id} - {accepted_status_codes}")
 
-            selected_request = request_df.xs(request_id, level="RequestId",
-                                             drop_level=False)
             domain_id = selected_request.index.get_level_values("DomainId")[0]
             header_id = selected_request.index.get_level_values("HeaderId")[0]
             selected_policy = domain_policy_df.loc[domain_id]
 
+            # Bytes are accounted as they arrive
+            byte_callback = lambda size: self._manager.put_bps_info(domain_id, size)
             response, bytecount, valid = self._request(selected_request,
                                                        accepted_status_codes,
-                                                       selected_policy)
+                                                       selected_policy,
+                                                       byte_callback)
             done_time = dt.datetime.utcnow()
             
-            self._manager.put_bps_info(domain_id, done_time, bytecount)
             self._manager.put_domain_status(domain_id, header_id, valid)
             self._store_response(request_id, response, done_time)
             
             if valid:
                 success_count += 1
 
+            if lease_keeper is not None:
+                lease_keeper.renew_if_due()
+
             request_df = request_df.drop(request_id, level="RequestId")
 
             if len(request_df) == 0:
@@ -342,16 +640,470 @@ class RequestOrchestrator ():
 
         return success_count
 
+class ThreadedRequestOrchestrator (RequestOrchestrator):
+    '''
+    Fetches with a pool of worker threads using the blocking Requester.
+    The domains are sharded over the workers. A worker processes all
+    requests of a domain in order and with its own _StatusManager, so
+    the status bookkeeping of a domain is only ever touched by
+    one thread. A worker whose shard runs dry steals domains which
+    nobody has started yet from the other shards. The rate limiter
+    is shared by all workers.
+    '''
+    def __init__ (self, storage, requester, logger, global_bps_limit=None,
+                  burst_seconds=1.0, max_wait=60.0, workers=16, retry_engine=None):
+        super().__init__(storage, requester, logger,
+                         global_bps_limit=global_bps_limit,
+                         burst_seconds=burst_seconds, max_wait=max_wait,
+                         retry_engine=retry_engine)
+        
+        self._workers = workers
+        self._renew_lock = Lock()
+        
+    def _create_shards (self, domain_ids):
+        shards = [deque() for _ in range(self._workers)]
+        
+        for domain_id in domain_ids:
+            shards[hash(domain_id) % self._workers].append(domain_id)
+            
+        return shards
+    
+    def _next_domain (self, shards, worker):
+        '''
+        Owners take domains from the front of their shard, thieves
+        from the back. Both pops are atomic, no lock is needed.
+        '''
+        try:
+            return shards[worker].popleft()
+        except IndexError:
+            pass
+        
+        for i in range(1, len(shards)):
+            try:
+                return shards[(worker + i) % len(shards)].pop()
+            except IndexError:
+                continue
+            
+        return None
+    
+    def _renew_leases (self, lease_keeper):
+        # Another worker renewing right now is just as good
+        if lease_keeper is not None and self._renew_lock.acquire(blocking=False):
+            try:
+                lease_keeper.renew_if_due()
+            finally:
+                self._renew_lock.release()
+    
+    def _orchestrate_domain (self, manager, domain_df, policy, lease_keeper):
+        '''
+        The sequential loop, restricted to the requests of one domain.
+        '''
+        success_count = 0
+        remaining = list(range(len(domain_df)))
+        domain_id = domain_df.index.get_level_values("DomainId")[0]
+        header_ids = domain_df.index.get_level_values("HeaderId")
+        
+        while len(remaining) != 0:
+            wait = manager.get_domain_wait(domain_id)
+            
+            # The rest of the domain is left for the next cycle
+            if wait is None or wait > self._max_wait:
+                break
+            
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            
+            position = next((
+                    x for x in remaining
+                    if manager.is_domain_header_requestable(domain_id, header_ids[x])
+                ), None)
+            
+            if position is None:
+                break
+            
+            remaining.remove(position)
+            manager.put_request(domain_id)
+            selected_request = domain_df.iloc[[position]]
+            request_id = selected_request.index.get_level_values("RequestId")[0]
+            
+            if Storage.ACCEPTED_STATUS_COLUMN in selected_request.columns:
+                accepted_status_codes = selected_request[Storage.ACCEPTED_STATUS_COLUMN].iloc[0]
+            else:
+                accepted_status_codes = self._storage.get_accepted_status(request_id)
+                
+            self._logger.info(f"ThreadedRequestOrchestrator: Picking request: {request_id} - {accepted_status_codes}")
+            
+            byte_callback = lambda size: manager.put_bps_info(domain_id, size)
+            response, bytecount, valid = self._request(selected_request,
+                                                       accepted_status_codes,
+                                                       policy, byte_callback)
+            done_time = dt.datetime.utcnow()
+            
+            manager.put_domain_status(domain_id, header_ids[position], valid)
+            self._store_response(request_id, response, done_time)
+            
+            if valid:
+                success_count += 1
+                
+            self._renew_leases(lease_keeper)
+            
+        return success_count
+    
+    def _work (self, worker, shards, domain_dfs, domain_policy_df,
+               domain_status, status_changed, lease_keeper):
+        manager = _StatusManager(self._logger, self._rate_limiter)
+        manager.set_base_infos(domain_status.copy(), dict(status_changed),
+                               domain_policy_df)
+        
+        success_count = 0
+        
+        while True:
+            domain_id = self._next_domain(shards, worker)
+            
+            if domain_id is None:
+                break
+            
+            if domain_id not in domain_policy_df.index:
+                continue
+            
+            success_count += self._orchestrate_domain(manager, domain_dfs[domain_id],
+                                                      domain_policy_df.loc[domain_id],
+                                                      lease_keeper)
+            
+        return success_count
+    
+    def orchestrate (self, request_df, lease_keeper=None):
+        request_df = self._coalesce_requests(request_df)
+        domain_status = self._storage.get_domain_status()
+        status_changed = {
+                (domain_id, header_id) : False
+                for domain_id, header_id in domain_status.index.values
+            }
+        domain_policy_df = self._storage.get_domain_policy()
+        self._prepare_hosts(request_df, domain_policy_df)
+        
+        domain_dfs = {
+                domain_id : domain_df
+                for domain_id, domain_df in request_df.groupby(level="DomainId", sort=False)
+            }
+        shards = self._create_shards(list(domain_dfs.keys()))
+        
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [
+                    executor.submit(self._work, worker, shards, domain_dfs,
+                                    domain_policy_df, domain_status, status_changed,
+                                    lease_keeper)
+                    for worker in range(self._workers)
+                ]
+            
+            return sum(x.result() for x in futures)
+
+class _AsyncResponse ():
+    '''
+    Stand-in for a requests response of the async client,
+    as far as Response.of_response reads it.
+    '''
+    def __init__ (self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+class AsyncRequestOrchestrator (RequestOrchestrator):
+    '''
+    Fetches many requests concurrently on an asyncio event loop.
+    New fetches of a domain are only started while it has less than
+    domain_concurrency fetches running and is within its rate limits.
+    Rate limited domains are started as soon as they are due.
+    Responses are handed through a bounded queue to a single writer
+    thread, so the storage is never written from the event loop.
+    Domains with ProxyDefault go through the synchronous requester.
+    '''
+    def __init__ (self, storage, requester, logger, global_bps_limit=None,
+                  burst_seconds=1.0, max_wait=60.0, concurrency=200,
+                  domain_concurrency=4, queue_size=1000, retry_engine=None):
+        if aiohttp is None:
+            raise ImportError("The async orchestrator requires aiohttp.")
+        
+        super().__init__(storage, requester, logger,
+                         global_bps_limit=global_bps_limit,
+                         burst_seconds=burst_seconds, max_wait=max_wait,
+                         retry_engine=retry_engine)
+        
+        self._concurrency = concurrency
+        self._domain_concurrency = domain_concurrency
+        self._queue_size = queue_size
+        
+    @classmethod
+    def _prepare_accepted_status_codes (cls, accepted_status_codes):
+        if isinstance(accepted_status_codes, (list, tuple, set)):
+            return set(accepted_status_codes)
+        
+        return set([accepted_status_codes])
+        
+    async def _read_body (self, r, accepted_status_codes, max_bytes, byte_callback):
+        '''
+        Async counterpart of Requester._read_body.
+        '''
+        if r.status not in accepted_status_codes:
+            return b""
+        
+        if max_bytes is not None and r.content_length is not None:
+            if r.content_length > max_bytes:
+                raise ResponseTooLarge(r.content_length)
+        
+        chunks = []
+        size = 0
+        
+        async for chunk in r.content.iter_chunked(Requester.CHUNK_SIZE):
+            size += len(chunk)
+            
+            if max_bytes is not None and size > max_bytes:
+                raise ResponseTooLarge(size)
+            
+            chunks.append(chunk)
+            byte_callback(len(chunk))
+            
+        return b"".join(chunks)
+    
+    async def _fetch (self, session, url, header, accepted_status_codes, timeout,
+                      max_bytes, byte_callback):
+        allow_redirects = 301 not in accepted_status_codes
+        
+        if timeout is not None and np.isnan(timeout):
+            timeout = None
+        
+        try:
+            async with session.get(url, headers=header, allow_redirects=allow_redirects,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                content = await self._read_body(r, accepted_status_codes, max_bytes,
+                                                byte_callback)
+                response = _AsyncResponse(r.status, CaseInsensitiveDict(r.headers),
+                                          content, str(r.url))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError,
+                ResponseTooLarge) as e:
+            self._logger.info(f"AsyncRequestOrchestrator: {url} failed with {e!r}")
+            return None, False, e
+            
+        return response, response.status_code in accepted_status_codes, None
+    
+    async def _request_async (self, session, request, accepted_status_codes, policy,
+                              byte_callback):
+        '''
+        Async counterpart of _request including its retries.
+        '''
+        url = request["URL"]
+        header = json.loads(request["Header"])
+        max_bytes = self._get_max_bytes(policy)
+        bytecounter = 0
+        
+        async def attempt (attempt_url, timeout):
+            nonlocal bytecounter
+            
+            response, valid, error = await self._fetch(session, attempt_url, header,
+                                                       accepted_status_codes, timeout,
+                                                       max_bytes, byte_callback)
+            bytecounter += self._try_get_size_of_response(response)
+            
+            return response, valid, error
+        
+        response, valid, _ = await self._retry_engine.run_async(
+                request["DomainId"], policy, self._get_retry_urls(url, policy), attempt
+            )
+                
+        return response, bytecounter, valid
+    
+    async def _execute (self, session, request, policy, queue, request_df):
+        request_id = request["RequestId"]
+        domain_id = request["DomainId"]
+        header_id = request["HeaderId"]
+        accepted_status_codes = self._prepare_accepted_status_codes(request["AcceptedStatus"])
+        
+        self._logger.info(f"AsyncRequestOrchestrator: Starting request: {request_id} - {accepted_status_codes}")
+        
+        byte_callback = lambda size: self._manager.put_bps_info(domain_id, size)
+        
+        if bool(policy["ProxyDefault"]):
+            loop = asyncio.get_running_loop()
+            # The status manager belongs to the event loop thread
+            threadsafe_callback = lambda size: loop.call_soon_threadsafe(byte_callback, size)
+            response, bytecount, valid = await loop.run_in_executor(
+                    None, self._request, request_df.iloc[[request["Position"]]],
+                    accepted_status_codes, policy, threadsafe_callback
+                )
+        else:
+            response, bytecount, valid = await self._request_async(
+                    session, request, accepted_status_codes, policy, byte_callback
+                )
+            
+        done_time = dt.datetime.utcnow()
+        
+        self._manager.put_domain_status(domain_id, header_id, valid)
+        
+        # Blocks while the writer is behind
+        await queue.put((request_id, response, done_time))
+        
+        return valid
+    
+    async def _write (self, queue, lease_keeper):
+        loop = asyncio.get_running_loop()
+        
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            while True:
+                item = await queue.get()
+                
+                if item is None:
+                    break
+                
+                try:
+                    await loop.run_in_executor(writer, self._store_response, *item)
+                    
+                    if lease_keeper is not None:
+                        await loop.run_in_executor(writer, lease_keeper.renew_if_due)
+                except Exception as e:
+                    self._logger.error(f"AsyncRequestOrchestrator: Storing {item[0]} failed: {e!r}")
+    
+    def _get_pending_requests (self, request_df):
+        '''
+        Returns the requests of the DataFrame grouped by domain.
+        '''
+        pending = defaultdict(deque)
+        
+        request_ids = request_df.index.get_level_values("RequestId")
+        domain_ids = request_df.index.get_level_values("DomainId")
+        header_ids = request_df.index.get_level_values("HeaderId")
+        
+        if Storage.ACCEPTED_STATUS_COLUMN in request_df.columns:
+            accepted_status = request_df[Storage.ACCEPTED_STATUS_COLUMN].values
+        else:
+            accepted_status = [None] * len(request_df)
+        
+        for i in range(len(request_df)):
+            pending[domain_ids[i]].append({
+                    "RequestId" : request_ids[i],
+                    "DomainId" : domain_ids[i],
+                    "HeaderId" : header_ids[i],
+                    "URL" : request_df["URL"].iat[i],
+                    "Header" : request_df["Header"].iat[i],
+                    "AcceptedStatus" : accepted_status[i],
+                    "Position" : i
+                })
+            
+        return pending
+    
+    def _pop_requestable (self, domain_requests):
+        for i, request in enumerate(domain_requests):
+            if self._manager.is_domain_header_requestable(request["DomainId"],
+                                                          request["HeaderId"]):
+                del domain_requests[i]
+                return request
+            
+        return None
+    
+    async def _orchestrate (self, request_df, lease_keeper):
+        request_df = self._coalesce_requests(request_df)
+        domain_policy_df = self._set_base_infos()
+        self._prepare_hosts(request_df, domain_policy_df)
+        pending = self._get_pending_requests(request_df)
+        
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        writer = asyncio.create_task(self._write(queue, lease_keeper))
+        
+        # Task -> DomainId
+        running = {}
+        domain_running = defaultdict(int)
+        success_count = 0
+        
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                                             cookie_jar=aiohttp.DummyCookieJar()) as session:
+                while True:
+                    # Seconds until the first rate limited domain is due
+                    next_wait = None
+                    
+                    for domain_id, domain_requests in pending.items():
+                        while (len(domain_requests) != 0
+                               and len(running) < self._concurrency
+                               and domain_running[domain_id] < self._domain_concurrency):
+                            wait = self._manager.get_domain_wait(domain_id)
+                            
+                            if wait is None:
+                                break
+                            
+                            if wait > 0:
+                                if wait <= self._max_wait:
+                                    next_wait = wait if next_wait is None else min(next_wait, wait)
+                                    
+                                break
+                            
+                            request = self._pop_requestable(domain_requests)
+                            
+                            if request is None:
+                                break
+                            
+                            self._manager.put_request(domain_id)
+                            
+                            if request["AcceptedStatus"] is None:
+                                request["AcceptedStatus"] = self._storage.get_accepted_status(request["RequestId"])
+                            
+                            task = asyncio.create_task(self._execute(
+                                    session, request, domain_policy_df.loc[domain_id],
+                                    queue, request_df
+                                ))
+                            running[task] = domain_id
+                            domain_running[domain_id] += 1
+                    
+                    # Nothing running and nothing due ends the cycle
+                    if len(running) == 0:
+                        if next_wait is None:
+                            break
+                        
+                        await asyncio.sleep(next_wait)
+                        continue
+                    
+                    done, _ = await asyncio.wait(running.keys(), timeout=next_wait,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    
+                    for task in done:
+                        domain_running[running.pop(task)] -= 1
+                        
+                        try:
+                            if task.result():
+                                success_count += 1
+                        except Exception as e:
+                            self._logger.error(f"AsyncRequestOrchestrator: Request failed: {e!r}")
+        finally:
+            await queue.put(None)
+            await writer
+        
+        return success_count
+    
+    def orchestrate (self, request_df, lease_keeper=None):
+        return asyncio.run(self._orchestrate(request_df, lease_keeper))
+
 class RequestHandler():
     '''
     classdocs
     '''
-    def __init__(self, storage, requester, timeout_default=dt.timedelta(hours=3)):
+    def __init__(self, storage, requester, timeout_default=dt.timedelta(hours=3),
+                 freshness=False, worker_id=None,
+                 lease_duration=dt.timedelta(minutes=10),
+                 provisional_max_age=dt.timedelta(days=7),
+                 pending_resync_interval=None, coalesce_window=None,
+                 orchestrator_class=RequestOrchestrator, orchestrator_kwargs={}):
         self._storage = storage
         # self._session = requests.Session()
         self._requester = requester
         
         self._timeout_default = timeout_default
+        # Answer new requests with still fresh cached responses
+        self._freshness = freshness
+        # Attach new requests to pending ones of the same url and
+        # header dated within this timedelta, None always inserts
+        self._coalesce_window = coalesce_window
         
         self._logger = logging.getLogger("requesthandler")
         self._logger.setLevel(logging.INFO)
@@ -363,21 +1115,101 @@ class RequestHandler():
         ch.setFormatter(formatter)
         
         self._logger.addHandler(ch)
-        self._orchestrator = RequestOrchestrator(self._storage, self._requester,
-                                                  self._logger)
+        self._orchestrator = orchestrator_class(self._storage, self._requester,
+                                                 self._logger, **orchestrator_kwargs)
+
+        if worker_id is None:
+            worker_id = "{:s}-{:d}".format(socket.gethostname(), os.getpid())
+
+        # Requests are leased, so several workers can drain the queue
+        self._lease_keeper = _LeaseKeeper(self._storage, worker_id[:64],
+                                          lease_duration)
+        # Mappings of write-behind tokens are kept this long
+        self._provisional_max_age = provisional_max_age
+        
+        # Keeps the pending requests in memory between cycles and only
+        # pulls changes, None queries the capped set on every cycle.
+        self._pending_set = None
         
-    def add_request (self, url, headers={}, accepted_status=200, min_date=None, max_date=None):
+        if pending_resync_interval is not None:
+            self._pending_set = _PendingSet(self._storage, self._logger,
+                                            pending_resync_interval)
+        
+    def add_request (self, url, headers={}, accepted_status=200, min_date=None, max_date=None,
+                     timestamp=None):
         url = URL.of_string(url)
         headers = RequestHeader.of_dict(headers)
         
-        now = dt.datetime.now()
-        request = Request(url, headers, now, accepted_status)
+        if timestamp is None:
+            timestamp = dt.datetime.now()
+            
+        request = Request(url, headers, timestamp, accepted_status)
         
         request_id = self._storage.insert_request(request,
                                                   min_date=min_date,
-                                                  max_date=max_date)
+                                                  max_date=max_date,
+                                                  freshness=self._freshness,
+                                                  coalesce_window=self._coalesce_window)
         return int(request_id)
     
+    def add_requests (self, submissions, tokens=None):
+        '''
+        Adds several submissions at once, each a dict with the keys
+        url, header, accepted_status, timestamp, min_date and max_date.
+        Plain submissions are group-inserted, those with a date window
+        or a freshness check need the single insert path. Optional
+        provisional tokens are mapped to the resulting request ids.
+        Returns the request ids in the order of the submissions.
+        '''
+        request_ids = [None] * len(submissions)
+        
+        bulk_indices = []
+        bulk_requests = []
+        
+        for i, x in enumerate(submissions):
+            if (self._freshness or x["min_date"] is not None
+                or x["max_date"] is not None):
+                request_ids[i] = self.add_request(x["url"], x["header"],
+                                                  x["accepted_status"],
+                                                  x["min_date"], x["max_date"],
+                                                  timestamp=x["timestamp"])
+            else:
+                bulk_indices.append(i)
+                bulk_requests.append(Request(URL.of_string(x["url"]),
+                                             RequestHeader.of_dict(x["header"]),
+                                             x["timestamp"], x["accepted_status"]))
+        
+        if len(bulk_requests) != 0:
+            bulk_tokens = None
+            
+            if tokens is not None:
+                bulk_tokens = [tokens[i] for i in bulk_indices]
+                
+            bulk_ids = self._storage.bulk_insert_requests(bulk_requests,
+                                                          tokens=bulk_tokens,
+                                                          coalesce_window=self._coalesce_window)
+            
+            for i, request_id in zip(bulk_indices, bulk_ids):
+                request_ids[i] = int(request_id)
+                
+        if tokens is not None:
+            bulk_index_set = set(bulk_indices)
+            single_indices = [
+                    i for i in range(len(submissions))
+                    if i not in bulk_index_set
+                ]
+            
+            if len(single_indices) != 0:
+                self._storage.insert_provisional_request_ids(
+                        [tokens[i] for i in single_indices],
+                        [request_ids[i] for i in single_indices]
+                    )
+                
+        return request_ids
+    
+    def get_provisional_request_ids (self, tokens):
+        return self._storage.get_provisional_request_ids(tokens)
+    
     def add_response (self, request_id, request, requests_response):
         response = Response.of_response(request, requests_response, dt.datetime.now())
         response_id = self._storage.direct_insert_response(request_id,
@@ -395,6 +1227,29 @@ class RequestHandler():
         latest_response = self._storage.get_latest_accepted_response(request_id)
         return latest_response
     
+    def get_metrics (self):
+        return {
+                "BloomFilter" : self._storage.get_bloom_filter_metrics(),
+                "SessionPool" : self._requester.get_session_metrics(),
+                "Retries" : self._orchestrator.get_retry_metrics(),
+                "DNSCache" : self._requester.get_dns_metrics(),
+                "Coalescing" : {
+                        "Requests" : self._storage.get_coalesced_request_count(),
+                        "Fetches" : self._orchestrator.get_coalesced_fetch_count()
+                    }
+            }
+    
+    def get_changed_urls (self, since):
+        return self._storage.get_changed_urls(since)
+    
+    def get_near_duplicates (self, request_id):
+        url_id = self._storage.get_request_url_id(request_id)
+        
+        if url_id is None:
+            return None
+        
+        return self._storage.get_near_duplicate_cluster(url_id)
+    
     def _execute_web_request (self, request_index, url, header, accepted_status_codes):
         '''
         with self._session as s:
@@ -415,39 +1270,48 @@ class RequestHandler():
         
         return False            
         
-    def _split_fullrequest_dataframe_by_domain (self, df, count):
+    def _shuffle_requests (self, df):
         '''
-        FULLREQUEST_COLUMNS = ["RequestId", "UrlId", "DomainId", "HeaderId", "Scheme", "Netloc",
-                           "Path", "Query", "Header", "Timestamp", "URL"]
-        FULLREQUEST_INDEX = ["RequestId", "UrlId", "DomainId", "HeaderId"]
+        The per-domain cap and the near-duplicate ranking are
+        applied by the storage query, only the order is mixed.
         '''
-        
-        splitted = []
-        
         if len(df) != 0:
-            unique_domain_ids = df.index.get_level_values("DomainId").unique()
-            
-            for unique_domain_id in unique_domain_ids:
-                subdf = df.xs(unique_domain_id, axis=0, level="DomainId", drop_level=False)[:count]
-                splitted.append(subdf)
-        
-            splitted = pd.concat(splitted, axis=0)
-            rnd = np.arange(len(splitted))
+            rnd = np.arange(len(df))
             np.random.shuffle(rnd)
             
-            splitted = splitted.iloc[rnd]
+            df = df.iloc[rnd]
         
-        return splitted
+        return df
+        
+    def _claim_requests (self, df):
+        claimed = self._lease_keeper.claim(df)
+        
+        if self._pending_set is not None:
+            request_ids = df.index.get_level_values("RequestId")
+            skipped = ~request_ids.isin(claimed.index.get_level_values("RequestId"))
+            self._pending_set.discard(request_ids[skipped].values)
+            
+        return claimed
         
     def _execute_pending_requests (self):
         self._logger.info("Start PendingRequests")
-        df = self._storage.get_requests_without_responses()       
-        df = self._split_fullrequest_dataframe_by_domain(df, 50)
+        if self._pending_set is not None:
+            df = self._pending_set.get_requests(0, self._storage.get_domain_policy())
+        else:
+            df = self._storage.get_limited_requests_without_responses()
+            
+        df = self._shuffle_requests(df)
        
+        if len(df) != 0:
+            df = self._claim_requests(df)
+
         original_length = len(df)
         
         if original_length != 0:
-            success_count = self._orchestrator.orchestrate(df)
+            try:
+                success_count = self._orchestrator.orchestrate(df, self._lease_keeper)
+            finally:
+                self._lease_keeper.release()
         else:
             success_count = 0
         
@@ -497,13 +1361,23 @@ class RequestHandler():
     
     def execute_failing_requests (self):
         self._logger.info("Start FailingRequests")
-        df = self._storage.get_retryable_failing_request()
-        df = self._split_fullrequest_dataframe_by_domain(df, 50)
+        if self._pending_set is not None:
+            df = self._pending_set.get_requests(1, self._storage.get_domain_policy())
+        else:
+            df = self._storage.get_limited_retryable_failing_request()
+            
+        df = self._shuffle_requests(df)
         
+        if len(df) != 0:
+            df = self._claim_requests(df)
+
         original_length = len(df)
         
         if original_length != 0:
-            success_count = self._orchestrator.orchestrate(df)
+            try:
+                success_count = self._orchestrator.orchestrate(df, self._lease_keeper)
+            finally:
+                self._lease_keeper.release()
         else:
             success_count = 0
         
@@ -552,6 +1426,27 @@ class RequestHandler():
         
         msg = f"Execute requests: {filled_timeouts}, {executed_pending_requests}, {executed_failing_requests}"
         self._logger.info(msg)
+        
+        self._requester.evict_idle_sessions()
+        session_metrics = self._requester.get_session_metrics()
+        msg = "Sessions: {:d} open, {:d} requests, {:.1%} on reused connections".format(
+                session_metrics["Sessions"], session_metrics["Requests"],
+                session_metrics["ReuseRatio"]
+            )
+        self._logger.info(msg)
+        
+        retry_metrics = self._orchestrator.get_retry_metrics().values()
+        msg = "Retries: {:d} attempts for {:d} requests, {:d} exhausted budgets".format(
+                sum(x["Attempts"] for x in retry_metrics),
+                sum(x["Requests"] for x in retry_metrics),
+                sum(x["AttemptsExhausted"] + x["BudgetExhausted"] for x in retry_metrics)
+            )
+        self._logger.info(msg)
+        
+        msg = "Coalescing: {:d} fetches saved by requests sharing another one's".format(
+                self._orchestrator.get_coalesced_fetch_count()
+            )
+        self._logger.info(msg)
 
         made_changes = filled_timeouts | executed_pending_requests | executed_failing_requests
         
@@ -559,3 +1454,5 @@ class RequestHandler():
        
     def execute_maintenance(self):
         self._storage.fill_missing_request_statuses()
+        self._storage.delete_expired_request_leases()
+        self._storage.delete_old_provisional_request_ids(self._provisional_max_age)
@@ -0,0 +1,242 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from webrequestmanager.control.requester import ResponseTooLarge
+import datetime as dt
+import asyncio
+import random
+import time
+import requests
+import numpy as np
+
+class RetryEngine ():
+    '''
+    Executes the attempts of a request within the retry budget of its
+    domain policy: 1 + Retries attempts and at most RetryBudget seconds.
+    Waits between attempts grow exponentially from RetryMinDelay up to
+    RetryMaxDelay (max_delay if that is 0) with full jitter, a
+    Retry-After header of the server is honoured. The first valid
+    response ends the run, so does a fatal error.
+    '''
+    RETRYABLE_STATUS_CODES = frozenset([408, 425, 429, 500, 502, 503, 504])
+    # Malformed urls and headers are ValueErrors with both clients
+    FATAL_EXCEPTIONS = (
+            ResponseTooLarge,
+            ValueError,
+            requests.exceptions.InvalidURL,
+            requests.exceptions.MissingSchema,
+            requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidHeader,
+            requests.exceptions.TooManyRedirects,
+            requests.exceptions.SSLError
+        )
+
+    VALID = "valid"
+    RETRYABLE = "retryable"
+    FATAL = "fatal"
+
+    METRIC_COLUMNS = ["Requests", "Attempts", "Successes", "Fatal",
+                      "AttemptsExhausted", "BudgetExhausted"]
+
+    def __init__ (self, base_delay=0.5, max_delay=30.0, max_retry_after=120.0):
+        # First backoff step if the policy has no minimum delay
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_retry_after = max_retry_after
+
+        self._lock = Lock()
+        # DomainId -> Metric -> Count
+        self._metrics = defaultdict(lambda: dict.fromkeys(RetryEngine.METRIC_COLUMNS, 0))
+
+    @classmethod
+    def _get_number (cls, policy, key, default=None):
+        value = policy.get(key, None)
+
+        if value is None or np.isnan(value):
+            return default
+
+        return float(value)
+
+    @classmethod
+    def classify (cls, response, valid, error):
+        if valid:
+            return cls.VALID
+
+        if response is not None:
+            if response.status_code in cls.RETRYABLE_STATUS_CODES:
+                return cls.RETRYABLE
+
+            # Another attempt yields the same not accepted status
+            return cls.FATAL
+
+        if error is not None and isinstance(error, cls.FATAL_EXCEPTIONS):
+            return cls.FATAL
+
+        # Connection errors, timeouts and cancelled attempts
+        return cls.RETRYABLE
+
+    @classmethod
+    def get_retry_after (cls, response):
+        '''
+        Returns the Retry-After of the response in seconds or None.
+        '''
+        if response is None:
+            return None
+
+        value = response.headers.get("Retry-After", None)
+
+        if value is None:
+            return None
+
+        value = value.strip()
+
+        if value.isdigit():
+            return float(value)
+
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=dt.timezone.utc)
+
+        return max((date - dt.datetime.now(dt.timezone.utc)).total_seconds(), 0.0)
+
+    def get_delay (self, policy, retry, response=None):
+        '''
+        Returns the wait in seconds before the given retry (1 based).
+        '''
+        min_delay = self._get_number(policy, "RetryMinDelay", 0.0)
+        max_delay = self._get_number(policy, "RetryMaxDelay", 0.0)
+
+        if max_delay <= 0:
+            max_delay = self._max_delay
+
+        ceiling = min(max(min_delay, self._base_delay) * 2 ** (retry - 1), max_delay)
+        delay = min_delay + random.random() * max(ceiling - min_delay, 0.0)
+
+        retry_after = self.get_retry_after(response)
+
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self._max_retry_after))
+
+        return delay
+
+    def _count (self, domain_id, metric, value=1):
+        with self._lock:
+            self._metrics[domain_id][metric] += value
+
+    def _plan (self, domain_id, policy, urls):
+        '''
+        Generator of the attempts of a run. Yields (delay, url, timeout),
+        the caller waits delay seconds, attempts the url and sends back
+        (response, valid, error). A fatal error drops the url, the
+        remaining urls are attempted in turn.
+        '''
+        domain_id = int(domain_id)
+        max_attempts = 1 + int(self._get_number(policy, "Retries", 0))
+        budget = self._get_number(policy, "RetryBudget", None)
+        timeout = self._get_number(policy, "Timeout", None)
+        urls = list(urls)
+
+        start = time.monotonic()
+        delay = 0.0
+        attempt = 0
+
+        self._count(domain_id, "Requests")
+
+        while True:
+            attempt_timeout = timeout
+
+            if budget is not None:
+                remaining = budget - (time.monotonic() - start) - delay
+
+                if attempt != 0 and remaining <= 0:
+                    self._count(domain_id, "BudgetExhausted")
+                    return
+
+                if attempt_timeout is None or attempt_timeout > remaining:
+                    attempt_timeout = max(remaining, 1.0)
+
+            url = urls[attempt % len(urls)]
+            attempt += 1
+            self._count(domain_id, "Attempts")
+
+            response, valid, error = yield delay, url, attempt_timeout
+            outcome = self.classify(response, valid, error)
+
+            if outcome == RetryEngine.VALID:
+                self._count(domain_id, "Successes")
+                return
+
+            if outcome == RetryEngine.FATAL:
+                urls.remove(url)
+
+                if len(urls) == 0:
+                    self._count(domain_id, "Fatal")
+                    return
+
+            if attempt >= max_attempts:
+                self._count(domain_id, "AttemptsExhausted")
+                return
+
+            delay = self.get_delay(policy, attempt, response)
+
+    def run (self, domain_id, policy, urls, attempt):
+        '''
+        attempt(url, timeout) has to return response, valid and the
+        error of the attempt. Returns the outcome of the last attempt.
+        '''
+        plan = self._plan(domain_id, policy, urls)
+        outcome = None, False, None
+
+        try:
+            delay, url, timeout = next(plan)
+
+            while True:
+                if delay > 0:
+                    time.sleep(delay)
+
+                outcome = attempt(url, timeout)
+                delay, url, timeout = plan.send(outcome)
+        except StopIteration:
+            pass
+
+        return outcome
+
+    async def run_async (self, domain_id, policy, urls, attempt):
+        '''
+        Same as run with a coroutine function as attempt.
+        '''
+        plan = self._plan(domain_id, policy, urls)
+        outcome = None, False, None
+
+        try:
+            delay, url, timeout = next(plan)
+
+            while True:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                outcome = await attempt(url, timeout)
+                delay, url, timeout = plan.send(outcome)
+        except StopIteration:
+            pass
+
+        return outcome
+
+    def get_metrics (self):
+        '''
+        Returns the attempt counts per domain id.
+        '''
+        with self._lock:
+            return {
+                    domain_id : dict(counts)
+                    for domain_id, counts in self._metrics.items()
+                }
@@ -0,0 +1,168 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import time
+
+class SessionPool ():
+    '''
+    Keep-alive sessions per scheme, host and proxy. Repeated fetches
+    against one host reuse its pooled connections instead of doing
+    a new TCP and TLS handshake every time. Sessions idle for longer
+    than max_idle and the least recently used ones beyond max_sessions
+    are closed.
+    '''
+
+    def __init__ (self, pool_connections=4, pool_maxsize=8, max_idle=90.0,
+                  max_sessions=256):
+        # Connection pools per session (hosts reached by redirects
+        # get their own) and kept-alive connections per pool
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._max_idle = max_idle
+        self._max_sessions = max_sessions
+
+        self._lock = Lock()
+        # Key -> [session, last use], least recently used first
+        self._sessions = OrderedDict()
+
+        # Counts of closed sessions
+        self._closed_requests = 0
+        self._closed_connections = 0
+        self._evicted = 0
+
+    @classmethod
+    def _get_key (cls, url, proxy_dict):
+        parsed = urlparse(url)
+        proxy = None
+
+        if proxy_dict is not None:
+            proxy = proxy_dict.get(parsed.scheme, None)
+
+        return parsed.scheme, parsed.netloc.lower(), proxy
+
+    def _create_session (self):
+        session = requests.Session()
+        # Like the module level requests.get, no cookies carry over
+        # from one fetch to the next
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        adapter = HTTPAdapter(pool_connections=self._pool_connections,
+                              pool_maxsize=self._pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    @classmethod
+    def _get_connection_pools (cls, session):
+        pools = []
+        # The same adapter is mounted for both schemes
+        adapters = {id(x) : x for x in session.adapters.values()}
+
+        for adapter in adapters.values():
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+
+                    if pool is not None:
+                        pools.append(pool)
+
+        return pools
+
+    @classmethod
+    def _get_session_counts (cls, session):
+        '''
+        Returns the number of requests and of newly
+        opened connections of the given session.
+        '''
+        pools = cls._get_connection_pools(session)
+
+        requests_count = sum(x.num_requests for x in pools)
+        connections = sum(x.num_connections for x in pools)
+
+        return requests_count, connections
+
+    def _close (self, session):
+        '''
+        Closes the given session, the lock has to be held.
+        '''
+        requests_count, connections = self._get_session_counts(session)
+        self._closed_requests += requests_count
+        self._closed_connections += connections
+        self._evicted += 1
+
+        session.close()
+
+    def _evict (self, now):
+        while len(self._sessions) != 0:
+            key, (session, last_use) = next(iter(self._sessions.items()))
+
+            if now - last_use <= self._max_idle and len(self._sessions) <= self._max_sessions:
+                break
+
+            del self._sessions[key]
+            self._close(session)
+
+    def get_session (self, url, proxy_dict=None):
+        key = self._get_key(url, proxy_dict)
+        now = time.monotonic()
+
+        with self._lock:
+            if key in self._sessions:
+                entry = self._sessions[key]
+                self._sessions.move_to_end(key)
+            else:
+                entry = [self._create_session(), now]
+                self._sessions[key] = entry
+
+            entry[1] = now
+            self._evict(now)
+
+            return entry[0]
+
+    def get (self, url, proxy_dict=None, **kwargs):
+        return self.get_session(url, proxy_dict).get(url, proxies=proxy_dict, **kwargs)
+
+    def evict_idle (self):
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def close (self):
+        with self._lock:
+            while len(self._sessions) != 0:
+                _, (session, _) = self._sessions.popitem(last=False)
+                self._close(session)
+
+    def get_metrics (self):
+        with self._lock:
+            requests_count = self._closed_requests
+            connections = self._closed_connections
+
+            for session, _ in self._sessions.values():
+                session_requests, session_connections = self._get_session_counts(session)
+                requests_count += session_requests
+                connections += session_connections
+
+            sessions = len(self._sessions)
+            evicted = self._evicted
+
+        reused = max(requests_count - connections, 0)
+
+        return {
+                "Sessions" : sessions,
+                "EvictedSessions" : evicted,
+                "Requests" : requests_count,
+                "Connections" : connections,
+                "ReusedConnections" : reused,
+                "ReuseRatio" : reused / requests_count if requests_count != 0 else 0.0
+            }
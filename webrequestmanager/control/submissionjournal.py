@@ -0,0 +1,291 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from collections import OrderedDict
+from itertools import islice
+from threading import Lock, Event, Thread
+import datetime as dt
+import json
+import logging
+import os
+import uuid
+
+class SubmissionJournal ():
+    '''
+    Write-behind buffer for request submissions. Submissions are
+    appended to a local journal file and answered with a provisional
+    token right away. A background thread group-inserts them into
+    the storage and maps the tokens to the final request ids.
+    Pending submissions are replayed from the journal on restart.
+    '''
+    TOKEN_PREFIX = "p"
+    DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__ (self, path, handler, batch_size=1000, flush_interval=1.0,
+                  compact_size=64 * 1024 * 1024, resolved_cache_size=100000):
+        self._path = path
+        self._handler = handler
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        # The journal is rewritten with the pending entries only,
+        # once it grows beyond this size while never running empty.
+        self._compact_size = compact_size
+        self._resolved_cache_size = resolved_cache_size
+
+        self._logger = logging.getLogger("submissionjournal")
+
+        # Protects the file buffer and the pending entries
+        self._lock = Lock()
+        # Serializes fsyncs, appenders share a single sync (group commit)
+        self._sync_lock = Lock()
+        self._written_seq = 0
+        self._synced_seq = 0
+
+        self._pending = OrderedDict()
+        self._resolved = OrderedDict()
+
+        self._flush_event = Event()
+        self._stop_event = Event()
+        self._thread = None
+
+        self._file = None
+        self._replay()
+
+    @classmethod
+    def is_token (cls, request_id):
+        return isinstance(request_id, str) and request_id.startswith(cls.TOKEN_PREFIX)
+
+    @classmethod
+    def _format_date (cls, d):
+        if d is None:
+            return None
+
+        return d.strftime(cls.DATETIME_FORMAT)
+
+    @classmethod
+    def _parse_date (cls, d):
+        if d is None:
+            return None
+
+        return dt.datetime.strptime(d, cls.DATETIME_FORMAT)
+
+    @classmethod
+    def _to_submission (cls, entry):
+        return {
+                "url" : entry["url"],
+                "header" : entry["header"],
+                "accepted_status" : entry["accepted_status"],
+                "timestamp" : cls._parse_date(entry["timestamp"]),
+                "min_date" : cls._parse_date(entry["min_date"]),
+                "max_date" : cls._parse_date(entry["max_date"])
+            }
+
+    def _read_entries (self):
+        entries = OrderedDict()
+
+        if not os.path.exists(self._path):
+            return entries
+
+        with open(self._path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # Torn write of the last line before a crash
+                    self._logger.warning("Skipping unreadable journal line.")
+                    continue
+
+                entries[entry["token"]] = entry
+
+        return entries
+
+    def _replay (self):
+        entries = self._read_entries()
+
+        if len(entries) != 0:
+            mapped = self._handler.get_provisional_request_ids(list(entries.keys()))
+
+            for token, entry in entries.items():
+                if token in mapped:
+                    self._remember_resolved(token, mapped[token])
+                else:
+                    self._pending[token] = entry
+
+            self._logger.info("Replaying {:d} of {:d} journaled submissions.".format(
+                    len(self._pending), len(entries)
+                ))
+
+        with self._sync_lock:
+            with self._lock:
+                self._rewrite()
+
+    def _rewrite (self):
+        '''
+        Atomically replaces the journal with the pending entries.
+        Both locks have to be held.
+        '''
+        if self._file is not None:
+            self._file.close()
+
+        tmp_path = self._path + ".tmp"
+
+        with open(tmp_path, "wb") as f:
+            for entry in self._pending.values():
+                f.write((json.dumps(entry) + "\n").encode("utf-8"))
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self._path)
+
+        self._file = open(self._path, "ab")
+        self._synced_seq = self._written_seq
+
+    def _remember_resolved (self, token, request_id):
+        self._resolved[token] = int(request_id)
+
+        while len(self._resolved) > self._resolved_cache_size:
+            self._resolved.popitem(last=False)
+
+    def _sync (self, seq):
+        with self._sync_lock:
+            # Another appender already synced past this entry
+            if self._synced_seq >= seq:
+                return
+
+            with self._lock:
+                self._file.flush()
+                target = self._written_seq
+
+            os.fsync(self._file.fileno())
+            self._synced_seq = target
+
+    def append (self, url, header, accepted_status=200, min_date=None, max_date=None):
+        '''
+        Durably journals a submission and returns its provisional token.
+        '''
+        token = self.TOKEN_PREFIX + uuid.uuid4().hex
+
+        entry = {
+                "token" : token,
+                "url" : url,
+                "header" : header,
+                "accepted_status" : accepted_status,
+                "timestamp" : self._format_date(dt.datetime.now()),
+                "min_date" : self._format_date(min_date),
+                "max_date" : self._format_date(max_date)
+            }
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+
+        with self._lock:
+            self._file.write(line)
+            self._written_seq += 1
+            seq = self._written_seq
+
+            self._pending[token] = entry
+
+            if len(self._pending) >= self._batch_size:
+                self._flush_event.set()
+
+        self._sync(seq)
+        return token
+
+    def resolve (self, token):
+        '''
+        Returns the request id of a provisional token or None
+        while its submission is not yet flushed.
+        '''
+        with self._lock:
+            if token in self._resolved:
+                return self._resolved[token]
+
+            if token in self._pending:
+                return None
+
+        mapped = self._handler.get_provisional_request_ids([token])
+
+        if token not in mapped:
+            return None
+
+        with self._lock:
+            self._remember_resolved(token, mapped[token])
+
+        return int(mapped[token])
+
+    def get_pending_count (self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush (self):
+        '''
+        Inserts all pending submissions in batches and returns
+        the number of flushed submissions.
+        '''
+        flushed = 0
+
+        while True:
+            with self._lock:
+                batch = list(islice(self._pending.items(), self._batch_size))
+
+            if len(batch) == 0:
+                break
+
+            tokens = [token for token, _ in batch]
+            submissions = [self._to_submission(entry) for _, entry in batch]
+
+            request_ids = self._handler.add_requests(submissions, tokens=tokens)
+
+            with self._lock:
+                for token, request_id in zip(tokens, request_ids):
+                    del self._pending[token]
+                    self._remember_resolved(token, request_id)
+
+            flushed += len(batch)
+
+        self._compact()
+        return flushed
+
+    def _compact (self):
+        with self._sync_lock:
+            with self._lock:
+                if len(self._pending) == 0:
+                    if self._file.tell() != 0:
+                        self._file.truncate(0)
+                        self._file.seek(0)
+                        self._file.flush()
+                        os.fsync(self._file.fileno())
+                        self._synced_seq = self._written_seq
+                elif self._file.tell() > self._compact_size:
+                    self._rewrite()
+
+    def _run (self):
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self._flush_interval)
+            self._flush_event.clear()
+
+            try:
+                flushed = self.flush()
+
+                if flushed != 0:
+                    self._logger.info("Flushed {:d} submissions.".format(flushed))
+            except Exception as e:
+                # Entries stay journaled and are retried with the next flush
+                self._logger.error("Flushing submissions failed: {:s}".format(str(e)))
+
+    def start (self):
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="submissionjournal", daemon=True)
+        self._thread.start()
+
+    def stop (self):
+        self._stop_event.set()
+        self._flush_event.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        self._file.close()
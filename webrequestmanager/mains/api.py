@@ -4,6 +4,7 @@ Created on 01.02.2022
 @author: larsw
 '''
 from webrequestmanager.model.storage import Storage
+from webrequestmanager.model.urlcanonicalizer import URLCanonicalizer
 from webrequestmanager.control.api import WebRequestAPIServer
 from webrequestmanager.control.requesthandling import RequestHandler
 from webrequestmanager.control.requester import Requester, HideMyNameProxyList, ProxyManager
@@ -15,13 +16,17 @@ import traceback as tb
 
 def run_api (host, user, password):
     try:
-        storage = Storage(host, user, password)
+        storage = Storage(host, user, password, bloom_filter=True,
+                          bloom_snapshot_path="bloom_filters.snapshot",
+                          url_canonicalizer=URLCanonicalizer())
         
         # proxy_manager = ProxyManager(HideMyNameProxyList())
         proxy_manager = None
         requester = Requester(proxy_manager)
         
-        server = WebRequestAPIServer(requester, storage)
+        # Scrapers asking for the same page within a minute share a fetch
+        server = WebRequestAPIServer(requester, storage, freshness=True,
+                                     coalesce_window=dt.timedelta(minutes=1))
         server.run()
     except Exception as e:
         print("--------------------- HEEEEEEEEEEEEEELLLLLLLLLLLPPPPPPPPPPPPPP ---------------------------")
@@ -0,0 +1,266 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.storage import Storage, Request, URL, RequestHeader
+from webrequestmanager.model.urlcanonicalizer import URLCanonicalizer
+from collections import deque
+import multiprocessing as mp
+import argparse
+import hashlib
+import json
+import time
+import csv
+import sys
+import datetime as dt
+
+CANONICALIZER = URLCanonicalizer()
+
+def canonicalize_url (url):
+    '''
+    Base canonicalization, so that equivalent urls share a dedupe
+    key. Domain strip lists are applied by the storage.
+    '''
+    return CANONICALIZER.canonicalize(url)
+
+def parse_status (status):
+    if status is None or status == "":
+        return 200
+
+    if isinstance(status, int):
+        return status
+
+    if isinstance(status, list):
+        return [int(x) for x in status]
+
+    if "," in status:
+        return [int(x) for x in status.split(",")]
+
+    return int(status)
+
+def parse_record (record, input_format):
+    if input_format == "ndjson":
+        record = json.loads(record)
+
+        if not isinstance(record, dict):
+            raise ValueError("Record is not an object: {:s}".format(str(record)[:100]))
+
+        url = record["url"]
+        header = record.get("header", {})
+        status = record.get("accepted_status", None)
+    else:
+        url = record[0]
+        header = json.loads(record[1]) if len(record) > 1 and record[1] != "" else {}
+        status = record[2] if len(record) > 2 else None
+
+    if not isinstance(url, str) or not isinstance(header, dict):
+        raise ValueError("Malformed url or header in {:s}".format(str(record)[:100]))
+
+    return canonicalize_url(url), header, parse_status(status)
+
+def get_dedupe_key (url, request):
+    '''
+    Lines with the same url and cache key of the header are one
+    request, which accepts the status codes of all of them.
+    '''
+    return hashlib.blake2b(url.encode("utf-8") + request.request_header.header_checksum,
+                           digest_size=8).digest()
+
+def get_status_codes (request):
+    status = request.accepted_status
+
+    if isinstance(status, int):
+        status = [status]
+
+    return frozenset(status)
+
+def prepare_batch (args):
+    '''
+    Runs in the worker processes. Returns the requests of the batch
+    with their dedupe keys and the number of unreadable records.
+    '''
+    records, input_format, timestamp = args
+
+    prepared = []
+    errors = 0
+
+    for record in records:
+        try:
+            url, header, status = parse_record(record, input_format)
+        except (ValueError, KeyError, IndexError, TypeError):
+            errors += 1
+            continue
+
+        request = Request(URL.of_string(url), RequestHeader.of_dict(header),
+                          timestamp, status)
+        prepared.append((get_dedupe_key(url, request), request))
+
+    return prepared, errors
+
+def read_records (stream, input_format):
+    if input_format == "ndjson":
+        for line in stream:
+            line = line.strip()
+
+            if line != "":
+                yield line
+    else:
+        for i, row in enumerate(csv.reader(stream)):
+            if len(row) == 0:
+                continue
+
+            # Optional header row
+            if i == 0 and row[0].strip().lower() == "url":
+                continue
+
+            yield row
+
+def read_batches (stream, input_format, batch_size, timestamp):
+    batch = []
+
+    for record in read_records(stream, input_format):
+        batch.append(record)
+
+        if len(batch) >= batch_size:
+            yield batch, input_format, timestamp
+            batch = []
+
+    if len(batch) != 0:
+        yield batch, input_format, timestamp
+
+def prepare_batches (pool, batches, max_pending):
+    '''
+    Like pool.imap, but with at most max_pending batches submitted
+    and not yet returned. The pool's task feeder would read the whole
+    input ahead, this streams it.
+    '''
+    pending = deque()
+
+    for batch in batches:
+        pending.append(pool.apply_async(prepare_batch, (batch,)))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while len(pending) != 0:
+        yield pending.popleft().get()
+
+def ingest (storage, stream, input_format, processes=None, batch_size=10000,
+            chunk_size=5000, report_interval=100000, max_seen=1000000):
+    '''
+    Enqueues the requests of the stream, all dated now. Lines with
+    the same url and header are merged into one request accepting
+    the status codes of all of them: within a chunk here, across
+    chunks by bulk_insert_requests, which merges requests of equal
+    url, header and date. The dedupe set skips repeated lines before
+    they reach the storage, it keeps about 80 bytes per unique line
+    and is cleared when it holds max_seen of them.
+    '''
+    timestamp = dt.datetime.now()
+
+    seen = set()
+    # Dedupe key -> request of the chunk
+    buffer = {}
+
+    read_count = 0
+    error_count = 0
+    duplicate_count = 0
+    inserted_count = 0
+    next_report = report_interval
+
+    start = time.perf_counter()
+
+    def report ():
+        secs = max(time.perf_counter() - start, 1e-9)
+        print("{:d} read, {:d} inserted, {:d} duplicates, {:d} errors, {:.0f} rows/s".format(
+                read_count, inserted_count,
+                duplicate_count, error_count,
+                read_count / secs
+            ), file=sys.stderr)
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    with mp.Pool(processes) as pool:
+        batches = read_batches(stream, input_format, batch_size, timestamp)
+
+        for prepared, errors in prepare_batches(pool, batches, 2 * processes):
+            read_count += len(prepared) + errors
+            error_count += errors
+
+            for key, request in prepared:
+                status_codes = get_status_codes(request)
+                seen_key = key + ",".join(str(x) for x in sorted(status_codes)).encode("ascii")
+
+                if seen_key in seen:
+                    duplicate_count += 1
+                    continue
+
+                if len(seen) >= max_seen:
+                    seen.clear()
+
+                seen.add(seen_key)
+                buffered = buffer.get(key, None)
+
+                if buffered is None:
+                    buffer[key] = request
+                else:
+                    buffered.accepted_status = sorted(get_status_codes(buffered) | status_codes)
+                    duplicate_count += 1
+
+                if len(buffer) >= chunk_size:
+                    storage.bulk_insert_requests(list(buffer.values()), chunk_size=chunk_size)
+                    inserted_count += len(buffer)
+                    buffer = {}
+
+            if read_count >= next_report:
+                report()
+                next_report += report_interval
+
+    if len(buffer) != 0:
+        storage.bulk_insert_requests(list(buffer.values()), chunk_size=chunk_size)
+        inserted_count += len(buffer)
+
+    report()
+    return inserted_count
+
+def main ():
+    parser = argparse.ArgumentParser(description="Enqueues urls from a CSV or NDJSON source.")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="Input file, - reads from stdin.")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default=None,
+                        help="Input format, derived from the file extension by default.")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--max-seen", type=int, default=1000000,
+                        help="Unique lines kept for deduplication, about 80 bytes each.")
+    parser.add_argument("--host", default="192.168.178.21")
+    parser.add_argument("--credentials", default="credentials.json")
+    args = parser.parse_args()
+
+    input_format = args.format
+
+    if input_format is None:
+        if args.input.endswith(".json") or args.input.endswith(".ndjson"):
+            input_format = "ndjson"
+        else:
+            input_format = "csv"
+
+    with open(args.credentials, "r") as f:
+        credentials = json.load(f)
+
+    storage = Storage(args.host, credentials["user"], credentials["password"],
+                      url_canonicalizer=CANONICALIZER)
+
+    if args.input == "-":
+        ingest(storage, sys.stdin, input_format, args.processes,
+               args.batch_size, args.chunk_size, max_seen=args.max_seen)
+    else:
+        with open(args.input, "r", newline="", encoding="utf-8") as f:
+            ingest(storage, f, input_format, args.processes,
+                   args.batch_size, args.chunk_size, max_seen=args.max_seen)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.storage import Storage
+from webrequestmanager.model.urlcanonicalizer import URLCanonicalizer
+import argparse
+import json
+
+def main ():
+    parser = argparse.ArgumentParser(description="Reports or merges stored urls sharing a canonical form.")
+    parser.add_argument("--apply", action="store_true",
+                        help="Merge the urls instead of only reporting them.")
+    parser.add_argument("--host", default="192.168.178.21")
+    parser.add_argument("--credentials", default="credentials.json")
+    args = parser.parse_args()
+    
+    with open(args.credentials, "r") as f:
+        credentials = json.load(f)
+    
+    canonicalizer = URLCanonicalizer()
+    storage = Storage(args.host, credentials["user"], credentials["password"],
+                      url_canonicalizer=canonicalizer)
+    
+    report = storage.get_url_canonicalization_report(canonicalizer)
+    print(report.head(50))
+    print("{:d} of {:d} urls would be merged, {:d} rewritten.".format(
+            int(report["Collapsible"].sum()), int(report["Urls"].sum()),
+            int(report["Rewritten"].sum())
+        ))
+    
+    if args.apply:
+        merged = storage.merge_equivalent_urls(canonicalizer)
+        print("Merged {:d} urls.".format(merged))
+    
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,11 @@ Created on 12.04.2022
 @author: larsw
 '''
 from webrequestmanager.model.storage import Storage
-from webrequestmanager.control.requesthandling import RequestHandler
+from webrequestmanager.control.requesthandling import RequestHandler, RequestOrchestrator, ThreadedRequestOrchestrator, AsyncRequestOrchestrator
 from webrequestmanager.control.requester import Requester
+from webrequestmanager.control.dnscache import DNSCache
+from webrequestmanager.control.http2transport import HTTP2Transport
+import argparse
 import json
 import time
 import datetime as dt
@@ -33,7 +36,23 @@ class DBBotRunner ():
 
 
 
+ORCHESTRATOR_CLASSES = {
+        "sequential" : RequestOrchestrator,
+        "threaded" : ThreadedRequestOrchestrator,
+        "async" : AsyncRequestOrchestrator
+    }
+
 def main():
+    parser = argparse.ArgumentParser(description="Executes the pending requests.")
+    parser.add_argument("--mode", choices=list(ORCHESTRATOR_CLASSES.keys()),
+                        default="sequential",
+                        help="Fetch one request at a time or many concurrently.")
+    parser.add_argument("--http2", action="store_true",
+                        help="Fetch over HTTP/2 where the servers support it, requires httpx.")
+    parser.add_argument("--global-bps", type=float, default=None,
+                        help="Bytes per second over all domains.")
+    args = parser.parse_args()
+    
     wait_seconds = [60.0, 120.0, 240.0, 480.0, 900.0]
 
     with open("credentials.json", "r") as f:
@@ -49,9 +68,14 @@ def main():
     
     # proxy_manager = ProxyManager(HideMyNameProxyList())
     proxy_manager = None
-    requester = Requester(proxy_manager)
+    dns_cache = DNSCache()
+    session_pool = HTTP2Transport(dns_cache=dns_cache) if args.http2 else None
+    requester = Requester(proxy_manager, session_pool=session_pool, dns_cache=dns_cache)
     
-    request_handler = RequestHandler(storage, requester, timeout_default=timeout_default)
+    request_handler = RequestHandler(storage, requester, timeout_default=timeout_default,
+                                     pending_resync_interval=dt.timedelta(minutes=30),
+                                     orchestrator_class=ORCHESTRATOR_CLASSES[args.mode],
+                                     orchestrator_kwargs={"global_bps_limit" : args.global_bps})
     
     runner = DBBotRunner(request_handler, wait_seconds)
     
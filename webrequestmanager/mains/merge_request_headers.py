@@ -0,0 +1,23 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.storage import Storage
+import json
+
+def main ():
+    with open("credentials.json", "r") as f:
+        credentials = json.load(f)
+    
+    host = "192.168.178.21"
+    user = credentials["user"]
+    password = credentials["password"]
+    
+    storage = Storage(host, user, password)
+    moved = storage.merge_equivalent_request_headers()
+    
+    print("Moved {:d} domain and header pairs to canonical headers.".format(moved))
+    
+if __name__ == '__main__':
+    main()
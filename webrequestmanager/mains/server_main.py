@@ -4,19 +4,23 @@ Created on 12.04.2022
 @author: larsw
 '''
 from webrequestmanager.model.storage import Storage
+from webrequestmanager.model.urlcanonicalizer import URLCanonicalizer
 from webrequestmanager.control.api import WebRequestAPIServer
 from webrequestmanager.control.requester import Requester
 import json
 
 
 def run_api (host, user, password):
-    storage = Storage(host, user, password)
+    storage = Storage(host, user, password, bloom_filter=True,
+                      bloom_snapshot_path="bloom_filters.snapshot",
+                      url_canonicalizer=URLCanonicalizer())
     
     # proxy_manager = ProxyManager(HideMyNameProxyList())
     proxy_manager = None
     requester = Requester(proxy_manager)
     
-    server = WebRequestAPIServer(requester, storage)
+    server = WebRequestAPIServer(requester, storage,
+                                 journal_path="submissions.journal")
     server.run()
 
 def main ():
@@ -0,0 +1,126 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.storage import Storage, Request, Response, URL, RequestHeader
+import datetime as dt
+import numpy as np
+import json
+import gzip
+import time
+
+def create_versions (version_count, page_words=40000, changes=30, seed=0):
+    '''
+    Creates successive versions of a synthetic page, each one
+    differing from its predecessor by a few small edits.
+    '''
+    rnd = np.random.RandomState(seed)
+    vocabulary = [
+            "".join(rnd.choice(list("abcdefghijklmnopqrstuvwxyz"), rnd.randint(2, 10)))
+            for _ in range(5000)
+        ]
+
+    words = [vocabulary[i] for i in rnd.randint(0, len(vocabulary), page_words)]
+    versions = []
+
+    for _ in range(version_count):
+        for _ in range(changes):
+            words[rnd.randint(0, len(words))] = vocabulary[rnd.randint(0, len(vocabulary))]
+
+        page = "<html><body><p>{:s}</p></body></html>".format(" ".join(words))
+        versions.append(page.encode("utf-8"))
+
+    return versions
+
+def store_versions (storage, versions, run):
+    '''
+    Stores the versions as responses of successive requests for the
+    same url through Storage's write path. Returns the request and
+    response ids and the seconds spent inserting the responses.
+    '''
+    url = URL.of_string("http://127.0.0.1/delta-benchmark?run={:d}".format(run))
+    request_header = RequestHeader.of_dict({})
+    start_date = dt.datetime.now().replace(microsecond=0)
+
+    request_ids = []
+    response_ids = []
+    write_secs = 0
+
+    for i, version in enumerate(versions):
+        timestamp = start_date + dt.timedelta(minutes=i)
+        request = Request(url, request_header, timestamp, [200])
+        request_id = int(storage.insert_request(request))
+        response = Response(request, 200, timestamp, "{}", gzip.compress(version))
+
+        start = time.perf_counter()
+        response_id = storage.direct_insert_response(request_id, response)
+        write_secs += time.perf_counter() - start
+
+        request_ids.append(request_id)
+        response_ids.append(int(response_id))
+
+    return request_ids, response_ids, write_secs
+
+def read_version (storage, request_id):
+    response = storage.get_latest_accepted_response(request_id)
+    return gzip.decompress(bytes(response["Content"]))
+
+def benchmark (storage, versions, run, reads=50):
+    request_ids, response_ids, write_secs = store_versions(storage, versions, run)
+    stored_bytes = storage.get_stored_content_size(response_ids)
+
+    # Older versions are rebuilt from their keyframe
+    indices = np.random.RandomState(1).randint(0, len(versions) - 1, reads)
+
+    start = time.perf_counter()
+
+    for i in indices:
+        if read_version(storage, request_ids[i]) != versions[i]:
+            errmsg = "Version {:d} was not reconstructed correctly.".format(i)
+            raise ValueError(errmsg)
+
+    read_ms = (time.perf_counter() - start) / reads * 1000
+
+    # The latest version is served from the full copy in response_latest
+    start = time.perf_counter()
+
+    for _ in range(reads):
+        if read_version(storage, request_ids[-1]) != versions[-1]:
+            raise ValueError("The latest version was not read correctly.")
+
+    latest_ms = (time.perf_counter() - start) / reads * 1000
+
+    return stored_bytes, write_secs / len(versions) * 1000, read_ms, latest_ms
+
+def main ():
+    with open("credentials.json", "r") as f:
+        credentials = json.load(f)
+
+    versions = create_versions(40)
+    raw_bytes = sum(len(x) for x in versions)
+    run = int(dt.datetime.now().timestamp())
+
+    print("{:d} versions, {:d} bytes uncompressed".format(len(versions), raw_bytes))
+    print("{:>9s} {:>12s} {:>8s} {:>10s} {:>12s} {:>12s}".format(
+            "Interval", "Stored", "Ratio", "Write ms", "Read ms", "Latest ms"
+        ))
+
+    full_bytes = None
+
+    # None stores every version as a full keyframe
+    for i, interval in enumerate([None, 5, 10, 20, 40]):
+        storage = Storage("localhost", credentials["user"], credentials["password"],
+                          delta_keyframe_interval=interval)
+        stored_bytes, write_ms, read_ms, latest_ms = benchmark(storage, versions, run + i)
+
+        if full_bytes is None:
+            full_bytes = stored_bytes
+
+        print("{:>9s} {:>12d} {:>8.3f} {:>10.3f} {:>12.3f} {:>12.3f}".format(
+                "off" if interval is None else str(interval), stored_bytes,
+                stored_bytes / full_bytes, write_ms, read_ms, latest_ms
+            ))
+
+if __name__ == '__main__':
+    main()
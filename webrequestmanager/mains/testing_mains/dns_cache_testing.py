@@ -0,0 +1,68 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.control.dnscache import DNSCache
+from webrequestmanager.control.requester import Requester
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import socket
+
+class StubResolver ():
+    '''
+    Offline resolver of fixed names, counting its lookups.
+    '''
+    def __init__ (self, names, ttl=60.0):
+        self._names = names
+        self._ttl = ttl
+        self.lookups = 0
+
+    def resolve (self, host, family):
+        self.lookups += 1
+
+        if host not in self._names:
+            raise socket.gaierror(socket.EAI_NONAME, "Unknown host {:s}".format(host))
+
+        sa = (self._names[host], 0)
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", sa)], self._ttl
+
+class OKHandler (BaseHTTPRequestHandler):
+    def do_GET (self):
+        content = b"OK"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        # New connection per request, so every fetch resolves
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message (self, *args):
+        pass
+
+def main ():
+    port = 18160
+    server = ThreadingHTTPServer(("127.0.0.1", port), OKHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    resolver = StubResolver({"site-a.test" : "127.0.0.1", "site-b.test" : "127.0.0.1"})
+    dns_cache = DNSCache(resolver, negative_ttl=60.0)
+    requester = Requester(dns_cache=dns_cache)
+
+    requester.prefetch_hosts(["site-a.test:{:d}".format(port), "unknown.test"])
+
+    for host in ["site-a.test", "site-b.test", "unknown.test"]:
+        for i in range(5):
+            url = "http://{:s}:{:d}/{:d}".format(host, port, i)
+            response, secs, valid = requester.request(url, {}, [200], 5, False)
+
+        print(host, response, valid)
+
+    print("Resolver lookups:", resolver.lookups)
+    print("DNS Cache:", dns_cache.get_metrics())
+
+    dns_cache.uninstall()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.fingerprint import ContentFingerprint
+
+PAGE = b"""<!DOCTYPE html>
+<html>
+<head>
+<meta name="generated" content="{generated}">
+<meta property="og:updated_time" content="{generated}">
+<script src="/app.js?v={epoch}"></script>
+</head>
+<body data-timestamp="{epoch}" data-rendered-at="{generated}">
+<!-- served by node {node} -->
+<div class="post" data-comments="{comments}" data-products="{products}">
+<p>Call 0301234567, the event is on 2026-11-02 19:30.</p>
+</div>
+<footer>Generated at {generated}</footer>
+</body>
+</html>
+"""
+
+def get_page (generated="2026-10-19 12:00:00", epoch="1760875200", node="1",
+              comments="5", products="a,b"):
+    return PAGE.replace(b"{generated}", generated.encode()) \
+        .replace(b"{epoch}", epoch.encode()) \
+        .replace(b"{node}", node.encode()) \
+        .replace(b"{comments}", comments.encode()) \
+        .replace(b"{products}", products.encode())
+
+def main ():
+    base = ContentFingerprint.of_content(get_page())
+
+    # Volatile parts, the fingerprint has to stay the same
+    volatile = {
+            "generation time" : get_page(generated="2026-10-19 12:05:42"),
+            "cache buster and data-timestamp" : get_page(epoch="1760875542"),
+            "comment" : get_page(node="2"),
+        }
+    # Content, the fingerprint has to change
+    content = {
+            "data-comments" : get_page(comments="9"),
+            "data-products" : get_page(products="c"),
+            "phone number" : get_page().replace(b"0301234567", b"0307654321"),
+            "event date" : get_page().replace(b"2026-11-02", b"2026-11-09"),
+        }
+
+    failed = 0
+
+    for name, page in volatile.items():
+        same = ContentFingerprint.of_content(page) == base
+        failed += not same
+        print("Volatile {:s}: {:s}".format(name, "same" if same else "CHANGED (wrong)"))
+
+    for name, page in content.items():
+        same = ContentFingerprint.of_content(page) == base
+        failed += same
+        print("Content {:s}: {:s}".format(name, "SAME (wrong)" if same else "changed"))
+
+    print("Failed checks:", failed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.control.sessionpool import SessionPool
+from webrequestmanager.control.http2transport import HTTP2Transport
+from hypercorn.config import Config
+from hypercorn.asyncio import serve
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+import subprocess
+import tempfile
+import asyncio
+import warnings
+import time
+import os
+
+BODY = b"x" * 20000
+
+async def app (scope, receive, send):
+    '''
+    ASGI page with a fixed server latency.
+    '''
+    if scope["type"] != "http":
+        return
+
+    await asyncio.sleep(0.05)
+    await send({
+            "type" : "http.response.start",
+            "status" : 200,
+            "headers" : [(b"content-length", str(len(BODY)).encode("ascii"))]
+        })
+    await send({"type" : "http.response.body", "body" : BODY})
+
+def create_certificate (directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", keyfile, "-out", certfile, "-days", "1",
+                    "-subj", "/CN=localhost"], check=True, capture_output=True)
+
+    return certfile, keyfile
+
+def start_server (port, certfile, keyfile, alpn_protocols):
+    config = Config()
+    config.bind = ["localhost:{:d}".format(port)]
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.alpn_protocols = alpn_protocols
+    config.loglevel = "ERROR"
+
+    started = Event()
+    stop = Event()
+
+    def run ():
+        async def trigger ():
+            started.set()
+
+            while not stop.is_set():
+                await asyncio.sleep(0.1)
+
+        asyncio.run(serve(app, config, shutdown_trigger=trigger))
+
+    Thread(target=run, daemon=True).start()
+    started.wait()
+    time.sleep(0.5)
+
+    return stop
+
+def benchmark (name, get, url, request_count, workers, metrics):
+    def fetch (i):
+        r = get("{:s}/{:d}".format(url, i))
+        return r.status_code == 200 and len(r.content) == len(BODY)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        valid = sum(executor.map(fetch, range(request_count)))
+
+    secs = time.perf_counter() - start
+    m = metrics()
+
+    print("{:28s} {:4d}/{:d} valid, {:6.2f}s, {:7.1f} req/s, {:3d} connections, {:d} HTTP/2".format(
+            name, valid, request_count, secs, request_count / secs,
+            m["Connections"], m.get("HTTP2Requests", 0)
+        ))
+
+def main ():
+    request_count = 400
+    workers = 50
+    h2_port = 18170
+    h1_port = 18171
+
+    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = create_certificate(directory)
+
+        stops = [
+                start_server(h2_port, certfile, keyfile, ["h2", "http/1.1"]),
+                start_server(h1_port, certfile, keyfile, ["http/1.1"])
+            ]
+
+        h2_url = "https://localhost:{:d}".format(h2_port)
+        h1_url = "https://localhost:{:d}".format(h1_port)
+
+        pool = SessionPool(pool_maxsize=workers)
+        benchmark("SessionPool (HTTP/1.1)", lambda url: pool.get(url, verify=False, timeout=30),
+                  h2_url, request_count, workers, pool.get_metrics)
+        pool.close()
+
+        transport = HTTP2Transport(verify=False)
+        benchmark("HTTP2Transport", lambda url: transport.get(url, timeout=30),
+                  h2_url, request_count, workers, transport.get_metrics)
+        transport.close()
+
+        transport = HTTP2Transport(verify=False)
+        transport.set_stream_limits({"localhost:{:d}".format(h2_port) : 8})
+        benchmark("HTTP2Transport, 8 streams", lambda url: transport.get(url, timeout=30),
+                  h2_url, request_count, workers, transport.get_metrics)
+        transport.close()
+
+        transport = HTTP2Transport(verify=False)
+        benchmark("HTTP2Transport, no h2 ALPN", lambda url: transport.get(url, timeout=30),
+                  h1_url, request_count, workers, transport.get_metrics)
+        transport.close()
+
+        for stop in stops:
+            stop.set()
+
+if __name__ == '__main__':
+    main()
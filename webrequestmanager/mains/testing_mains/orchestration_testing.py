@@ -0,0 +1,72 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.model.storage import Storage
+from webrequestmanager.control.requesthandling import RequestHandler, RequestOrchestrator, ThreadedRequestOrchestrator, AsyncRequestOrchestrator
+from webrequestmanager.control.requester import Requester
+from webrequestmanager.mains.testing_mains.testing_server import run_server_main
+import multiprocessing as mp
+import datetime as dt
+import json
+import time
+
+def add_requests (request_handler, ports, urls_per_port, run):
+    # A fresh parameter per run, so earlier responses are not reused
+    for port in ports:
+        for i in range(urls_per_port):
+            url = "http://127.0.0.1:{:d}/?number={:d}&run={:d}".format(port, i, run)
+            request_handler.add_request(url, {}, accepted_status=[200, 501])
+
+def run_mode (storage, orchestrator_class, ports, urls_per_port, run):
+    request_handler = RequestHandler(storage, Requester(),
+                                     orchestrator_class=orchestrator_class)
+    add_requests(request_handler, ports, urls_per_port, run)
+    
+    start = time.perf_counter()
+    
+    while request_handler.execute_requests():
+        pass
+    
+    return time.perf_counter() - start
+
+def main ():
+    with open("credentials.json", "r") as f:
+        credentials = json.load(f)
+    
+    storage = Storage("localhost", credentials["user"], credentials["password"])
+    
+    ports = list(range(18140, 18148))
+    urls_per_port = 30
+    
+    pool = mp.Pool(len(ports))
+    
+    for port in ports:
+        pool.apply_async(run_server_main, tuple([__name__, port]))
+        
+    time.sleep(5)
+    
+    run = int(dt.datetime.now().timestamp())
+    
+    orchestrator_classes = [RequestOrchestrator, ThreadedRequestOrchestrator,
+                            AsyncRequestOrchestrator]
+    request_count = len(ports) * urls_per_port
+    serial_secs = None
+    
+    try:
+        for i, orchestrator_class in enumerate(orchestrator_classes):
+            secs = run_mode(storage, orchestrator_class, ports, urls_per_port, run + i)
+            
+            if serial_secs is None:
+                serial_secs = secs
+            
+            print("{:s}: {:d} requests in {:.2f} s, {:.1f} requests/s, {:.1f}x serial".format(
+                    orchestrator_class.__name__, request_count, secs,
+                    request_count / secs, serial_secs / secs
+                ))
+    finally:
+        pool.terminate()
+    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from webrequestmanager.control.requester import StaticProxyList, ProxyManager, ProxyMaintainer, Requester
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import datetime as dt
+import requests
+import time
+
+class CheckHandler (BaseHTTPRequestHandler):
+    '''
+    Local stand-in for the check url.
+    '''
+    def do_GET (self):
+        content = b"OK"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        
+    def log_message (self, *args):
+        pass
+        
+class ForwardingProxyHandler (BaseHTTPRequestHandler):
+    '''
+    Minimal plain http proxy, the request line holds the full url.
+    '''
+    def do_GET (self):
+        r = requests.get(self.path, timeout=5)
+        self.send_response(r.status_code)
+        self.send_header("Content-Length", str(len(r.content)))
+        self.end_headers()
+        self.wfile.write(r.content)
+        
+    def log_message (self, *args):
+        pass
+    
+def serve (handler_class, port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main ():
+    check_port = 18150
+    proxy_ports = [18151, 18152]
+    
+    serve(CheckHandler, check_port)
+    
+    for port in proxy_ports:
+        serve(ForwardingProxyHandler, port)
+        
+    # One dead proxy, which must not be published
+    proxies = [("http", "127.0.0.1", port) for port in proxy_ports + [18159]]
+    
+    proxy_manager = ProxyManager(StaticProxyList(proxies))
+    maintainer = ProxyMaintainer(proxy_manager, "http://127.0.0.1:{:d}/".format(check_port),
+                                 interval=dt.timedelta(seconds=10), check_timeout=2.0)
+    maintainer.start()
+    
+    time.sleep(3)
+    print("Published Proxy Data:\n"+str(proxy_manager.get_proxy_data()))
+    
+    requester = Requester(proxy_manager)
+    response, secs, valid = requester.request("http://127.0.0.1:{:d}/".format(check_port),
+                                              {}, [200], 5, True)
+    print(response, secs, valid)
+    print("Proxy Data:\n"+str(proxy_manager.get_proxy_data()))
+    
+    maintainer.stop()
+    
+if __name__ == '__main__':
+    main()
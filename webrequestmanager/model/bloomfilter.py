@@ -0,0 +1,183 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+import hashlib
+import json
+import math
+import os
+import struct
+from threading import Lock
+
+class BloomFilter ():
+    '''
+    Bloom filter over byte keys. A negative answer is definite,
+    a positive one may be false with the configured error rate.
+    Observed false positives have to be reported by the caller
+    after a lookup did not find the key. Safe to share between
+    threads.
+    '''
+
+    def __init__ (self, capacity, error_rate=0.01, bit_count=None,
+                  hash_count=None, bits=None, count=0):
+        self.capacity = int(capacity)
+        self.error_rate = error_rate
+
+        if bit_count is None:
+            bit_count = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+            bit_count = max(bit_count, 8)
+
+        if hash_count is None:
+            hash_count = max(int(round(bit_count / self.capacity * math.log(2))), 1)
+
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+
+        if bits is None:
+            bits = bytearray((bit_count + 7) // 8)
+
+        self._bits = bits
+        self.count = count
+        self._lock = Lock()
+
+        self.queries = 0
+        self.negatives = 0
+        self.false_positives = 0
+
+    def _get_positions (self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [
+                (h1 + i * h2) % self.bit_count
+                for i in range(self.hash_count)
+            ]
+
+    def add (self, key):
+        positions = self._get_positions(key)
+
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+            self.count += 1
+
+    def might_contain (self, key):
+        positions = self._get_positions(key)
+
+        with self._lock:
+            self.queries += 1
+
+            for position in positions:
+                if self._bits[position >> 3] & (1 << (position & 7)) == 0:
+                    self.negatives += 1
+                    return False
+
+        return True
+
+    def record_false_positive (self):
+        with self._lock:
+            self.false_positives += 1
+
+    def get_expected_false_positive_rate (self):
+        exponent = -self.hash_count * self.count / self.bit_count
+        return (1 - math.exp(exponent)) ** self.hash_count
+
+    def get_observed_false_positive_rate (self):
+        # False positives among all queries for absent keys
+        absent = self.false_positives + self.negatives
+
+        if absent == 0:
+            return 0.0
+
+        return self.false_positives / absent
+
+    def is_saturated (self):
+        return self.count > self.capacity
+
+    def get_metrics (self):
+        with self._lock:
+            return {
+                    "Count" : self.count,
+                    "Capacity" : self.capacity,
+                    "Queries" : self.queries,
+                    "DefiniteMisses" : self.negatives,
+                    "FalsePositives" : self.false_positives,
+                    "ObservedFalsePositiveRate" : self.get_observed_false_positive_rate(),
+                    "ExpectedFalsePositiveRate" : self.get_expected_false_positive_rate()
+                }
+
+    def _get_state (self):
+        '''
+        The parameters and a copy of the bits, taken together.
+        '''
+        with self._lock:
+            return self.get_parameters(), bytes(self._bits)
+
+    def get_parameters (self):
+        return {
+                "capacity" : self.capacity,
+                "error_rate" : self.error_rate,
+                "bit_count" : self.bit_count,
+                "hash_count" : self.hash_count,
+                "count" : self.count
+            }
+
+    @classmethod
+    def save_snapshot (cls, path, filters, extra=None):
+        '''
+        Atomically writes the given dict of named filters
+        and extra JSON serializable information to a file.
+        '''
+        states = {
+                name : f._get_state()
+                for name, f in filters.items()
+            }
+        header = {
+                "filters" : {
+                        name : state[0]
+                        for name, state in states.items()
+                    },
+                "order" : list(filters.keys()),
+                "extra" : extra
+            }
+        header = json.dumps(header).encode("utf-8")
+
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+
+            for name in filters:
+                f.write(states[name][1])
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_snapshot (cls, path):
+        '''
+        Returns the dict of named filters and the extra
+        information of a snapshot file.
+        '''
+        with open(path, "rb") as f:
+            header_length = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+            filters = {}
+
+            for name in header["order"]:
+                params = header["filters"][name]
+                bits = bytearray(f.read((params["bit_count"] + 7) // 8))
+
+                filters[name] = BloomFilter(params["capacity"], params["error_rate"],
+                                            bit_count=params["bit_count"],
+                                            hash_count=params["hash_count"],
+                                            bits=bits, count=params["count"])
+
+        return filters, header["extra"]
@@ -0,0 +1,148 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+
+class BinaryDelta ():
+    '''
+    Block matching binary delta between two versions of a document.
+    A delta consists of copy operations referencing the old version
+    and inserts of literal bytes which are not found in it.
+    '''
+    MAGIC = b"WRD1"
+    COPY_OP = 1
+    INSERT_OP = 2
+
+    @classmethod
+    def _write_varint (cls, buf, value):
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+
+            if value != 0:
+                buf.append(byte | 0x80)
+            else:
+                buf.append(byte)
+                return
+
+    @classmethod
+    def _read_varint (cls, data, pos):
+        value = 0
+        shift = 0
+
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+            if byte & 0x80 == 0:
+                return value, pos
+
+    @classmethod
+    def _append_insert (cls, buf, literal):
+        if len(literal) != 0:
+            buf.append(cls.INSERT_OP)
+            cls._write_varint(buf, len(literal))
+            buf.extend(literal)
+
+    @classmethod
+    def create (cls, old, new, block_size=32):
+        old = bytes(old)
+        new = bytes(new)
+
+        old_len = len(old)
+        new_len = len(new)
+
+        index = {}
+
+        for i in range(0, old_len - block_size + 1, block_size):
+            index.setdefault(old[i:i+block_size], i)
+
+        buf = bytearray(cls.MAGIC)
+        cls._write_varint(buf, new_len)
+
+        literal_start = 0
+        i = 0
+
+        while i <= new_len - block_size:
+            j = index.get(new[i:i+block_size], None)
+
+            if j is None:
+                i += 1
+                continue
+
+            # Extend the match backwards into the pending literal
+            start_new = i
+            start_old = j
+
+            while (start_new > literal_start and start_old > 0
+                   and new[start_new-1] == old[start_old-1]):
+                start_new -= 1
+                start_old -= 1
+
+            # Extend the match forwards, blockwise first
+            end_new = i + block_size
+            end_old = j + block_size
+
+            while (end_new + block_size <= new_len and end_old + block_size <= old_len
+                   and new[end_new:end_new+block_size] == old[end_old:end_old+block_size]):
+                end_new += block_size
+                end_old += block_size
+
+            while (end_new < new_len and end_old < old_len
+                   and new[end_new] == old[end_old]):
+                end_new += 1
+                end_old += 1
+
+            cls._append_insert(buf, new[literal_start:start_new])
+
+            buf.append(cls.COPY_OP)
+            cls._write_varint(buf, start_old)
+            cls._write_varint(buf, end_new - start_new)
+
+            i = end_new
+            literal_start = end_new
+
+        cls._append_insert(buf, new[literal_start:])
+
+        return bytes(buf)
+
+    @classmethod
+    def apply (cls, old, delta):
+        old = bytes(old)
+        delta = bytes(delta)
+
+        if not delta.startswith(cls.MAGIC):
+            errmsg = "The given data is not a binary delta."
+            raise ValueError(errmsg)
+
+        pos = len(cls.MAGIC)
+        new_len, pos = cls._read_varint(delta, pos)
+
+        new = bytearray()
+
+        while pos < len(delta):
+            op = delta[pos]
+            pos += 1
+
+            if op == cls.COPY_OP:
+                offset, pos = cls._read_varint(delta, pos)
+                length, pos = cls._read_varint(delta, pos)
+                new.extend(old[offset:offset+length])
+            elif op == cls.INSERT_OP:
+                length, pos = cls._read_varint(delta, pos)
+                new.extend(delta[pos:pos+length])
+                pos += length
+            else:
+                errmsg = "Unknown delta operation {:d}.".format(op)
+                raise ValueError(errmsg)
+
+        if len(new) != new_len:
+            errmsg = "Delta result has length {:d} instead of {:d}.".format(
+                    len(new), new_len
+                )
+            raise ValueError(errmsg)
+
+        return bytes(new)
@@ -0,0 +1,75 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+import hashlib
+import re
+
+class ContentFingerprint ():
+    '''
+    Creates checksums of response contents, optionally after
+    removing volatile parts of HTML documents (comments, nonces,
+    CSRF tokens, timestamps), so that two fetches of an unchanged
+    page yield the same fingerprint. Timestamps are only removed
+    where pages put generation times, elsewhere dates and numbers
+    are content.
+    '''
+    TIMESTAMP = rb"(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?|1\d{9}(\d{3})?)"
+    HTML_PATTERNS = [
+            re.compile(rb"<!--.*?-->", re.S),
+            re.compile(rb"\snonce\s*=\s*(\"[^\"]*\"|'[^']*')", re.I),
+            re.compile(rb"<meta[^>]+name\s*=\s*[\"']?csrf[^>]*>", re.I),
+            re.compile(rb"<input[^>]+name\s*=\s*[\"']?(csrf[\w-]*|_token|authenticity_token|"
+                       rb"__requestverificationtoken|__viewstate\w*|__eventvalidation)[^>]*>", re.I),
+        ]
+    TIMESTAMP_PATTERNS = [
+            # <meta name="generated" content="...">, <meta property="og:updated_time" ...>
+            re.compile(rb"<meta[^>]+(name|property|itemprop|http-equiv)\s*=\s*[\"']?[\w:.-]*"
+                       rb"(date|time|modified|updated|generated)[^>]*>", re.I),
+            # data-timestamp="...", data-rendered-at="...", not data-comments="..."
+            re.compile(rb"\sdata-(timestamp|ts|time|generated(-at)?|rendered(-at)?)\s*=\s*"
+                       rb"(\"[^\"]*\"|'[^']*'|[^\s>]+)", re.I),
+            # Cache busters like app.js?v=1697712345
+            re.compile(rb"[?&](_|t|ts|v|cb|timestamp)=1\d{9}(\d{3})?\b"),
+            # "Generated at 2026-10-19 12:00:00"
+            re.compile(rb"(generated|rendered|cached|built)\s+(at|on)\s*:?\s*" + TIMESTAMP, re.I),
+        ]
+    WHITESPACE_PATTERN = re.compile(rb"\s+")
+    INTERTAG_WHITESPACE_PATTERN = re.compile(rb">\s+<")
+
+    @classmethod
+    def is_html (cls, content, content_type=None):
+        if content_type is not None:
+            return "html" in content_type.lower()
+
+        start = content[:256].lstrip().lower()
+        return start.startswith(b"<!doctype html") or start.startswith(b"<html")
+
+    @classmethod
+    def normalize_html (cls, content):
+        for pattern in cls.HTML_PATTERNS:
+            content = pattern.sub(b"", content)
+
+        for pattern in cls.TIMESTAMP_PATTERNS:
+            content = pattern.sub(b"", content)
+
+        content = cls.WHITESPACE_PATTERN.sub(b" ", content)
+        content = cls.INTERTAG_WHITESPACE_PATTERN.sub(b"><", content)
+        return content.strip()
+
+    @classmethod
+    def of_content (cls, content, content_type=None, normalize_html=True):
+        '''
+        Returns the 16 byte fingerprint of the given raw content
+        or None if there is no content.
+        '''
+        if content is None:
+            return None
+
+        content = bytes(content)
+
+        if normalize_html and cls.is_html(content, content_type):
+            content = cls.normalize_html(content)
+
+        return hashlib.md5(content).digest()
@@ -0,0 +1,128 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from email.utils import parsedate_to_datetime
+import datetime as dt
+import json
+
+class ResponseFreshness ():
+    '''
+    Evaluates the HTTP caching headers (Cache-Control, Expires, Age)
+    of a stored response to decide whether it can still be served
+    instead of fetching the page again.
+    '''
+    UNCACHEABLE_DIRECTIVES = {"no-store", "no-cache"}
+
+    def __init__ (self, requested, headers):
+        # UTC timestamp of the stored response
+        self.requested = requested
+        self.headers = {
+                str(k).lower() : str(v)
+                for k, v in headers.items()
+            }
+
+    @classmethod
+    def of_stored_response (cls, requested, stored_header):
+        try:
+            headers = json.loads(stored_header)
+        except (TypeError, ValueError):
+            headers = {}
+
+        if not isinstance(headers, dict):
+            headers = {}
+
+        return ResponseFreshness(requested, headers)
+
+    @classmethod
+    def _parse_http_date (cls, value):
+        try:
+            d = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        if d is None:
+            return None
+
+        if d.tzinfo is not None:
+            d = d.astimezone(dt.timezone.utc).replace(tzinfo=None)
+
+        return d
+
+    def _get_cache_control (self):
+        directives = {}
+
+        for x in self.headers.get("cache-control", "").split(","):
+            x = x.strip().lower()
+
+            if len(x) == 0:
+                continue
+
+            if "=" in x:
+                k, v = x.split("=", 1)
+                directives[k.strip()] = v.strip().strip("\"")
+            else:
+                directives[x] = None
+
+        return directives
+
+    def get_lifetime (self):
+        '''
+        Returns the freshness lifetime in seconds as given by the
+        response headers or None if the headers do not define one.
+        '''
+        directives = self._get_cache_control()
+
+        if len(self.UNCACHEABLE_DIRECTIVES.intersection(directives)) != 0:
+            return 0
+
+        for directive in ("s-maxage", "max-age"):
+            if directive in directives:
+                try:
+                    return max(int(directives[directive]), 0)
+                except (TypeError, ValueError):
+                    return 0
+
+        if "expires" in self.headers:
+            expires = ResponseFreshness._parse_http_date(self.headers["expires"])
+
+            if expires is None:
+                return 0
+
+            date = ResponseFreshness._parse_http_date(self.headers.get("date", ""))
+
+            if date is None:
+                date = self.requested
+
+            return max((expires - date).total_seconds(), 0)
+
+        return None
+
+    def get_age (self, utc_now):
+        '''
+        Returns the current age of the response in seconds.
+        '''
+        try:
+            age = max(int(self.headers.get("age", "0")), 0)
+        except ValueError:
+            age = 0
+
+        resident = (utc_now - self.requested).total_seconds()
+
+        return age + max(resident, 0)
+
+    def is_fresh (self, utc_now, lifetime_override=None):
+        '''
+        A lifetime override (e.g. from the domain policy) takes
+        precedence over the lifetime given by the response headers.
+        '''
+        if lifetime_override is not None:
+            lifetime = lifetime_override
+        else:
+            lifetime = self.get_lifetime()
+
+        if lifetime is None:
+            return False
+
+        return self.get_age(utc_now) < lifetime
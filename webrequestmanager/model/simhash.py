@@ -0,0 +1,76 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+import numpy as np
+import hashlib
+import re
+
+class SimHash ():
+    '''
+    64 bit SimHash over word shingles of a response content.
+    Near-duplicate documents differ in only a few bits. The hash
+    is split into bands, so that candidates within a small
+    hamming distance share at least one band exactly.
+    '''
+    BITS = 64
+    BAND_COUNT = 4
+    BAND_BITS = 16
+
+    TAG_PATTERN = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.S | re.I)
+    WORD_PATTERN = re.compile(r"\w+", re.U)
+
+    @classmethod
+    def tokenize (cls, content):
+        text = bytes(content).decode("utf-8", errors="ignore")
+        text = cls.TAG_PATTERN.sub(" ", text)
+        return cls.WORD_PATTERN.findall(text.lower())
+
+    @classmethod
+    def of_content (cls, content, shingle_size=4):
+        '''
+        Returns the SimHash of the given raw content as unsigned
+        integer or None if the content has no words.
+        '''
+        if content is None:
+            return None
+
+        words = cls.tokenize(content)
+
+        if len(words) == 0:
+            return None
+
+        shingle_count = max(len(words) - shingle_size + 1, 1)
+        shingles = [
+                " ".join(words[i:i+shingle_size])
+                for i in range(shingle_count)
+            ]
+
+        hashes = np.frombuffer(b"".join(
+                hashlib.md5(x.encode("utf-8")).digest()[:8]
+                for x in shingles
+            ), dtype=">u8")
+
+        bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)
+        weights = np.sum(bits, axis=0, dtype=np.int64) * 2 - len(shingles)
+
+        simhash = 0
+
+        for bit in (weights > 0):
+            simhash = (simhash << 1) | int(bit)
+
+        return simhash
+
+    @classmethod
+    def get_bands (cls, simhash):
+        mask = (1 << cls.BAND_BITS) - 1
+
+        return [
+                (simhash >> (cls.BAND_BITS * i)) & mask
+                for i in range(cls.BAND_COUNT)
+            ]
+
+    @classmethod
+    def distance (cls, a, b):
+        return bin(a ^ b).count("1")
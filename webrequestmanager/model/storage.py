@@ -4,7 +4,7 @@ Created on 12.01.2022
 @author: larsw
 '''
 import mysql.connector
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
 import hashlib
 import numpy as np
 import pandas as pd
@@ -13,7 +13,15 @@ from io import BytesIO
 import gzip
 import datetime as dt
 import time
-from threading import RLock
+import os
+import re
+from threading import RLock, Lock
+from webrequestmanager.model.freshness import ResponseFreshness
+from webrequestmanager.model.fingerprint import ContentFingerprint
+from webrequestmanager.model.delta import BinaryDelta
+from webrequestmanager.model.simhash import SimHash
+from webrequestmanager.model.bloomfilter import BloomFilter
+from webrequestmanager.model.urlcanonicalizer import URLCanonicalizer
 
 class URL ():
     def __init__ (self, urlparsed, path_checksum, query_checksum):
@@ -30,15 +38,51 @@ class URL ():
         
         return URL(urlparsed, path_checksum, query_checksum)
     
+    def to_string (self):
+        return urlunparse(self.urlparsed)
+    
 class RequestHeader ():
+    # Request headers which usually do not change the response. They
+    # are left out of the checksum and the stored header, so a request
+    # never sends the conditional headers of whoever submitted it
+    # first, unless a domain names them in its Vary headers
+    # (domain_policy.cache_key_headers).
+    # User-Agent is keyed, many sites vary on it without saying so,
+    # domains can leave it out (domain_policy.cache_ignore_headers).
+    IGNORED_KEY_HEADERS = frozenset([
+            "cache-control", "pragma", "if-none-match", "if-modified-since",
+            "connection", "keep-alive", "dnt", "upgrade-insecure-requests"
+        ])
+    
     def __init__ (self, header_dict, stringed_header_dict, header_checksum):
         self.header_dict = header_dict
         self.stringed_header_dict = stringed_header_dict
         self.header_checksum = header_checksum
         
     @classmethod
-    def of_dict (cls, d):
-        stringed = json.dumps(d)
+    def canonicalize (cls, d):
+        return {
+                str(k).strip().lower() : v
+                for k, v in d.items()
+            }
+        
+    @classmethod
+    def of_dict (cls, d, key_headers=frozenset(), ignore_headers=frozenset()):
+        '''
+        Header names are lowercased and sorted. The checksum and the
+        stored (sent) header only cover the headers which belong to
+        the cache key, the header dict keeps all of them for rekeying.
+        Key headers take precedence over ignored ones.
+        '''
+        d = RequestHeader.canonicalize(d)
+        
+        key = {
+                k : v
+                for k, v in d.items()
+                if k in key_headers or (k not in RequestHeader.IGNORED_KEY_HEADERS
+                                        and k not in ignore_headers)
+            }
+        stringed = json.dumps(key, sort_keys=True)
         checksum = hashlib.md5(stringed.encode("utf-8")).digest()
         
         return RequestHeader(d, stringed, checksum)
@@ -51,15 +95,23 @@ class Request ():
         self.accepted_status = accepted_status
         
 class Response ():
-    def __init__ (self, request, status_code, timestamp, headers, content):
+    TEXT_CONTENT_TYPES = ["text", "html", "xml", "json"]
+    
+    def __init__ (self, request, status_code, timestamp, headers, content,
+                  fingerprint=None, simhash=None, vary=None):
         self.request = request
         self.status_code = status_code
         self.timestamp = timestamp
         self.headers = headers
         self.content = content
+        self.fingerprint = fingerprint
+        self.simhash = simhash
+        # Lowercased request header names of the Vary header
+        self.vary = vary
         
     @classmethod
-    def of_response (cls, request, requests_response, timestamp):
+    def of_response (cls, request, requests_response, timestamp,
+                     normalize_html=True):
         status_code = requests_response.status_code
         headers = json.dumps(dict(requests_response.headers))
         headers = headers.replace("\"", "\\\"")
@@ -77,7 +129,24 @@ class Response ():
         else:
             content = None
             
-        return Response(request, status_code, timestamp, headers, content)
+        content_type = requests_response.headers.get("Content-Type", None)
+        fingerprint = ContentFingerprint.of_content(
+                c, content_type, normalize_html=normalize_html
+            )
+        
+        if content_type is None or any(x in content_type.lower() 
+                                       for x in Response.TEXT_CONTENT_TYPES):
+            simhash = SimHash.of_content(c)
+        else:
+            simhash = None
+            
+        vary = requests_response.headers.get("Vary", None)
+        
+        if vary is not None:
+            vary = [x.strip().lower() for x in vary.split(",") if x.strip() != ""]
+            
+        return Response(request, status_code, timestamp, headers, content,
+                        fingerprint=fingerprint, simhash=simhash, vary=vary)
     
     def is_accepted (self, accepted_status_codes):
         return self.status_code in accepted_status_codes
@@ -120,13 +189,21 @@ class _DBCon ():
         
     
     def __exit__ (self, exc_type, exc_val, exc_tb):
-        self._con.commit()
-        self._con.close()
-        self._lock.release()
+        try:
+            # A block is one transaction, a failed one is undone as a whole
+            if exc_type is None:
+                self._con.commit()
+            else:
+                self._con.rollback()
+        finally:
+            self._con.close()
+            self._lock.release()
         
         
 class Storage ():
     DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+    # Lease owners are written into SQL, so they are restricted to these
+    LEASE_OWNER_PATTERN = re.compile(r"[\w.:@-]{1,64}", re.A)
     TIME_FORMAT = "%H:%M:%S"
     
     FULLREQUEST_QUERY = """SELECT 
@@ -257,14 +334,179 @@ class Storage ():
     
     DOMAIN_POLICY_QUERY = """
     SELECT domainid, timeout, retries, retry_mindelay, retry_maxdelay,
-        retry_http, retry_proxies, bpslimit, proxy_default, proxy_regions
+        retry_http, retry_proxies, bpslimit, proxy_default, proxy_regions,
+        freshness, freshness_lifetime, nearduplicate_deprioritize,
+        pending_limit, cache_key_headers, strip_params,
+        collapse_trailing_slash, max_bytes, hedge_percentile,
+        retry_budget, max_streams, rpslimit, cache_ignore_headers
     FROM domain_policy
     """
     DOMAIN_POLICY_COLUMNS = ["DomainId", "Timeout", "Retries", "RetryMinDelay",
             "RetryMaxDelay", "RetryHTTP", "RetryProxies", "BPSLimit", "ProxyDefault",
-            "ProxyRegions"]
+            "ProxyRegions", "Freshness", "FreshnessLifetime",
+            "NearDuplicateDeprioritize", "PendingLimit", "CacheKeyHeaders",
+            "StripParams", "CollapseTrailingSlash", "MaxBytes", "HedgePercentile",
+            "RetryBudget", "MaxStreams", "RPSLimit", "CacheIgnoreHeaders"]
     DOMAIN_POLICY_INDEX = "DomainId"
 
+    # Latest accepted response of the same url and header, if the
+    # domain policy allows answering new requests from the cache.
+    FRESH_RESPONSE_QUERY = """SELECT resp.requestid, resp.requested,
+        resp.header, dp.freshness_lifetime
+    FROM request AS req
+    INNER JOIN response AS resp
+        ON req.requestid = resp.requestid
+    INNER JOIN accepted_status AS a_s
+        ON resp.requestid = a_s.requestid AND resp.statuscode = a_s.statuscode
+    INNER JOIN url
+        ON req.urlid = url.urlid
+    INNER JOIN domain_policy AS dp
+        ON url.domainid = dp.domainid
+    WHERE req.urlid = {:d} AND req.headerid = {:d} AND
+        dp.freshness = 1 AND resp.statuscode IN ({:s})
+    ORDER BY resp.requested DESC LIMIT 1"""
+
+    # Latest accepted fingerprint per url after (x) and up to (y)
+    # a given point in time.
+    LATEST_FINGERPRINT_QUERY = """SELECT rf.urlid, MAX(rf.responseid) "responseid"
+        FROM response_fingerprint AS rf
+        INNER JOIN accepted_status AS a_s
+            ON rf.requestid = a_s.requestid AND rf.statuscode = a_s.statuscode
+        WHERE rf.requested {:s} \"{:s}\"
+        GROUP BY rf.urlid"""
+
+    CHANGED_URLS_QUERY = """SELECT cur.urlid,
+        CONCAT(d.scheme, 
+            "://", d.netloc, 
+            url.path, 
+            IF(url.query != "", 
+                CONCAT("?", url.query), 
+                url.query)
+        ) "url",
+        cur.responseid, cur.requestid, cur.requested
+    FROM ({:s}) x
+    INNER JOIN response_fingerprint AS cur
+        ON x.responseid = cur.responseid
+    LEFT JOIN ({:s}) y
+        ON x.urlid = y.urlid
+    LEFT JOIN response_fingerprint AS prev
+        ON y.responseid = prev.responseid
+    INNER JOIN url
+        ON cur.urlid = url.urlid
+    INNER JOIN domain AS d
+        ON url.domainid = d.domainid
+    WHERE prev.fingerprint IS NULL OR prev.fingerprint != cur.fingerprint"""
+    CHANGED_URLS_COLUMNS = ["UrlId", "URL", "ResponseId", "RequestId", "Timestamp"]
+    CHANGED_URLS_INDEX = "UrlId"
+
+    URL_VERSIONS_COLUMNS = ["ResponseId", "RequestId", "Timestamp", "Fingerprint"]
+    URL_VERSIONS_INDEX = "ResponseId"
+
+    # Candidates share at least one band with the latest simhash of
+    # the given url, so all pages within a hamming distance of 3 are found.
+    NEAR_DUPLICATE_CLUSTER_QUERY = """SELECT other.urlid,
+        CONCAT(d.scheme, 
+            "://", d.netloc, 
+            url.path, 
+            IF(url.query != "", 
+                CONCAT("?", url.query), 
+                url.query)
+        ) "url",
+        MIN(BIT_COUNT(cur.simhash ^ other.simhash)) "distance"
+    FROM (SELECT * FROM response_simhash
+          WHERE urlid = {:d}
+          ORDER BY responseid DESC LIMIT 1) cur
+    INNER JOIN response_simhash AS other
+        ON other.domainid = cur.domainid AND (
+            other.band0 = cur.band0 OR other.band1 = cur.band1 OR
+            other.band2 = cur.band2 OR other.band3 = cur.band3)
+    INNER JOIN url
+        ON other.urlid = url.urlid
+    INNER JOIN domain AS d
+        ON url.domainid = d.domainid
+    WHERE BIT_COUNT(cur.simhash ^ other.simhash) <= {:d}
+    GROUP BY other.urlid, d.scheme, d.netloc, url.path, url.query"""
+    NEAR_DUPLICATE_CLUSTER_COLUMNS = ["UrlId", "URL", "Distance"]
+    NEAR_DUPLICATE_CLUSTER_INDEX = "UrlId"
+
+    # Paths of domains with the deprioritization policy whose
+    # recently fetched query variants were near-duplicates.
+    # Defaults of the near-duplicate lookups, shared by the SQL ranking
+    # of pending requests and the in-memory pending set
+    NEAR_DUPLICATE_DAYS = 7
+    NEAR_DUPLICATE_MAX_DISTANCE = 3
+    
+    NEAR_DUPLICATE_PATHS_QUERY = """SELECT DISTINCT a.domainid, url.path
+    FROM response_simhash AS a
+    INNER JOIN response_simhash AS b
+        ON a.domainid = b.domainid AND a.pathchecksum = b.pathchecksum
+            AND a.urlid != b.urlid
+    INNER JOIN domain_policy AS dp
+        ON a.domainid = dp.domainid
+    INNER JOIN url
+        ON a.urlid = url.urlid
+    WHERE dp.nearduplicate_deprioritize = 1
+        AND a.requested >= TIMESTAMPADD(DAY, -{:d}, UTC_TIMESTAMP())
+        AND b.requested >= TIMESTAMPADD(DAY, -{:d}, UTC_TIMESTAMP())
+        AND BIT_COUNT(a.simhash ^ b.simhash) <= {:d}"""
+    NEAR_DUPLICATE_PATHS_COLUMNS = ["DomainId", "Path"]
+
+    # Executable requests of a status, at most pending_limit per domain.
+    # Paths with near-duplicate query variants are ranked last, the
+    # accepted status codes are only aggregated for the kept rows.
+    LIMITED_REQUESTS_QUERY = """SELECT ranked.requestid, ranked.urlid,
+        ranked.domainid, ranked.headerid,
+        ranked.scheme, ranked.netloc,
+        ranked.path, ranked.query,
+        ranked.header, ranked.date,
+        ranked.url,
+        (SELECT GROUP_CONCAT(a_s.statuscode)
+         FROM accepted_status AS a_s
+         WHERE a_s.requestid = ranked.requestid) "accepted_status"
+    FROM (SELECT fr.*, dp.pending_limit,
+            ROW_NUMBER() OVER (
+                PARTITION BY fr.domainid
+                ORDER BY nd.path IS NOT NULL, fr.requestid
+            ) "domain_rank"
+        FROM request_status AS rs
+        INNER JOIN ({:s}) fr
+            ON rs.requestid = fr.requestid
+        INNER JOIN domain_policy AS dp
+            ON fr.domainid = dp.domainid
+        LEFT JOIN domain_retry AS dr
+            ON fr.domainid = dr.domainid AND fr.headerid = dr.headerid
+        LEFT JOIN request_lease AS rl
+            ON fr.requestid = rl.requestid
+        LEFT JOIN ({:s}) nd
+            ON fr.domainid = nd.domainid AND fr.path = nd.path
+        WHERE rs.status = {:d}
+            AND (dr.retry <= UTC_TIMESTAMP() OR dr.retry IS NULL)
+            AND (rl.expiry <= UTC_TIMESTAMP() OR rl.expiry IS NULL)
+    ) ranked
+    WHERE ranked.pending_limit IS NULL OR ranked.domain_rank <= ranked.pending_limit"""
+    ACCEPTED_STATUS_COLUMN = "AcceptedStatus"
+
+    # Full requests with their status and accepted status codes
+    STATUS_REQUESTS_QUERY = """SELECT fr.*, rs.status,
+        (SELECT GROUP_CONCAT(a_s.statuscode)
+         FROM accepted_status AS a_s
+         WHERE a_s.requestid = fr.requestid) "accepted_status"
+    FROM request_status AS rs
+    INNER JOIN ({:s}) fr
+        ON rs.requestid = fr.requestid
+    WHERE {:s}"""
+    STATUS_COLUMN = "Status"
+
+    # New requests and status changes, both are index range scans
+    REQUEST_STATUS_CHANGES_QUERY = """SELECT requestid, status, changed
+        FROM request_status
+        WHERE requestid > {:d}
+    UNION
+    SELECT requestid, status, changed
+        FROM request_status
+        WHERE changed >= \"{:s}\""""
+    REQUEST_STATUS_CHANGES_COLUMNS = ["RequestId", "Status", "Changed"]
+
     REQUESTSTATUS_QUERY = """SELECT requestid, requested, status
     FROM request_status"""
     REQUESTSTATUS_COLUMNS = ["RequestId", "Requested", "Status"]
@@ -272,16 +514,49 @@ class Storage ():
 
     URLPARSE_REVERT = "{:s}://{:s}{:s}{:s}"
     
-    def __init__ (self, host, user, passwd, db_name="webrequest"):
+    def __init__ (self, host, user, passwd, db_name="webrequest",
+                  delta_keyframe_interval=None, bloom_filter=False,
+                  bloom_snapshot_path=None, bloom_capacity=1000000,
+                  bloom_snapshot_interval=10000, url_canonicalizer=None):
         self._host = host
         self._user = user
         self._passwd = passwd
         self._db_name = db_name
         
+        # Every n-th version of a url is stored in full, the others
+        # as deltas against their predecessor. None disables deltas.
+        self._delta_keyframe_interval = delta_keyframe_interval
+        
+        # Bloom filters over known urls and request headers,
+        # definite misses skip the lookup queries on insert.
+        self._url_filter = None
+        self._header_filter = None
+        self._bloom_snapshot_path = bloom_snapshot_path
+        self._bloom_capacity = bloom_capacity
+        self._bloom_snapshot_interval = bloom_snapshot_interval
+        self._bloom_unsaved = 0
+        self._bloom_lock = Lock()
+        
+        # Canonicalizes urls before checksumming, None keeps them raw
+        self._url_canonicalizer = url_canonicalizer
+        
+        # (Scheme, Netloc) -> domain policy parts which shape the
+        # url and header keys of new requests
+        self._domain_key_policies = {}
+        self._domain_key_policies_loaded = None
+        self._domain_key_policies_ttl = 300
+        
+        # New requests attached to pending ones of the same url
+        # and header within the coalescing window
+        self._coalesced_requests = 0
+        
         self._con = None
                 
         self._initialize()
         
+        if bloom_filter:
+            self._initialize_bloom_filters()
+        
     def _create_database (self):
         self._con = _DBCon(self._host, self._user, self._passwd, None)
         
@@ -319,6 +594,30 @@ class Storage ():
             proxy_default TINYINT UNSIGNED DEFAULT 0,
             proxy_regions TEXT NULL,
 
+            freshness TINYINT UNSIGNED DEFAULT 1,
+            freshness_lifetime INT UNSIGNED DEFAULT NULL,
+
+            nearduplicate_deprioritize TINYINT UNSIGNED DEFAULT 0,
+
+            pending_limit SMALLINT UNSIGNED DEFAULT 50,
+
+            cache_key_headers TEXT NULL,
+
+            strip_params TEXT NULL,
+            collapse_trailing_slash TINYINT UNSIGNED DEFAULT 0,
+
+            max_bytes BIGINT UNSIGNED DEFAULT NULL,
+
+            hedge_percentile TINYINT UNSIGNED DEFAULT NULL,
+
+            retry_budget SMALLINT UNSIGNED DEFAULT NULL,
+
+            max_streams SMALLINT UNSIGNED DEFAULT NULL,
+
+            rpslimit FLOAT DEFAULT NULL,
+
+            cache_ignore_headers TEXT NULL,
+
             FOREIGN KEY (domainid)
                 REFERENCES domain(domainid)
                     ON DELETE CASCADE
@@ -326,6 +625,77 @@ class Storage ():
         );"""
         cur.execute(sql)
 
+    def _add_missing_column (self, cur, table, column, definition):
+        sql = """SELECT COUNT(*)
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND
+        table_name = \"{:s}\" AND
+        column_name = \"{:s}\";""".format(table, column)
+        cur.execute(sql)
+
+        if cur.fetchall()[0][0] == 0:
+            sql = "ALTER TABLE {:s} ADD COLUMN {:s} {:s};".format(
+                    table, column, definition
+                )
+            cur.execute(sql)
+
+    def _add_missing_index (self, cur, table, index, columns):
+        sql = """SELECT COUNT(*)
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND
+        table_name = \"{:s}\" AND
+        index_name = \"{:s}\";""".format(table, index)
+        cur.execute(sql)
+
+        if cur.fetchall()[0][0] == 0:
+            sql = "ALTER TABLE {:s} ADD INDEX {:s} ({:s});".format(
+                    table, index, ",".join(columns)
+                )
+            cur.execute(sql)
+
+    def _add_missing_foreign_key (self, cur, table, constraint, definition):
+        sql = """SELECT COUNT(*)
+        FROM information_schema.table_constraints
+        WHERE table_schema = DATABASE() AND
+        table_name = \"{:s}\" AND
+        constraint_name = \"{:s}\";""".format(table, constraint)
+        cur.execute(sql)
+
+        if cur.fetchall()[0][0] == 0:
+            sql = "ALTER TABLE {:s} ADD CONSTRAINT {:s} {:s};".format(
+                    table, constraint, definition
+                )
+            cur.execute(sql)
+
+    def _update_domain_policy_table (self, cur):
+        # Columns added after the initial table layout
+        self._add_missing_column(cur, "domain_policy", "freshness",
+                                 "TINYINT UNSIGNED DEFAULT 1")
+        self._add_missing_column(cur, "domain_policy", "freshness_lifetime",
+                                 "INT UNSIGNED DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "nearduplicate_deprioritize",
+                                 "TINYINT UNSIGNED DEFAULT 0")
+        self._add_missing_column(cur, "domain_policy", "pending_limit",
+                                 "SMALLINT UNSIGNED DEFAULT 50")
+        self._add_missing_column(cur, "domain_policy", "cache_key_headers",
+                                 "TEXT NULL")
+        self._add_missing_column(cur, "domain_policy", "strip_params",
+                                 "TEXT NULL")
+        self._add_missing_column(cur, "domain_policy", "collapse_trailing_slash",
+                                 "TINYINT UNSIGNED DEFAULT 0")
+        self._add_missing_column(cur, "domain_policy", "max_bytes",
+                                 "BIGINT UNSIGNED DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "hedge_percentile",
+                                 "TINYINT UNSIGNED DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "retry_budget",
+                                 "SMALLINT UNSIGNED DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "max_streams",
+                                 "SMALLINT UNSIGNED DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "rpslimit",
+                                 "FLOAT DEFAULT NULL")
+        self._add_missing_column(cur, "domain_policy", "cache_ignore_headers",
+                                 "TEXT NULL")
+
     def _create_url_table (self, cur):        
         sql = """CREATE TABLE IF NOT EXISTS url (
             urlid INTEGER UNSIGNED AUTO_INCREMENT,
@@ -408,6 +778,94 @@ class Storage ():
         );"""
         cur.execute(sql)
     
+    def _create_response_fingerprint_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS response_fingerprint (
+            responseid INTEGER UNSIGNED NOT NULL,
+            requestid INTEGER UNSIGNED NOT NULL,
+            urlid INTEGER UNSIGNED NOT NULL,
+            requested DATETIME NOT NULL,
+            statuscode SMALLINT UNSIGNED NOT NULL,
+            fingerprint BINARY(16) NOT NULL,
+            
+            PRIMARY KEY (responseid),
+            FOREIGN KEY (responseid)
+                REFERENCES response(responseid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            INDEX(urlid, requested),
+            INDEX(requested)
+        );"""
+        cur.execute(sql)
+    
+    def _create_response_simhash_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS response_simhash (
+            responseid INTEGER UNSIGNED NOT NULL,
+            urlid INTEGER UNSIGNED NOT NULL,
+            domainid INTEGER UNSIGNED NOT NULL,
+            pathchecksum BINARY(16) NOT NULL,
+            requested DATETIME NOT NULL,
+            simhash BIGINT UNSIGNED NOT NULL,
+            band0 SMALLINT UNSIGNED NOT NULL,
+            band1 SMALLINT UNSIGNED NOT NULL,
+            band2 SMALLINT UNSIGNED NOT NULL,
+            band3 SMALLINT UNSIGNED NOT NULL,
+            
+            PRIMARY KEY (responseid),
+            FOREIGN KEY (responseid)
+                REFERENCES response(responseid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            INDEX(urlid),
+            INDEX(domainid, pathchecksum, requested),
+            INDEX(domainid, band0),
+            INDEX(domainid, band1),
+            INDEX(domainid, band2),
+            INDEX(domainid, band3)
+        );"""
+        cur.execute(sql)
+    
+    def _create_response_delta_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS response_delta (
+            responseid INTEGER UNSIGNED NOT NULL,
+            baseid INTEGER UNSIGNED NOT NULL,
+            depth SMALLINT UNSIGNED NOT NULL,
+            
+            PRIMARY KEY (responseid),
+            FOREIGN KEY (responseid)
+                REFERENCES response(responseid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            CONSTRAINT response_delta_base FOREIGN KEY (baseid)
+                REFERENCES response(responseid)
+                    ON DELETE RESTRICT
+                    ON UPDATE CASCADE
+        );"""
+        cur.execute(sql)
+        
+    def _update_response_delta_table (self, cur):
+        # Deleting a delta base would break every chain built on it
+        self._add_missing_foreign_key(cur, "response_delta", "response_delta_base",
+                                      """FOREIGN KEY (baseid)
+                REFERENCES response(responseid)
+                    ON DELETE RESTRICT
+                    ON UPDATE CASCADE""")
+    
+    def _create_response_latest_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS response_latest (
+            urlid INTEGER UNSIGNED NOT NULL,
+            headerid INTEGER UNSIGNED NOT NULL,
+            responseid INTEGER UNSIGNED NOT NULL,
+            content LONGBLOB NOT NULL,
+            
+            PRIMARY KEY (urlid, headerid),
+            FOREIGN KEY (responseid)
+                REFERENCES response(responseid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            INDEX(responseid)
+        );"""
+        cur.execute(sql)
+    
     def _create_domain_timeout_table (self, cur):
         sql = """CREATE TABLE IF NOT EXISTS domain_timeout ( 
             domainid INTEGER UNSIGNED NOT NULL,
@@ -426,16 +884,26 @@ class Storage ():
             requestid INTEGER UNSIGNED NOT NULL,
             requested DATETIME NULL,
             status TINYINT UNSIGNED NOT NULL,
+            changed TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+                ON UPDATE CURRENT_TIMESTAMP(6),
             
             PRIMARY KEY (requestid),
             FOREIGN KEY (requestid)
                 REFERENCES request(requestid)
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
-            INDEX(status)
+            INDEX(status),
+            INDEX(changed)
         );"""
         cur.execute(sql)
         
+    def _update_request_status_table (self, cur):
+        # Change marker for the incremental pending set
+        self._add_missing_column(cur, "request_status", "changed",
+                                 "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) "
+                                 "ON UPDATE CURRENT_TIMESTAMP(6)")
+        self._add_missing_index(cur, "request_status", "changed", ["changed"])
+        
     def _create_domain_status_table (self, cur):
         sql = """CREATE TABLE IF NOT EXISTS domain_status (
             domainid INTEGER UNSIGNED,
@@ -455,6 +923,37 @@ class Storage ():
         );"""
         cur.execute(sql)
         
+    def _create_request_lease_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS request_lease (
+            requestid INTEGER UNSIGNED NOT NULL,
+            owner CHAR(64) NOT NULL,
+            expiry DATETIME NOT NULL,
+            
+            PRIMARY KEY (requestid),
+            FOREIGN KEY (requestid)
+                REFERENCES request(requestid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            INDEX(owner),
+            INDEX(expiry)
+        );"""
+        cur.execute(sql)
+        
+    def _create_provisional_request_table (self, cur):
+        sql = """CREATE TABLE IF NOT EXISTS provisional_request (
+            token CHAR(40) NOT NULL,
+            requestid INTEGER UNSIGNED NOT NULL,
+            created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            
+            PRIMARY KEY (token),
+            FOREIGN KEY (requestid)
+                REFERENCES request(requestid)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+            INDEX(created)
+        );"""
+        cur.execute(sql)
+        
     def _create_domain_retry_table (self, cur):
         sql = """CREATE TABLE IF NOT EXISTS domain_retry (
             domainid INTEGER UNSIGNED,
@@ -601,16 +1100,25 @@ class Storage ():
         with self._con as cur:
             self._create_domain_table(cur)
             self._create_domain_policy_table(cur)
+            self._update_domain_policy_table(cur)
             self._create_url_table(cur)
             
             self._create_request_header_table(cur)
             self._create_request_table(cur)
             self._create_request_status_table(cur)
+            self._update_request_status_table(cur)
             self._create_response_table(cur)
             self._create_accepted_status_codes_table(cur)
+            self._create_response_fingerprint_table(cur)
+            self._create_response_simhash_table(cur)
+            self._create_response_delta_table(cur)
+            self._update_response_delta_table(cur)
+            self._create_response_latest_table(cur)
             self._create_domain_timeout_table(cur)
             self._create_domain_status_table(cur)
             self._create_domain_retry_table(cur)
+            self._create_request_lease_table(cur)
+            self._create_provisional_request_table(cur)
             
             self._create_full_request_view(cur)
             
@@ -621,6 +1129,146 @@ class Storage ():
             self._create_request_status_update_trigger(cur)
             self._create_domain_status_update_trigger(cur)
         
+    @classmethod
+    def _get_url_filter_key (cls, url):
+        key = "{:s}://{:s}".format(url.urlparsed.scheme, url.urlparsed.netloc)
+        return key.encode("utf-8") + url.path_checksum + url.query_checksum
+    
+    def _load_bloom_filters (self):
+        '''
+        Loads the filters of the last snapshot. Returns None
+        if there is no usable snapshot.
+        '''
+        path = self._bloom_snapshot_path
+        
+        if path is None or not os.path.exists(path):
+            return None
+        
+        try:
+            filters, extra = BloomFilter.load_snapshot(path)
+            url_filter = filters["url"]
+            header_filter = filters["header"]
+            last_ids = (extra["LastUrlId"], extra["LastHeaderId"])
+        except Exception as e:
+            print("Bloom filter snapshot {:s} is not usable: {:s}".format(path, str(e)))
+            return None
+        
+        if url_filter.is_saturated() or header_filter.is_saturated():
+            return None
+        
+        return url_filter, header_filter, last_ids
+    
+    def _initialize_bloom_filters (self):
+        '''
+        Loads the snapshot and adds all rows inserted since then,
+        or rebuilds both filters from the database.
+        '''
+        loaded = self._load_bloom_filters()
+        
+        with self._con as cur:
+            if loaded is not None:
+                url_filter, header_filter, (last_url_id, last_header_id) = loaded
+            else:
+                cur.execute("SELECT COUNT(*) FROM url;")
+                url_count = cur.fetchall()[0][0]
+                cur.execute("SELECT COUNT(*) FROM request_header;")
+                header_count = cur.fetchall()[0][0]
+                
+                url_filter = BloomFilter(max(self._bloom_capacity, 2 * url_count))
+                header_filter = BloomFilter(max(self._bloom_capacity // 10, 2 * header_count))
+                last_url_id = 0
+                last_header_id = 0
+                
+            sql = """SELECT url.urlid, d.scheme, d.netloc,
+                url.pathchecksum, url.querychecksum
+            FROM url
+            INNER JOIN domain AS d
+                ON url.domainid = d.domainid
+            WHERE url.urlid > {:d}
+            ORDER BY url.urlid;""".format(last_url_id)
+            cur.execute(sql)
+            
+            while True:
+                rows = cur.fetchmany(100000)
+                
+                if len(rows) == 0:
+                    break
+                
+                for url_id, scheme, netloc, path_checksum, query_checksum in rows:
+                    key = "{:s}://{:s}".format(scheme, netloc).encode("utf-8")
+                    url_filter.add(key + bytes(path_checksum) + bytes(query_checksum))
+                    last_url_id = url_id
+            
+            sql = """SELECT headerid, headerchecksum
+            FROM request_header
+            WHERE headerid > {:d}
+            ORDER BY headerid;""".format(last_header_id)
+            cur.execute(sql)
+            
+            while True:
+                rows = cur.fetchmany(100000)
+                
+                if len(rows) == 0:
+                    break
+                
+                for header_id, header_checksum in rows:
+                    header_filter.add(bytes(header_checksum))
+                    last_header_id = header_id
+        
+        self._url_filter = url_filter
+        self._header_filter = header_filter
+        
+        self.save_bloom_filters()
+        
+    def save_bloom_filters (self):
+        '''
+        Saves the filters with the highest url and header ids, a
+        restart adds the rows after them. Rows up to those ids which
+        are missing from the filters (inserted by other processes)
+        end up as definite misses, whose inserts fail and are
+        caught by the integrity error paths.
+        '''
+        if self._bloom_snapshot_path is None or self._url_filter is None:
+            return
+        
+        with self._bloom_lock:
+            with self._con as cur:
+                cur.execute("SELECT (SELECT MAX(urlid) FROM url), (SELECT MAX(headerid) FROM request_header);")
+                last_url_id, last_header_id = cur.fetchall()[0]
+            
+            extra = {
+                    "LastUrlId" : int(last_url_id or 0),
+                    "LastHeaderId" : int(last_header_id or 0)
+                }
+            filters = {
+                    "url" : self._url_filter,
+                    "header" : self._header_filter
+                }
+            BloomFilter.save_snapshot(self._bloom_snapshot_path, filters, extra)
+            self._bloom_unsaved = 0
+        
+    def _add_to_bloom_filter (self, bloom_filter, key):
+        if bloom_filter is None:
+            return
+        
+        bloom_filter.add(key)
+        
+        with self._bloom_lock:
+            self._bloom_unsaved += 1
+            save = self._bloom_unsaved >= self._bloom_snapshot_interval
+        
+        if save:
+            self.save_bloom_filters()
+    
+    def get_bloom_filter_metrics (self):
+        if self._url_filter is None:
+            return None
+        
+        return {
+                "URL" : self._url_filter.get_metrics(),
+                "Header" : self._header_filter.get_metrics()
+            }
+        
     def get_last_insert_id (self, cur=None):
         if cur is None:
             with self._con as cur:
@@ -727,7 +1375,14 @@ class Storage ():
                                     retry_mindelay=None, retry_maxdelay=None,
                                     retry_http=None, retry_proxies=None,
                                     bps_limit=None, proxy_default=None,
-                                    proxy_regions=None):
+                                    proxy_regions=None, freshness=None,
+                                    freshness_lifetime=None,
+                                    nearduplicate_deprioritize=None,
+                                    pending_limit=None, cache_key_headers=None,
+                                    strip_params=None, collapse_trailing_slash=None,
+                                    max_bytes=None, hedge_percentile=None,
+                                    retry_budget=None, max_streams=None,
+                                    rps_limit=None, cache_ignore_headers=None):
         sql = """INSERT INTO domain_policy {:s} 
                 VALUES {:s}  {:s};"""
 
@@ -772,6 +1427,72 @@ class Storage ():
             column_list.append("proxy_regions")
             value_list.append(f"\"{proxy_regions}\"")
 
+        if freshness is not None:
+            column_list.append("freshness")
+            value_list.append(bool_to_str(freshness))
+
+        if freshness_lifetime is not None:
+            freshness_lifetime = "NULL" if freshness_lifetime < 0 else str(int(freshness_lifetime))
+            column_list.append("freshness_lifetime")
+            value_list.append(freshness_lifetime)
+
+        if nearduplicate_deprioritize is not None:
+            column_list.append("nearduplicate_deprioritize")
+            value_list.append(bool_to_str(nearduplicate_deprioritize))
+
+        if pending_limit is not None:
+            pending_limit = "NULL" if pending_limit < 0 else str(int(pending_limit))
+            column_list.append("pending_limit")
+            value_list.append(pending_limit)
+
+        if cache_key_headers is not None:
+            cache_key_headers = ",".join(sorted(x.strip().lower() for x in cache_key_headers))
+            column_list.append("cache_key_headers")
+            value_list.append(f"\"{cache_key_headers}\"")
+
+        if strip_params is not None:
+            strip_params = ",".join(sorted(x.strip().lower() for x in strip_params))
+            column_list.append("strip_params")
+            value_list.append(f"\"{strip_params}\"")
+
+        if collapse_trailing_slash is not None:
+            column_list.append("collapse_trailing_slash")
+            value_list.append(bool_to_str(collapse_trailing_slash))
+
+        if max_bytes is not None:
+            max_bytes = "NULL" if max_bytes < 0 else str(int(max_bytes))
+            column_list.append("max_bytes")
+            value_list.append(max_bytes)
+
+        if hedge_percentile is not None:
+            if hedge_percentile == 0 or hedge_percentile > 100:
+                raise ValueError("The hedge percentile has to be within (0, 100], "
+                                 "got {:s}.".format(str(hedge_percentile)))
+            
+            hedge_percentile = "NULL" if hedge_percentile < 0 else str(int(hedge_percentile))
+            column_list.append("hedge_percentile")
+            value_list.append(hedge_percentile)
+
+        if retry_budget is not None:
+            retry_budget = "NULL" if retry_budget < 0 else str(int(retry_budget))
+            column_list.append("retry_budget")
+            value_list.append(retry_budget)
+
+        if max_streams is not None:
+            max_streams = "NULL" if max_streams < 0 else str(int(max_streams))
+            column_list.append("max_streams")
+            value_list.append(max_streams)
+
+        if rps_limit is not None:
+            rps_limit = "NULL" if rps_limit < 0 else str(float(rps_limit))
+            column_list.append("rpslimit")
+            value_list.append(rps_limit)
+
+        if cache_ignore_headers is not None:
+            cache_ignore_headers = ",".join(sorted(x.strip().lower() for x in cache_ignore_headers))
+            column_list.append("cache_ignore_headers")
+            value_list.append(f"\"{cache_ignore_headers}\"")
+
         value_list = "({:s})".format(",".join(value_list))
 
         if len(column_list) > 1:
@@ -787,6 +1508,159 @@ class Storage ():
         with self._con as cur:
             cur.execute(sql)
     
+    @classmethod
+    def _split_list_column (cls, value):
+        if value is None or value == "":
+            return frozenset()
+        
+        return frozenset(value.split(","))
+    
+    @classmethod
+    def _get_default_key_policy (cls):
+        return {
+                "CacheKeyHeaders" : frozenset(),
+                "CacheIgnoreHeaders" : frozenset(),
+                "StripParams" : frozenset(),
+                "CollapseTrailingSlash" : False
+            }
+    
+    def _load_domain_key_policies (self):
+        sql = """SELECT d.scheme, d.netloc, dp.cache_key_headers,
+            dp.cache_ignore_headers, dp.strip_params, dp.collapse_trailing_slash
+        FROM domain_policy AS dp
+        INNER JOIN domain AS d
+            ON dp.domainid = d.domainid
+        WHERE (dp.cache_key_headers IS NOT NULL AND dp.cache_key_headers != "")
+            OR (dp.cache_ignore_headers IS NOT NULL AND dp.cache_ignore_headers != "")
+            OR (dp.strip_params IS NOT NULL AND dp.strip_params != "")
+            OR dp.collapse_trailing_slash = 1;"""
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        self._domain_key_policies = {
+                (scheme, netloc) : {
+                        "CacheKeyHeaders" : Storage._split_list_column(headers),
+                        "CacheIgnoreHeaders" : Storage._split_list_column(ignored),
+                        "StripParams" : Storage._split_list_column(params),
+                        "CollapseTrailingSlash" : bool(collapse)
+                    }
+                for scheme, netloc, headers, ignored, params, collapse in rows
+            }
+        self._domain_key_policies_loaded = time.monotonic()
+        
+    def get_domain_key_policy (self, url):
+        '''
+        Returns the cache key and ignored headers, the url parameters to
+        strip and whether to collapse trailing slashes for the url's domain.
+        Policies are cached for a few minutes.
+        '''
+        if (self._domain_key_policies_loaded is None or
+            time.monotonic() - self._domain_key_policies_loaded > self._domain_key_policies_ttl):
+            self._load_domain_key_policies()
+            
+        key = (url.urlparsed.scheme, url.urlparsed.netloc)
+        return self._domain_key_policies.get(key, Storage._get_default_key_policy())
+    
+    def get_cache_key_headers (self, url):
+        '''
+        Returns the normally ignored request headers which
+        belong to the cache key of the url's domain.
+        '''
+        return self.get_domain_key_policy(url)["CacheKeyHeaders"]
+    
+    def canonicalize_url (self, url, canonicalizer=None):
+        '''
+        Returns the canonical URL of the given one, including
+        the strip list and trailing slash policy of its domain.
+        '''
+        if canonicalizer is None:
+            canonicalizer = self._url_canonicalizer
+            
+        if canonicalizer is None:
+            return url
+        
+        # Domain policies are keyed by the canonical scheme and host
+        url = URL.of_string(canonicalizer.canonicalize(url.to_string()))
+        policy = self.get_domain_key_policy(url)
+        
+        if len(policy["StripParams"]) != 0 or policy["CollapseTrailingSlash"]:
+            url = URL.of_string(canonicalizer.canonicalize(
+                    url.to_string(),
+                    strip_params=policy["StripParams"],
+                    collapse_trailing_slash=policy["CollapseTrailingSlash"] or None
+                ))
+        
+        return url
+        
+    def _apply_key_policies (self, request):
+        url = self.canonicalize_url(request.url)
+        policy = self.get_domain_key_policy(url)
+        key_headers = policy["CacheKeyHeaders"]
+        ignore_headers = policy["CacheIgnoreHeaders"]
+        
+        if url is request.url and len(key_headers) == 0 and len(ignore_headers) == 0:
+            return request
+        
+        request_header = request.request_header
+        
+        if len(key_headers) != 0 or len(ignore_headers) != 0:
+            request_header = RequestHeader.of_dict(request_header.header_dict,
+                                                   key_headers, ignore_headers)
+            
+        return Request(url, request_header, request.timestamp,
+                       request.accepted_status)
+    
+    def _learn_cache_key_headers (self, cur, request_id, vary):
+        '''
+        Adds normally or by the domain ignored request headers named
+        in a Vary response header to the cache key of the request's domain.
+        '''
+        # Headers some domain leaves out, the query checks which one
+        ignorable = RequestHeader.IGNORED_KEY_HEADERS.union(*(
+                x["CacheIgnoreHeaders"] for x in self._domain_key_policies.values()
+            ))
+        vary = set(vary) & ignorable
+        
+        if len(vary) == 0:
+            return
+        
+        sql = """SELECT d.domainid, d.scheme, d.netloc, dp.cache_key_headers,
+            dp.cache_ignore_headers
+        FROM request AS req
+        INNER JOIN url
+            ON req.urlid = url.urlid
+        INNER JOIN domain AS d
+            ON url.domainid = d.domainid
+        INNER JOIN domain_policy AS dp
+            ON d.domainid = dp.domainid
+        WHERE req.requestid = {:d};""".format(request_id)
+        cur.execute(sql)
+        rows = cur.fetchall()
+        
+        if len(rows) == 0:
+            return
+        
+        domain_id, scheme, netloc, known, ignored = rows[0]
+        known = set(Storage._split_list_column(known))
+        vary &= RequestHeader.IGNORED_KEY_HEADERS | Storage._split_list_column(ignored)
+        
+        if vary <= known:
+            return
+        
+        known = ",".join(sorted(known | vary))
+        
+        sql = "UPDATE domain_policy SET cache_key_headers = \"{:s}\" WHERE domainid = {:d};".format(
+                known, domain_id
+            )
+        cur.execute(sql)
+        
+        policy = dict(self._domain_key_policies.get((scheme, netloc),
+                                                    Storage._get_default_key_policy()))
+        policy["CacheKeyHeaders"] = frozenset(known.split(","))
+        self._domain_key_policies[(scheme, netloc)] = policy
+        
     def get_domain_policy (self):
         sql = "{:s};".format(Storage.DOMAIN_POLICY_QUERY)
 
@@ -808,6 +1682,7 @@ class Storage ():
         fmt = "({:d},X\'{:s}\',X\'{:s}\',\"{:s}\",\"{:s}\")" 
         
         if isinstance(url, URL):
+            filter_key = Storage._get_url_filter_key(url)
             url = fmt.format(
                         domain_id,
                         url.path_checksum.hex(),
@@ -822,6 +1697,8 @@ class Storage ():
                 cur.execute(sql)
                 
                 last_id = self.get_last_insert_id(cur)
+                
+            self._add_to_bloom_filter(self._url_filter, filter_key)
         else:
             last_id = []
             
@@ -865,13 +1742,42 @@ class Storage ():
                 ])
             return ids
         
+    def _insert_single_url (self, url):
+        '''
+        Returns the id of the url and whether it was newly inserted.
+        '''
+        if self._url_filter is not None:
+            key = Storage._get_url_filter_key(url)
+            
+            # Definite miss, no lookup necessary
+            if not self._url_filter.might_contain(key):
+                domain_id = self.insert_domain(url)
+                
+                try:
+                    return self.direct_insert_url(domain_id, url), True
+                except mysql.connector.errors.IntegrityError:
+                    # Inserted by another process after the filter was built
+                    self._url_filter.add(key)
+                    return self.get_url_id(url), False
+        
+        domain_id = self.insert_domain(url)
+        existing_id = self.get_url_id(url)
+        
+        if existing_id is None:
+            if self._url_filter is not None:
+                self._url_filter.record_false_positive()
+                
+            return self.direct_insert_url(domain_id, url), True
+        else:
+            return existing_id, False
+    
     def insert_url (self, url):
         multi = not isinstance(url, URL)
         
-        domain_ids = self.insert_domain(url)        
-        existing_ids = self.get_url_id(url)
-        
         if multi:
+            domain_ids = self.insert_domain(url)        
+            existing_ids = self.get_url_id(url)
+            
             count = len(url)
             
             addables = []            
@@ -895,10 +1801,8 @@ class Storage ():
             url_ids[unset_indices] = new_url_ids
             return url_ids
         else:
-            if existing_ids is None:
-                return self.direct_insert_url(domain_ids, url)
-            else:
-                return existing_ids
+            url_id, _ = self._insert_single_url(url)
+            return url_id
             
     def direct_insert_request_header (self, request_header):
         '''
@@ -924,6 +1828,9 @@ class Storage ():
             with self._con as cur:
                 cur.execute(sql)
                 last_id = self.get_last_insert_id(cur)
+                
+            self._add_to_bloom_filter(self._header_filter,
+                                      request_header.header_checksum)
         else:
             last_id = []
             
@@ -956,12 +1863,39 @@ class Storage ():
                 ])
             return ids
         
+    def _insert_single_request_header (self, request_header):
+        '''
+        Returns the id of the request header and whether
+        it was newly inserted.
+        '''
+        if self._header_filter is not None:
+            key = request_header.header_checksum
+            
+            # Definite miss, no lookup necessary
+            if not self._header_filter.might_contain(key):
+                try:
+                    return self.direct_insert_request_header(request_header), True
+                except mysql.connector.errors.IntegrityError:
+                    # Inserted by another process after the filter was built
+                    self._header_filter.add(key)
+                    return self.get_request_header_id(request_header), False
+        
+        existing_id = self.get_request_header_id(request_header)
+        
+        if existing_id is None:
+            if self._header_filter is not None:
+                self._header_filter.record_false_positive()
+                
+            return self.direct_insert_request_header(request_header), True
+        else:
+            return existing_id, False
+        
     def insert_request_header (self, request_header):
         multi = not isinstance(request_header, RequestHeader)
-             
-        existing_ids = self.get_request_header_id(request_header)
         
         if multi:
+            existing_ids = self.get_request_header_id(request_header)
+            
             count = len(request_header)
             
             addables = []            
@@ -985,10 +1919,8 @@ class Storage ():
             reqheader_ids[unset_indices] = new_reqheader_ids
             return reqheader_ids
         else:
-            if existing_ids is None:
-                return self.direct_insert_request_header(request_header)
-            else:
-                return existing_ids
+            header_id, _ = self._insert_single_request_header(request_header)
+            return header_id
             
     def direct_insert_accepted_status (self, request_id, status_code):
         sql = "INSERT IGNORE INTO accepted_status (requestid, statuscode) VALUES {:s};"
@@ -1103,26 +2035,145 @@ class Storage ():
                     for ui, hi in zip(url_id, header_id)
                 ])
             
-    def insert_request (self, request, min_date=None, max_date=None):
-        multi = not isinstance(request, Request)
-             
-        if multi:
-            ids = [
-                    self.insert_request(x)
-                    for x in request
-                ]
+    @classmethod
+    def _get_status_code_key (cls, status_codes):
+        '''
+        The accepted status codes as GROUP_CONCAT lists them in order.
+        '''
+        if isinstance(status_codes, (int, np.integer)):
+            status_codes = [status_codes]
+            
+        return ",".join(str(x) for x in sorted(set(int(y) for y in status_codes)))
+    
+    def get_pending_request_id (self, url_id, header_id, accepted_status,
+                                min_timestamp, max_timestamp):
+        '''
+        Returns the id of the latest request of the url and header
+        with exactly the given accepted status codes dated within
+        the given bounds which has no response yet, be it pending or
+        in flight. Returns None if there is no such request.
+        '''
+        sql = """SELECT r.requestid FROM request AS r
+        INNER JOIN request_status AS rs
+            ON r.requestid = rs.requestid
+        WHERE r.urlid = {:d} AND r.headerid = {:d}
+            AND r.date >= \"{:s}\" AND r.date <= \"{:s}\"
+            AND rs.status = 0
+            AND (SELECT GROUP_CONCAT(a_s.statuscode ORDER BY a_s.statuscode)
+                 FROM accepted_status AS a_s
+                 WHERE a_s.requestid = r.requestid) = \"{:s}\"
+        ORDER BY r.date DESC LIMIT 1;""".format(
+                url_id, header_id,
+                min_timestamp.strftime(Storage.DATETIME_FORMAT),
+                max_timestamp.strftime(Storage.DATETIME_FORMAT),
+                self._get_status_code_key(accepted_status)
+            )
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        if len(rows) == 0:
+            return None
+        
+        return rows[0][0]
+    
+    def get_coalesced_request_count (self):
+        return self._coalesced_requests
+            
+    def get_fresh_request_id (self, url_id, header_id, accepted_status,
+                              utc_now=None):
+        '''
+        Returns the id of a request whose latest accepted response
+        is still fresh according to its caching headers or the
+        domain policy. Returns None if there is no such request.
+        '''
+        if not isinstance(accepted_status, (list, set, tuple, np.ndarray)):
+            accepted_status = [accepted_status]
+
+        if utc_now is None:
+            utc_now = dt.datetime.utcnow()
+
+        sql = "{:s};".format(Storage.FRESH_RESPONSE_QUERY.format(
+                url_id, header_id,
+                ",".join(str(int(x)) for x in accepted_status)
+            ))
+
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+
+        if len(rows) == 0:
+            return None
+
+        request_id, requested, header, lifetime_override = rows[0]
+        freshness = ResponseFreshness.of_stored_response(requested, header)
+
+        if freshness.is_fresh(utc_now, lifetime_override):
+            return request_id
+        else:
+            return None
+
+    def insert_request (self, request, min_date=None, max_date=None,
+                        freshness=False, coalesce_window=None):
+        '''
+        Returns the id of the request. With freshness, a request whose
+        cached response is still fresh is returned instead, unless a
+        date window is given, which only requests within it answer.
+        With a coalescing window, a request for the url and header
+        with the same accepted status codes which is still pending and
+        dated within the window around the new one is returned instead
+        of inserting another one.
+        '''
+        multi = not isinstance(request, Request)
+             
+        if multi:
+            ids = [
+                    self.insert_request(x, freshness=freshness,
+                                        coalesce_window=coalesce_window)
+                    for x in request
+                ]
             
             return ids
         else:
-            url_id = self.insert_url(request.url)
-            header_id = self.insert_request_header(request.request_header)
+            request = self._apply_key_policies(request)
+            
+            url_id, url_new = self._insert_single_url(request.url)
+            header_id, header_new = self._insert_single_request_header(request.request_header)
+            
+            # A new url or header cannot have any requests yet
+            known = not (url_new or header_new)
             
-            if min_date is not None or max_date is not None:
+            windowed = min_date is not None or max_date is not None
+            
+            if not known:
+                existing_id = None
+            elif windowed:
                 existing_id = self.get_request_id(url_id, header_id, 
                                                   min_timestamp=min_date, max_timestamp=max_date)                
             else:
                 existing_id = self.get_request_id(url_id, header_id, request.timestamp)
             
+            # A cached response from outside the window is not asked for
+            if existing_id is None and freshness and known and not windowed:
+                fresh_id = self.get_fresh_request_id(url_id, header_id,
+                                                     request.accepted_status)
+
+                # Answered from the cache, no new request is necessary.
+                if fresh_id is not None:
+                    return fresh_id
+                
+            if existing_id is None and coalesce_window is not None and known:
+                pending_id = self.get_pending_request_id(url_id, header_id,
+                                                         request.accepted_status,
+                                                         request.timestamp - coalesce_window,
+                                                         request.timestamp + coalesce_window)
+                
+                # Fetched once, for all of its callers
+                if pending_id is not None:
+                    self._coalesced_requests += 1
+                    return pending_id
+
             if existing_id is None:
                 existing_id = self.direct_insert_request(url_id, header_id, request.timestamp)
             else:
@@ -1132,32 +2183,388 @@ class Storage ():
                 
             return existing_id
         
-    def direct_insert_response (self, request_id, response):
-        if isinstance(response, Response):
-            content = response.content
+    def bulk_insert_requests (self, requests, tokens=None, chunk_size=1000,
+                              coalesce_window=None):
+        '''
+        Inserts many requests with few multi-row statements, one
+        transaction per chunk. Requests with equal url, header and
+        date are merged, with a coalescing window so are those dated
+        within the window of a pending one. If provisional tokens are
+        given, they are mapped to the request ids within the same
+        transaction. A failing chunk is rolled back as a whole, the
+        chunks before it stay committed and are merged on a retry.
+        Returns the request ids in the order of the given requests.
+        '''
+        request_ids = []
+        
+        for start in range(0, len(requests), chunk_size):
+            chunk_tokens = None
             
-            if content is None:
-                content = "NULL"
-            else:
-                content = "X'{:s}'".format(content.hex())
+            if tokens is not None:
+                chunk_tokens = tokens[start:start+chunk_size]
             
-            sql = """INSERT INTO response 
-            (requestid, requested, statuscode, header, content) 
-            VALUES {:s};"""
-            fmt = "({:d}, \"{:s}\", {:d}, \"{:s}\", {:s})"
+            request_ids.extend(self._bulk_insert_request_chunk(
+                    requests[start:start+chunk_size], chunk_tokens,
+                    coalesce_window
+                ))
             
-            fmt = fmt.format(
-                    request_id,
-                    response.timestamp.strftime(Storage.DATETIME_FORMAT),
-                    response.status_code,
-                    response.headers,
-                    content
+        return request_ids
+    
+    def _coalesce_request_keys (self, cur, keys, timestamps, accepted_status,
+                                coalesce_window):
+        '''
+        Attaches the requests of a chunk to pending requests of their
+        url, header and accepted status codes dated within the
+        coalescing window, stored ones or earlier ones of the chunk.
+        Returns the keys to insert, None for requests attached to
+        stored ones, and a dict of the positions of those to the
+        stored request ids.
+        '''
+        pairs = sorted(set(x[:2] for x in keys))
+        status_keys = [self._get_status_code_key(x) for x in accepted_status]
+        
+        sql = """SELECT r.requestid, r.urlid, r.headerid, r.date,
+            (SELECT GROUP_CONCAT(a_s.statuscode ORDER BY a_s.statuscode)
+             FROM accepted_status AS a_s
+             WHERE a_s.requestid = r.requestid)
+        FROM request AS r
+        INNER JOIN request_status AS rs
+            ON r.requestid = rs.requestid
+        WHERE (r.urlid, r.headerid) IN ({:s})
+            AND r.date >= \"{:s}\" AND r.date <= \"{:s}\"
+            AND rs.status = 0;""".format(
+                ",".join("({:d},{:d})".format(*x) for x in pairs),
+                (min(timestamps) - coalesce_window).strftime(Storage.DATETIME_FORMAT),
+                (max(timestamps) + coalesce_window).strftime(Storage.DATETIME_FORMAT)
+            )
+        cur.execute(sql)
+        
+        # (UrlId, HeaderId, AcceptedStatus) -> [(Date, stored request id or key of the chunk)]
+        pending = {}
+        
+        for request_id, url_id, header_id, date, status_codes in cur.fetchall():
+            status_key = self._get_status_code_key(self._split_status_codes(status_codes))
+            pending.setdefault((url_id, header_id, status_key), []).append((date, request_id))
+            
+        coalesced_keys = []
+        stored_ids = {}
+        
+        for i, (key, timestamp) in enumerate(zip(keys, timestamps)):
+            candidates = pending.setdefault(key[:2] + (status_keys[i],), [])
+            target = next((
+                    x for date, x in candidates
+                    if abs(date - timestamp) <= coalesce_window
+                ), None)
+            
+            if target is None:
+                candidates.append((timestamp, key))
+                coalesced_keys.append(key)
+            elif isinstance(target, tuple):
+                if target != key:
+                    self._coalesced_requests += 1
+                    
+                coalesced_keys.append(target)
+            else:
+                self._coalesced_requests += 1
+                stored_ids[i] = target
+                coalesced_keys.append(None)
+                
+        return coalesced_keys, stored_ids
+    
+    def _bulk_insert_request_chunk (self, requests, tokens, coalesce_window=None):
+        requests = [self._apply_key_policies(x) for x in requests]
+        
+        domains = sorted(set(
+                (x.url.urlparsed.scheme, x.url.urlparsed.netloc)
+                for x in requests
+            ))
+        headers = {
+                x.request_header.header_checksum : x.request_header
+                for x in requests
+            }
+        
+        with self._con as cur:
+            # Domains
+            sql = "INSERT IGNORE INTO domain (scheme, netloc) VALUES {:s};".format(
+                    ",".join("(\"{:s}\",\"{:s}\")".format(*x) for x in domains)
                 )
-            sql = sql.format(fmt)
+            cur.execute(sql)
+            
+            sql = """SELECT domainid, scheme, netloc FROM domain
+            WHERE (scheme, netloc) IN ({:s});""".format(
+                    ",".join("(\"{:s}\",\"{:s}\")".format(*x) for x in domains)
+                )
+            cur.execute(sql)
+            domain_ids = {
+                    (scheme, netloc) : domain_id
+                    for domain_id, scheme, netloc in cur.fetchall()
+                }
+            
+            # Urls
+            urls = {}
+            
+            for x in requests:
+                parsed = x.url.urlparsed
+                key = (domain_ids[(parsed.scheme, parsed.netloc)],
+                       x.url.path_checksum, x.url.query_checksum)
+                urls[key] = x.url
+                
+            sql = """INSERT IGNORE INTO url (domainid, pathchecksum, querychecksum, path, query)
+            VALUES {:s};""".format(",".join(
+                    "({:d},X\'{:s}\',X\'{:s}\',\"{:s}\",\"{:s}\")".format(
+                            key[0], key[1].hex(), key[2].hex(),
+                            url.urlparsed.path, url.urlparsed.query
+                        )
+                    for key, url in urls.items()
+                ))
+            cur.execute(sql)
+            
+            sql = """SELECT urlid, domainid, pathchecksum, querychecksum FROM url
+            WHERE (domainid, pathchecksum, querychecksum) IN ({:s});""".format(",".join(
+                    "({:d},X'{:s}',X'{:s}')".format(key[0], key[1].hex(), key[2].hex())
+                    for key in urls
+                ))
+            cur.execute(sql)
+            url_ids = {
+                    (domain_id, bytes(pathcs), bytes(querycs)) : url_id
+                    for url_id, domain_id, pathcs, querycs in cur.fetchall()
+                }
+            
+            # Request headers
+            sql = """INSERT IGNORE INTO request_header (headerchecksum, header)
+            VALUES {:s};""".format(",".join(
+                    "(X\'{:s}\',\"{:s}\")".format(
+                            checksum.hex(),
+                            header.stringed_header_dict.replace("\"", "\\\"")
+                        )
+                    for checksum, header in headers.items()
+                ))
+            cur.execute(sql)
+            
+            sql = """SELECT headerid, headerchecksum FROM request_header
+            WHERE headerchecksum IN ({:s});""".format(",".join(
+                    "X'{:s}'".format(checksum.hex())
+                    for checksum in headers
+                ))
+            cur.execute(sql)
+            header_ids = {
+                    bytes(checksum) : header_id
+                    for header_id, checksum in cur.fetchall()
+                }
+            
+            # Requests
+            keys = []
+            
+            for x in requests:
+                parsed = x.url.urlparsed
+                url_id = url_ids[(domain_ids[(parsed.scheme, parsed.netloc)],
+                                  x.url.path_checksum, x.url.query_checksum)]
+                header_id = header_ids[x.request_header.header_checksum]
+                keys.append((url_id, header_id,
+                             x.timestamp.strftime(Storage.DATETIME_FORMAT)))
+                
+            stored_ids = {}
+            
+            if coalesce_window is not None:
+                keys, stored_ids = self._coalesce_request_keys(
+                        cur, keys, [x.timestamp for x in requests],
+                        [x.accepted_status for x in requests], coalesce_window
+                    )
+                
+            unique_keys = sorted(set(x for x in keys if x is not None))
+            request_ids = {}
+            
+            if len(unique_keys) != 0:
+                values = ",".join("({:d},{:d},\"{:s}\")".format(*x) for x in unique_keys)
+                
+                sql = "INSERT IGNORE INTO request (urlid, headerid, date) VALUES {:s};".format(values)
+                cur.execute(sql)
+                
+                sql = """SELECT requestid, urlid, headerid, date FROM request
+                WHERE (urlid, headerid, date) IN ({:s});""".format(values)
+                cur.execute(sql)
+                request_ids = {
+                        (url_id, header_id, date.strftime(Storage.DATETIME_FORMAT)) : request_id
+                        for request_id, url_id, header_id, date in cur.fetchall()
+                    }
+                
+            request_ids = [
+                    stored_ids[i] if x is None else request_ids[x]
+                    for i, x in enumerate(keys)
+                ]
+            
+            # Accepted status codes, pending requests of other
+            # callers keep theirs
+            accepted = set()
             
+            for i, (request_id, x) in enumerate(zip(request_ids, requests)):
+                if i in stored_ids:
+                    continue
+                
+                status_codes = x.accepted_status
+                
+                if isinstance(status_codes, int):
+                    status_codes = [status_codes]
+                    
+                accepted.update((request_id, int(y)) for y in status_codes)
+                
+            if len(accepted) != 0:
+                sql = "INSERT IGNORE INTO accepted_status (requestid, statuscode) VALUES {:s};".format(
+                        ",".join("({:d},{:d})".format(*x) for x in sorted(accepted))
+                    )
+                cur.execute(sql)
+            
+            if tokens is not None:
+                self.insert_provisional_request_ids(tokens, request_ids, cur=cur)
+                
+        for x in urls.values():
+            self._add_to_bloom_filter(self._url_filter, Storage._get_url_filter_key(x))
+            
+        for checksum in headers:
+            self._add_to_bloom_filter(self._header_filter, checksum)
+        
+        return request_ids
+    
+    def insert_provisional_request_ids (self, tokens, request_ids, cur=None):
+        sql = "INSERT IGNORE INTO provisional_request (token, requestid) VALUES {:s};".format(
+                ",".join(
+                        "(\"{:s}\",{:d})".format(token, int(request_id))
+                        for token, request_id in zip(tokens, request_ids)
+                    )
+            )
+        
+        if cur is None:
             with self._con as cur:
                 cur.execute(sql)
-                last_id = self.get_last_insert_id(cur)
+        else:
+            cur.execute(sql)
+            
+    def get_provisional_request_ids (self, tokens):
+        '''
+        Returns a dict of the given provisional tokens which
+        are already mapped to their request ids.
+        '''
+        if len(tokens) == 0:
+            return {}
+        
+        sql = "SELECT token, requestid FROM provisional_request WHERE token IN ({:s});".format(
+                ",".join("\"{:s}\"".format(x) for x in tokens)
+            )
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        return {
+                token : request_id
+                for token, request_id in rows
+            }
+    
+    def delete_old_provisional_request_ids (self, max_age):
+        sql = """DELETE FROM provisional_request
+        WHERE created < NOW() - INTERVAL {:d} SECOND;""".format(
+                int(max_age.total_seconds())
+            )
+        
+        with self._con as cur:
+            cur.execute(sql)
+        
+    @classmethod
+    def _compress_content (cls, raw):
+        content = BytesIO()
+        
+        with gzip.open(content, "wb") as f:
+            f.write(raw)
+            
+        return content.getvalue()
+    
+    @classmethod
+    def _decompress_content (cls, content):
+        with gzip.open(BytesIO(bytes(content)), "rb") as f:
+            return f.read()
+    
+    def _prepare_delta_content (self, cur, request_id, content):
+        '''
+        Returns the content to store for a new response, the id
+        and chain depth of its delta base (None and 0 for keyframes)
+        and the key of the latest response cache entry.
+        '''
+        sql = """SELECT req.urlid, req.headerid, rl.responseid, rl.content,
+            COALESCE(rd.depth, 0)
+        FROM request AS req
+        LEFT JOIN response_latest AS rl
+            ON req.urlid = rl.urlid AND req.headerid = rl.headerid
+        LEFT JOIN response_delta AS rd
+            ON rl.responseid = rd.responseid
+        WHERE req.requestid = {:d};""".format(request_id)
+        cur.execute(sql)
+        rows = cur.fetchall()
+        
+        url_id, header_id, base_id, base_content, depth = rows[0]
+        latest_key = (url_id, header_id)
+        
+        if base_id is None or depth + 1 >= self._delta_keyframe_interval:
+            return content, None, 0, latest_key
+        
+        delta = BinaryDelta.create(Storage._decompress_content(base_content),
+                                   Storage._decompress_content(content))
+        delta = Storage._compress_content(delta)
+        
+        # Keep a keyframe if the delta does not save anything
+        if len(delta) >= len(content):
+            return content, None, 0, latest_key
+        
+        return delta, base_id, depth + 1, latest_key
+    
+    def _insert_response_delta (self, cur, response_id, base_id, depth):
+        sql = """INSERT INTO response_delta (responseid, baseid, depth)
+        VALUES ({:d}, {:d}, {:d});""".format(response_id, base_id, depth)
+        cur.execute(sql)
+    
+    def _update_response_latest (self, cur, latest_key, response_id, content):
+        sql = """INSERT INTO response_latest (urlid, headerid, responseid, content)
+        VALUES ({:d}, {:d}, {:d}, X'{:s}')
+        ON DUPLICATE KEY UPDATE responseid = VALUES(responseid),
+            content = VALUES(content);""".format(
+                latest_key[0], latest_key[1], response_id, bytes(content).hex()
+            )
+        cur.execute(sql)
+    
+    def _reconstruct_response_content (self, cur, response_id):
+        '''
+        Replays the delta chain of the given response starting
+        from its keyframe and returns the gzipped content.
+        '''
+        deltas = []
+        current_id = response_id
+        
+        while True:
+            sql = """SELECT resp.content, rd.baseid
+            FROM response AS resp
+            LEFT JOIN response_delta AS rd
+                ON resp.responseid = rd.responseid
+            WHERE resp.responseid = {:d};""".format(current_id)
+            cur.execute(sql)
+            content, base_id = cur.fetchall()[0]
+            
+            if base_id is None:
+                break
+            
+            deltas.append(content)
+            current_id = base_id
+        
+        raw = Storage._decompress_content(content)
+        
+        for delta in reversed(deltas):
+            raw = BinaryDelta.apply(raw, Storage._decompress_content(delta))
+        
+        return Storage._compress_content(raw)
+    
+    def direct_insert_response (self, request_id, response):
+        if isinstance(response, Response):
+            with self._con as cur:
+                last_id = self._direct_insert_single_response(cur, request_id,
+                                                              response)
         else:
             last_id = []
             
@@ -1168,6 +2575,193 @@ class Storage ():
             
         return last_id
     
+    def _direct_insert_single_response (self, cur, request_id, response):
+        content = response.content
+        use_delta = self._delta_keyframe_interval is not None and content is not None
+        
+        if use_delta:
+            content, base_id, depth, latest_key = self._prepare_delta_content(
+                    cur, request_id, bytes(content)
+                )
+        
+        if content is None:
+            content = "NULL"
+        else:
+            content = "X'{:s}'".format(content.hex())
+        
+        sql = """INSERT INTO response 
+        (requestid, requested, statuscode, header, content) 
+        VALUES {:s};"""
+        fmt = "({:d}, \"{:s}\", {:d}, \"{:s}\", {:s})"
+        
+        fmt = fmt.format(
+                request_id,
+                response.timestamp.strftime(Storage.DATETIME_FORMAT),
+                response.status_code,
+                response.headers,
+                content
+            )
+        sql = sql.format(fmt)
+        
+        cur.execute(sql)
+        last_id = self.get_last_insert_id(cur)
+        
+        if use_delta:
+            if base_id is not None:
+                self._insert_response_delta(cur, last_id, base_id, depth)
+            
+            self._update_response_latest(cur, latest_key, last_id,
+                                         response.content)
+        
+        if response.fingerprint is not None:
+            self._insert_response_fingerprint(cur, last_id, request_id,
+                                              response)
+        
+        if response.simhash is not None:
+            self._insert_response_simhash(cur, last_id, request_id, response)
+            
+        if response.vary is not None:
+            self._learn_cache_key_headers(cur, request_id, response.vary)
+        
+        return last_id
+    
+    def _insert_response_simhash (self, cur, response_id, request_id, response):
+        bands = SimHash.get_bands(response.simhash)
+        
+        sql = """INSERT INTO response_simhash
+        (responseid, urlid, domainid, pathchecksum, requested, simhash,
+         band0, band1, band2, band3)
+        SELECT {:d}, url.urlid, url.domainid, url.pathchecksum, \"{:s}\", {:d},
+            {:d}, {:d}, {:d}, {:d}
+        FROM request AS req
+        INNER JOIN url
+            ON req.urlid = url.urlid
+        WHERE req.requestid = {:d};""".format(
+                response_id,
+                response.timestamp.strftime(Storage.DATETIME_FORMAT),
+                response.simhash,
+                bands[0], bands[1], bands[2], bands[3],
+                request_id
+            )
+        cur.execute(sql)
+    
+    def get_request_url_id (self, request_id):
+        sql = "SELECT urlid FROM request WHERE requestid = {:d};".format(request_id)
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+        
+        if len(rows) == 0:
+            return None
+        else:
+            return rows[0][0]
+    
+    def get_near_duplicate_cluster (self, url_id, max_distance=None):
+        '''
+        Returns the urls of the same domain whose content is a
+        near-duplicate of the latest content of the given url,
+        including the url itself.
+        '''
+        if max_distance is None:
+            max_distance = Storage.NEAR_DUPLICATE_MAX_DISTANCE
+            
+        sql = "{:s};".format(Storage.NEAR_DUPLICATE_CLUSTER_QUERY.format(
+                url_id, max_distance
+            ))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+        
+        df = pd.DataFrame(rows, columns=Storage.NEAR_DUPLICATE_CLUSTER_COLUMNS)
+        df = df.set_index(Storage.NEAR_DUPLICATE_CLUSTER_INDEX)
+        return df
+    
+    def get_near_duplicate_paths (self, days=None, max_distance=None):
+        if days is None:
+            days = Storage.NEAR_DUPLICATE_DAYS
+            
+        if max_distance is None:
+            max_distance = Storage.NEAR_DUPLICATE_MAX_DISTANCE
+            
+        sql = "{:s};".format(Storage.NEAR_DUPLICATE_PATHS_QUERY.format(
+                days, days, max_distance
+            ))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+        
+        df = pd.DataFrame(rows, columns=Storage.NEAR_DUPLICATE_PATHS_COLUMNS)
+        return df
+    
+    def _insert_response_fingerprint (self, cur, response_id, request_id, response):
+        sql = """INSERT INTO response_fingerprint
+        (responseid, requestid, urlid, requested, statuscode, fingerprint)
+        SELECT {:d}, req.requestid, req.urlid, \"{:s}\", {:d}, X'{:s}'
+        FROM request AS req
+        WHERE req.requestid = {:d};""".format(
+                response_id,
+                response.timestamp.strftime(Storage.DATETIME_FORMAT),
+                response.status_code,
+                response.fingerprint.hex(),
+                request_id
+            )
+        cur.execute(sql)
+    
+    def get_changed_urls (self, since):
+        '''
+        Returns the urls with an accepted response after the given
+        UTC timestamp whose content differs from the last accepted
+        response up to that timestamp. Urls without any earlier
+        response count as changed.
+        '''
+        since = since.strftime(Storage.DATETIME_FORMAT)
+
+        sql = "{:s};".format(Storage.CHANGED_URLS_QUERY.format(
+                Storage.LATEST_FINGERPRINT_QUERY.format(">", since),
+                Storage.LATEST_FINGERPRINT_QUERY.format("<=", since)
+            ))
+
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+
+        df = pd.DataFrame(rows, columns=Storage.CHANGED_URLS_COLUMNS)
+        df = df.set_index(Storage.CHANGED_URLS_INDEX)
+        return df
+
+    def get_url_versions (self, url_id):
+        '''
+        Returns the accepted responses of the given url at which
+        its content changed, oldest first.
+        '''
+        sql = """SELECT rf.responseid, rf.requestid, rf.requested, rf.fingerprint
+        FROM response_fingerprint AS rf
+        INNER JOIN accepted_status AS a_s
+            ON rf.requestid = a_s.requestid AND rf.statuscode = a_s.statuscode
+        WHERE rf.urlid = {:d}
+        ORDER BY rf.requested ASC, rf.responseid ASC;""".format(url_id)
+
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+
+        versions = []
+        last_fingerprint = None
+
+        for response_id, request_id, requested, fingerprint in rows:
+            fingerprint = bytes(fingerprint).hex()
+
+            if fingerprint != last_fingerprint:
+                versions.append((response_id, request_id, requested, fingerprint))
+                last_fingerprint = fingerprint
+
+        df = pd.DataFrame(versions, columns=Storage.URL_VERSIONS_COLUMNS)
+        df = df.set_index(Storage.URL_VERSIONS_INDEX)
+        return df
+
     @classmethod
     def _get_iterable_condition (cls, attribute, values, is_string=False):
         if values is None:
@@ -1289,29 +2883,63 @@ class Storage ():
             
         return conditions    
     
+    def get_stored_content_size (self, response_ids):
+        '''
+        Returns the stored bytes of the contents of the given
+        responses, gzipped keyframes and deltas as they are.
+        '''
+        if len(response_ids) == 0:
+            return 0
+        
+        sql = """SELECT COALESCE(SUM(LENGTH(content)), 0) FROM response
+        WHERE responseid IN ({:s});""".format(",".join(str(int(x)) for x in response_ids))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        return int(rows[0][0])
+    
     def get_latest_accepted_response (self, request_id):
         sql = """SELECT 
             resp.responseid, resp.requestid, resp.requested, 
-            resp.statuscode, resp.header, resp.content
+            resp.statuscode, resp.header, resp.content,
+            rd.baseid, rl.content
         FROM response AS resp
+        LEFT JOIN response_delta AS rd
+            ON resp.responseid = rd.responseid
+        LEFT JOIN response_latest AS rl
+            ON resp.responseid = rl.responseid
         WHERE resp.requestid = {:d} AND 
         resp.statuscode IN (
             SELECT statuscode 
             FROM accepted_status 
-            WHERE resp.requestid = {:d}
+            WHERE requestid = {:d}
         )
         ORDER BY resp.requested DESC LIMIT 1;""".format(
             request_id, request_id
             )
-        ["ResponseId", "RequestId", "Timestamp", "StatusCode", "Header", "Content"]
+        
         with self._con as cur:
             cur.execute(sql)
             rows = cur.fetchall()
         
-        if len(rows) == 1:
-            df = pd.Series(rows[0], index=Storage.RESPONSE_COLUMNS)
-        else:
-            df = None
+            if len(rows) == 1:
+                row = list(rows[0])
+                base_id, latest_content = row[-2:]
+                row = row[:-2]
+                
+                # Delta stored responses are read from the latest
+                # response cache or rebuilt from their keyframe.
+                if base_id is not None:
+                    if latest_content is not None:
+                        row[-1] = latest_content
+                    else:
+                        row[-1] = self._reconstruct_response_content(cur, row[0])
+                
+                df = pd.Series(row, index=Storage.RESPONSE_COLUMNS)
+            else:
+                df = None
         
         return df
     
@@ -1324,6 +2952,133 @@ class Storage ():
         
         return df
         
+    @classmethod
+    def _split_status_codes (cls, status_codes):
+        if status_codes is None or (isinstance(status_codes, float) and np.isnan(status_codes)):
+            return []
+        
+        if isinstance(status_codes, (bytes, bytearray)):
+            status_codes = bytes(status_codes).decode("utf-8")
+        
+        return [int(x) for x in status_codes.split(",")]
+    
+    def _get_limited_requests (self, status):
+        sql = "{:s};".format(Storage.LIMITED_REQUESTS_QUERY.format(
+                Storage.FULLREQUEST_QUERY,
+                Storage.NEAR_DUPLICATE_PATHS_QUERY.format(
+                        Storage.NEAR_DUPLICATE_DAYS, Storage.NEAR_DUPLICATE_DAYS,
+                        Storage.NEAR_DUPLICATE_MAX_DISTANCE
+                    ),
+                status
+            ))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        df = Storage._prepare_fullrequest_dataframe(rows, [Storage.ACCEPTED_STATUS_COLUMN])
+        df[Storage.ACCEPTED_STATUS_COLUMN] = df[Storage.ACCEPTED_STATUS_COLUMN].apply(
+                Storage._split_status_codes
+            )
+        
+        return df
+    
+    def _get_status_requests (self, condition):
+        sql = "{:s};".format(Storage.STATUS_REQUESTS_QUERY.format(
+                Storage.FULLREQUEST_QUERY, condition
+            ))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        df = Storage._prepare_fullrequest_dataframe(rows, [Storage.STATUS_COLUMN,
+                                                           Storage.ACCEPTED_STATUS_COLUMN])
+        df[Storage.ACCEPTED_STATUS_COLUMN] = df[Storage.ACCEPTED_STATUS_COLUMN].apply(
+                Storage._split_status_codes
+            )
+        
+        return df
+    
+    def get_executable_requests (self):
+        '''
+        Returns all new and failed requests, uncapped and
+        regardless of retries and leases.
+        '''
+        return self._get_status_requests("rs.status IN (0, 1)")
+    
+    def get_full_requests (self, request_ids):
+        if len(request_ids) == 0:
+            return self._prepare_fullrequest_dataframe([], [Storage.STATUS_COLUMN,
+                                                            Storage.ACCEPTED_STATUS_COLUMN])
+        
+        return self._get_status_requests("rs.requestid IN ({:s})".format(
+                ",".join(str(int(x)) for x in request_ids)
+            ))
+    
+    def get_request_status_marks (self):
+        '''
+        Returns the highest request id and the current database
+        time, the starting point for get_request_status_changes.
+        '''
+        sql = "SELECT (SELECT MAX(requestid) FROM request), NOW(6);"
+        
+        with self._con as cur:
+            cur.execute(sql)
+            last_request_id, now = cur.fetchall()[0]
+            
+        if last_request_id is None:
+            last_request_id = 0
+            
+        return last_request_id, now
+    
+    def get_request_status_changes (self, last_request_id, since):
+        '''
+        Returns the requests with a higher id than the given one
+        or whose status changed at or after the given database time.
+        '''
+        sql = "{:s};".format(Storage.REQUEST_STATUS_CHANGES_QUERY.format(
+                int(last_request_id), since.strftime("%Y-%m-%d %H:%M:%S.%f")
+            ))
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        return pd.DataFrame(rows, columns=Storage.REQUEST_STATUS_CHANGES_COLUMNS)
+    
+    def get_blocked_domain_headers (self):
+        '''
+        Returns the set of domain and header id pairs which
+        have to wait for their retry time.
+        '''
+        sql = "SELECT domainid, headerid FROM domain_retry WHERE retry > UTC_TIMESTAMP();"
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        return set((domain_id, header_id) for domain_id, header_id in rows)
+    
+    def get_leased_request_ids (self):
+        sql = "SELECT requestid FROM request_lease WHERE expiry > UTC_TIMESTAMP();"
+        
+        with self._con as cur:
+            cur.execute(sql)
+            rows = cur.fetchall()
+            
+        return set(x[0] for x in rows)
+    
+    def get_limited_requests_without_responses (self):
+        '''
+        Like get_requests_without_responses, but capped per domain
+        by the domain policy and with the accepted status codes.
+        '''
+        return self._get_limited_requests(0)
+    
+    def get_limited_retryable_failing_request (self):
+        return self._get_limited_requests(1)
+        
     def get_requests_without_responses (self):
         sql = """SELECT
             fr.requestid, fr.urlid, fr.domainid, fr.headerid,
@@ -1335,8 +3090,11 @@ class Storage ():
             ON rs.requestid = fr.requestid
         LEFT JOIN domain_retry AS dr
             ON fr.domainid = dr.domainid AND fr.headerid = dr.headerid
+        LEFT JOIN request_lease AS rl
+            ON fr.requestid = rl.requestid
         WHERE rs.status = 0 
-            AND (dr.retry <= UTC_TIMESTAMP() OR dr.retry IS NULL);
+            AND (dr.retry <= UTC_TIMESTAMP() OR dr.retry IS NULL)
+            AND (rl.expiry <= UTC_TIMESTAMP() OR rl.expiry IS NULL);
         """.format(Storage.FULLREQUEST_QUERY)
         
         with self._con as cur:
@@ -1472,7 +3230,10 @@ class Storage ():
             ON fr.requestid = rs.requestid AND rs.status = 1
         LEFT JOIN domain_retry AS dr
             ON fr.domainid = dr.domainid AND fr.headerid = dr.headerid
-        WHERE dr.retry <= UTC_TIMESTAMP() OR dr.retry IS NULL
+        LEFT JOIN request_lease AS rl
+            ON fr.requestid = rl.requestid
+        WHERE (dr.retry <= UTC_TIMESTAMP() OR dr.retry IS NULL)
+            AND (rl.expiry <= UTC_TIMESTAMP() OR rl.expiry IS NULL)
         """.format(
                 Storage.FULLREQUEST_QUERY
             )
@@ -1496,6 +3257,523 @@ class Storage ():
         df = df.set_index(Storage.REQUESTSTATUS_INDEX)
         return df
 
+    def claim_request_leases (self, owner, request_ids, lease_duration):
+        '''
+        Claims the given requests for the given owner. Requests leased
+        by other owners are skipped unless their lease has expired,
+        as are requests which are done by now. Returns the ids of all
+        requests now leased by the owner.
+        '''
+        Storage._check_lease_owner(owner)
+        
+        if len(request_ids) == 0:
+            return np.array([], dtype=int)
+
+        ids = ",".join(str(int(x)) for x in request_ids)
+        expiry = "TIMESTAMPADD(SECOND, {:d}, UTC_TIMESTAMP())".format(
+                int(lease_duration.total_seconds())
+            )
+
+        with self._con as cur:
+            sql = """DELETE FROM request_lease
+            WHERE requestid IN ({:s}) AND expiry <= UTC_TIMESTAMP();""".format(ids)
+            cur.execute(sql)
+
+            # A stale pending row may name a request another worker just finished
+            sql = """INSERT IGNORE INTO request_lease (requestid, owner, expiry)
+            SELECT requestid, \"{:s}\", {:s} FROM request_status
+            WHERE requestid IN ({:s}) AND status != 2;""".format(owner, expiry, ids)
+            cur.execute(sql)
+
+            sql = """SELECT requestid FROM request_lease
+            WHERE requestid IN ({:s}) AND owner = \"{:s}\";""".format(ids, owner)
+            cur.execute(sql)
+            rows = cur.fetchall()
+
+        rows = np.array([
+                x[0]
+                for x in rows
+            ])
+        return rows
+
+    @classmethod
+    def _check_lease_owner (cls, owner):
+        if Storage.LEASE_OWNER_PATTERN.fullmatch(owner) is None:
+            raise ValueError("Invalid lease owner {:s}, only up to 64 letters, digits "
+                             "and _.:@- are allowed".format(repr(owner)))
+            
+    def renew_request_leases (self, owner, request_ids, lease_duration):
+        Storage._check_lease_owner(owner)
+        
+        if len(request_ids) == 0:
+            return
+
+        sql = """UPDATE request_lease
+        SET expiry = TIMESTAMPADD(SECOND, {:d}, UTC_TIMESTAMP())
+        WHERE owner = \"{:s}\" AND requestid IN ({:s});""".format(
+                int(lease_duration.total_seconds()), owner,
+                ",".join(str(int(x)) for x in request_ids)
+            )
+
+        with self._con as cur:
+            cur.execute(sql)
+
+    def release_request_leases (self, owner, request_ids=None):
+        Storage._check_lease_owner(owner)
+        
+        sql = "DELETE FROM request_lease WHERE owner = \"{:s}\"".format(owner)
+
+        if request_ids is not None:
+            if len(request_ids) == 0:
+                return
+
+            sql += " AND requestid IN ({:s})".format(
+                    ",".join(str(int(x)) for x in request_ids)
+                )
+
+        with self._con as cur:
+            cur.execute(sql+";")
+
+    def delete_expired_request_leases (self):
+        sql = "DELETE FROM request_lease WHERE expiry <= UTC_TIMESTAMP();"
+
+        with self._con as cur:
+            cur.execute(sql)
+
+    def _touch_request_status (self, cur, condition):
+        '''
+        Marks the requests matching the condition on req as changed,
+        so that in-memory pending sets reload their rows.
+        '''
+        sql = """UPDATE request_status AS rs
+        INNER JOIN request AS req
+            ON rs.requestid = req.requestid
+        SET rs.changed = CURRENT_TIMESTAMP(6)
+        WHERE {:s};""".format(condition)
+        cur.execute(sql)
+        
+    def _merge_request_rows (self, cur, mapping):
+        '''
+        Merges each source request of the dict into its target request.
+        Responses, accepted status codes and provisional tokens are
+        moved, the target keeps the more advanced status and the
+        source requests are deleted.
+        '''
+        for source, target in mapping.items():
+            source = int(source)
+            target = int(target)
+            
+            sql = "UPDATE response SET requestid = {:d} WHERE requestid = {:d};".format(
+                    target, source
+                )
+            cur.execute(sql)
+            
+            sql = "UPDATE response_fingerprint SET requestid = {:d} WHERE requestid = {:d};".format(
+                    target, source
+                )
+            cur.execute(sql)
+            
+            sql = """INSERT IGNORE INTO accepted_status (requestid, statuscode)
+            SELECT {:d}, statuscode FROM accepted_status WHERE requestid = {:d};""".format(
+                    target, source
+                )
+            cur.execute(sql)
+            
+            sql = "UPDATE provisional_request SET requestid = {:d} WHERE requestid = {:d};".format(
+                    target, source
+                )
+            cur.execute(sql)
+            
+            sql = """UPDATE request_status AS t
+            INNER JOIN request_status AS s
+                ON s.requestid = {:d}
+            SET t.status = GREATEST(t.status, s.status),
+                t.requested = GREATEST(COALESCE(t.requested, s.requested),
+                                       COALESCE(s.requested, t.requested))
+            WHERE t.requestid = {:d};""".format(source, target)
+            cur.execute(sql)
+            
+        if len(mapping) != 0:
+            sql = "DELETE FROM request WHERE requestid IN ({:s});".format(
+                    ",".join(str(int(x)) for x in mapping.keys())
+                )
+            cur.execute(sql)
+            
+            self._touch_request_status(cur, "req.requestid IN ({:s})".format(
+                    ",".join(str(int(x)) for x in sorted(set(mapping.values())))
+                ))
+            
+    def _move_request_header (self, cur, domain_id, source_id, target_id):
+        '''
+        Points the requests of a domain from one header to another,
+        merging requests which become equal.
+        '''
+        sql = """SELECT a.requestid, b.requestid
+        FROM request AS a
+        INNER JOIN url
+            ON a.urlid = url.urlid
+        INNER JOIN request AS b
+            ON a.urlid = b.urlid AND a.date = b.date AND b.headerid = {:d}
+        WHERE a.headerid = {:d} AND url.domainid = {:d};""".format(
+                target_id, source_id, domain_id
+            )
+        cur.execute(sql)
+        self._merge_request_rows(cur, dict(cur.fetchall()))
+        
+        sql = """UPDATE request AS req
+        INNER JOIN url
+            ON req.urlid = url.urlid
+        SET req.headerid = {:d}
+        WHERE req.headerid = {:d} AND url.domainid = {:d};""".format(
+                target_id, source_id, domain_id
+            )
+        cur.execute(sql)
+        
+        self._touch_request_status(cur, """req.headerid = {:d} AND
+            req.urlid IN (SELECT urlid FROM url WHERE domainid = {:d})""".format(
+                target_id, domain_id
+            ))
+        
+        for table, columns in [("domain_status", "requested, status"),
+                               ("domain_retry", "retry")]:
+            sql = """INSERT IGNORE INTO {:s} (domainid, headerid, {:s})
+            SELECT domainid, {:d}, {:s} FROM {:s}
+            WHERE domainid = {:d} AND headerid = {:d};""".format(
+                    table, columns, target_id, columns, table, domain_id, source_id
+                )
+            cur.execute(sql)
+            
+            sql = "DELETE FROM {:s} WHERE domainid = {:d} AND headerid = {:d};".format(
+                    table, domain_id, source_id
+                )
+            cur.execute(sql)
+        
+        # Latest contents are cached per url and header
+        sql = """DELETE rl FROM response_latest AS rl
+        INNER JOIN url
+            ON rl.urlid = url.urlid
+        WHERE rl.headerid = {:d} AND url.domainid = {:d};""".format(source_id, domain_id)
+        cur.execute(sql)
+    
+    URL_CANONICALIZATION_REPORT_COLUMNS = ["Netloc", "Urls", "CanonicalUrls",
+                                           "Collapsible", "Rewritten"]
+    URL_CANONICALIZATION_REPORT_INDEX = "Netloc"
+    
+    def _scan_canonical_urls (self, canonicalizer, batch_size=10000):
+        '''
+        Canonicalizes all stored urls. Returns the canonical host and
+        url ids of every canonical form shared by several urls, the
+        canonical URL of every rewritten url id and per canonical host
+        counts of urls and rewrites.
+        '''
+        sql = """SELECT url.urlid, d.scheme, d.netloc, url.path, url.query
+        FROM url
+        INNER JOIN domain AS d
+            ON url.domainid = d.domainid
+        ORDER BY url.urlid;"""
+        
+        first = {}
+        groups = {}
+        rewritten = {}
+        counts = {}
+        
+        with self._con as cur:
+            cur.execute(sql)
+            
+            while True:
+                rows = cur.fetchmany(batch_size)
+                
+                if len(rows) == 0:
+                    break
+                
+                for url_id, scheme, netloc, path, query in rows:
+                    original = Storage.URLPARSE_REVERT.format(
+                            scheme, netloc, path, "?" + query if query != "" else ""
+                        )
+                    url = self.canonicalize_url(URL.of_string(original), canonicalizer)
+                    canonical = url.to_string()
+                    
+                    count = counts.setdefault(url.urlparsed.netloc, [0, 0])
+                    count[0] += 1
+                    
+                    if canonical != original:
+                        rewritten[url_id] = url
+                        count[1] += 1
+                        
+                    key = hashlib.md5(canonical.encode("utf-8")).digest()
+                    
+                    if key in first:
+                        group = groups.setdefault(key, (url.urlparsed.netloc, [first[key]]))
+                        group[1].append(url_id)
+                    else:
+                        first[key] = url_id
+                        
+        return list(groups.values()), rewritten, counts
+    
+    def get_url_canonicalization_report (self, canonicalizer=None):
+        '''
+        Dry run of merge_equivalent_urls. Returns per canonical host
+        the number of stored urls, of distinct canonical urls, of url
+        rows which would be merged away and of rewritten urls.
+        '''
+        if canonicalizer is None:
+            canonicalizer = self._url_canonicalizer or URLCanonicalizer()
+            
+        groups, rewritten, counts = self._scan_canonical_urls(canonicalizer)
+        
+        collapsible = {}
+        
+        for netloc, group in groups:
+            collapsible[netloc] = collapsible.get(netloc, 0) + len(group) - 1
+        
+        df = pd.DataFrame([
+                (netloc, urls, urls - collapsible.get(netloc, 0),
+                 collapsible.get(netloc, 0), rewritten_count)
+                for netloc, (urls, rewritten_count) in counts.items()
+            ], columns=Storage.URL_CANONICALIZATION_REPORT_COLUMNS)
+        df = df.set_index(Storage.URL_CANONICALIZATION_REPORT_INDEX)
+        df = df.sort_values("Collapsible", ascending=False)
+        
+        return df
+    
+    def _merge_url_rows (self, cur, source_id, target_id):
+        '''
+        Moves all requests and response side rows of the source
+        url to the target url and deletes the source url.
+        '''
+        sql = """SELECT a.requestid, b.requestid
+        FROM request AS a
+        INNER JOIN request AS b
+            ON b.urlid = {:d} AND a.headerid = b.headerid AND a.date = b.date
+        WHERE a.urlid = {:d};""".format(target_id, source_id)
+        cur.execute(sql)
+        self._merge_request_rows(cur, dict(cur.fetchall()))
+        
+        for table in ["request", "response_fingerprint"]:
+            sql = "UPDATE {:s} SET urlid = {:d} WHERE urlid = {:d};".format(
+                    table, target_id, source_id
+                )
+            cur.execute(sql)
+            
+        self._touch_request_status(cur, "req.urlid = {:d}".format(target_id))
+            
+        # The target url may belong to another domain, whose
+        # status rows the moved requests need to be scheduled
+        sql = """INSERT IGNORE INTO domain_status (domainid, headerid, requested, status)
+        SELECT DISTINCT url.domainid, r.headerid, NULL, 0
+        FROM request AS r
+        INNER JOIN url
+            ON url.urlid = r.urlid
+        WHERE r.urlid = {:d};""".format(target_id)
+        cur.execute(sql)
+            
+        sql = """UPDATE response_simhash AS rs
+        INNER JOIN url
+            ON url.urlid = {:d}
+        SET rs.urlid = url.urlid, rs.domainid = url.domainid,
+            rs.pathchecksum = url.pathchecksum
+        WHERE rs.urlid = {:d};""".format(target_id, source_id)
+        cur.execute(sql)
+        
+        # Only a delta base cache, the next response is a keyframe
+        sql = "DELETE FROM response_latest WHERE urlid = {:d};".format(source_id)
+        cur.execute(sql)
+        
+        sql = "DELETE FROM url WHERE urlid = {:d};".format(source_id)
+        cur.execute(sql)
+        
+    def _rewrite_url_row (self, cur, url_id, url):
+        sql = "INSERT IGNORE INTO domain (scheme, netloc) VALUES (\"{:s}\",\"{:s}\");".format(
+                url.urlparsed.scheme, url.urlparsed.netloc
+            )
+        cur.execute(sql)
+        
+        sql = "SELECT domainid FROM domain WHERE scheme = \"{:s}\" AND netloc = \"{:s}\";".format(
+                url.urlparsed.scheme, url.urlparsed.netloc
+            )
+        cur.execute(sql)
+        domain_id = cur.fetchall()[0][0]
+        
+        sql = """UPDATE url SET domainid = {:d}, pathchecksum = X'{:s}',
+            querychecksum = X'{:s}', path = \"{:s}\", query = \"{:s}\"
+        WHERE urlid = {:d};""".format(
+                domain_id, url.path_checksum.hex(), url.query_checksum.hex(),
+                url.urlparsed.path, url.urlparsed.query, url_id
+            )
+        cur.execute(sql)
+        
+        sql = """UPDATE response_simhash SET domainid = {:d}, pathchecksum = X'{:s}'
+        WHERE urlid = {:d};""".format(domain_id, url.path_checksum.hex(), url_id)
+        cur.execute(sql)
+        
+        self._touch_request_status(cur, "req.urlid = {:d}".format(url_id))
+        
+        # Requests moved to another domain need its status rows
+        sql = """INSERT IGNORE INTO domain_status (domainid, headerid, requested, status)
+        SELECT DISTINCT {:d}, headerid, NULL, 0 FROM request WHERE urlid = {:d};""".format(
+                domain_id, url_id
+            )
+        cur.execute(sql)
+    
+    def merge_equivalent_urls (self, canonicalizer=None, groups_per_transaction=1000):
+        '''
+        Rewrites all stored urls into their canonical form and merges
+        the url rows sharing one, including requests which become
+        equal by it. Returns the number of merged away url rows.
+        '''
+        if canonicalizer is None:
+            canonicalizer = self._url_canonicalizer or URLCanonicalizer()
+            
+        groups, rewritten, _ = self._scan_canonical_urls(canonicalizer)
+        merged = 0
+        
+        for start in range(0, len(groups), groups_per_transaction):
+            with self._con as cur:
+                for _, group in groups[start:start+groups_per_transaction]:
+                    target_id = group[0]
+                    
+                    for source_id in group[1:]:
+                        self._merge_url_rows(cur, source_id, target_id)
+                        rewritten.pop(source_id, None)
+                        merged += 1
+                        
+        # Rows of merged forms are gone, the canonical ones are free
+        url_ids = sorted(rewritten.keys())
+        
+        for start in range(0, len(url_ids), groups_per_transaction):
+            with self._con as cur:
+                for url_id in url_ids[start:start+groups_per_transaction]:
+                    self._rewrite_url_row(cur, url_id, rewritten[url_id])
+                    
+        if self._url_filter is not None:
+            for url in rewritten.values():
+                self._add_to_bloom_filter(self._url_filter, Storage._get_url_filter_key(url))
+                    
+        return merged
+    
+    def merge_equivalent_request_headers (self):
+        '''
+        Rewrites all request headers canonically and rekeys them by
+        the cache key of the domains using them. Headers which share
+        a cache key within a domain are merged, as are the requests
+        which become equal by it. Returns the number of moved
+        domain and header pairs. Runs as one transaction, a failure
+        leaves all headers as they were.
+        '''
+        with self._con as cur:
+            sql = "SELECT headerid, headerchecksum, header FROM request_header;"
+            cur.execute(sql)
+            headers = {
+                    header_id : (bytes(checksum), json.loads(header))
+                    for header_id, checksum, header in cur.fetchall()
+                }
+            
+            sql = """SELECT DISTINCT url.domainid, req.headerid
+            FROM request AS req
+            INNER JOIN url
+                ON req.urlid = url.urlid;"""
+            cur.execute(sql)
+            pairs = cur.fetchall()
+            
+            sql = """SELECT domainid, cache_key_headers, cache_ignore_headers FROM domain_policy
+            WHERE (cache_key_headers IS NOT NULL AND cache_key_headers != "")
+                OR (cache_ignore_headers IS NOT NULL AND cache_ignore_headers != "");"""
+            cur.execute(sql)
+            rows = cur.fetchall()
+            key_headers = {
+                    domain_id : Storage._split_list_column(x)
+                    for domain_id, x, _ in rows
+                }
+            ignore_headers = {
+                    domain_id : Storage._split_list_column(x)
+                    for domain_id, _, x in rows
+                }
+            
+            # Headers without requests are keyed by default
+            used = set(header_id for _, header_id in pairs)
+            pairs = pairs + [(None, x) for x in headers if x not in used]
+            
+            keyed = {}
+            groups = {}
+            
+            for domain_id, header_id in pairs:
+                request_header = RequestHeader.of_dict(headers[header_id][1],
+                                                       key_headers.get(domain_id, frozenset()),
+                                                       ignore_headers.get(domain_id, frozenset()))
+                keyed[(domain_id, header_id)] = request_header
+                groups.setdefault(request_header.header_checksum, []).append(header_id)
+                
+            # Every checksum gets the smallest free header row of its group
+            targets = {}
+            taken = set()
+            
+            for checksum in sorted(groups, key=lambda x: min(groups[x])):
+                for header_id in sorted(groups[checksum]):
+                    if header_id not in taken:
+                        targets[checksum] = header_id
+                        taken.add(header_id)
+                        break
+                    
+            # Target rows keep their own headers
+            canonical = {}
+            
+            for (_, header_id), request_header in keyed.items():
+                checksum = request_header.header_checksum
+                
+                if targets.get(checksum, None) == header_id or checksum not in canonical:
+                    canonical[checksum] = request_header
+            
+            # Temporary checksums avoid unique key conflicts while rekeying
+            for header_id in headers:
+                sql = "UPDATE request_header SET headerchecksum = X'{:s}' WHERE headerid = {:d};".format(
+                        hashlib.md5("merge-{:d}".format(header_id).encode("utf-8")).hexdigest(),
+                        header_id
+                    )
+                cur.execute(sql)
+                
+            for checksum, request_header in canonical.items():
+                stringed = request_header.stringed_header_dict.replace("\"", "\\\"")
+                
+                if checksum in targets:
+                    sql = """UPDATE request_header SET headerchecksum = X'{:s}', header = \"{:s}\"
+                    WHERE headerid = {:d};""".format(checksum.hex(), stringed, targets[checksum])
+                    cur.execute(sql)
+                    
+                    self._touch_request_status(cur, "req.headerid = {:d}".format(
+                            targets[checksum]
+                        ))
+                else:
+                    # A header used by domains with different cache keys
+                    sql = """INSERT INTO request_header (headerchecksum, header)
+                    VALUES (X'{:s}', \"{:s}\");""".format(checksum.hex(), stringed)
+                    cur.execute(sql)
+                    targets[checksum] = self.get_last_insert_id(cur)
+                    
+            moved = 0
+            
+            for (domain_id, header_id), request_header in keyed.items():
+                target_id = targets[request_header.header_checksum]
+                
+                if domain_id is not None and target_id != header_id:
+                    self._move_request_header(cur, domain_id, header_id, target_id)
+                    moved += 1
+                    
+            sources = [x for x in headers if x not in taken]
+            
+            if len(sources) != 0:
+                sql = """DELETE FROM request_header
+                WHERE headerid IN ({:s}) AND
+                headerid NOT IN (SELECT DISTINCT headerid FROM request);""".format(
+                        ",".join(str(x) for x in sources)
+                    )
+                cur.execute(sql)
+                
+        if self._header_filter is not None:
+            for checksum in canonical:
+                self._add_to_bloom_filter(self._header_filter, checksum)
+                
+        return moved
+        
     def fill_missing_request_statuses(self):
         sql = """INSERT INTO request_status (requestid, requested, status)
         SELECT r.requestid, r.date, 0
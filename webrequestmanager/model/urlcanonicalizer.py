@@ -0,0 +1,138 @@
+'''
+Created on 19.10.2026
+
+@author: larsw
+'''
+from urllib.parse import urlparse, urlunparse
+import fnmatch
+import string
+import re
+
+class URLCanonicalizer ():
+    '''
+    Rewrites urls into a canonical form before they are checksummed:
+    RFC 3986 normalization (case, default ports, percent-encoding,
+    dot segments), removal of tracking parameters and sorting of the
+    query. Per domain, further parameters can be stripped and
+    trailing slashes collapsed.
+    '''
+    DEFAULT_PORTS = {
+            "http" : "80",
+            "https" : "443"
+        }
+    DEFAULT_STRIP_PARAMS = [
+            "utm_*", "fbclid", "gclid", "dclid", "gbraid", "wbraid",
+            "msclkid", "yclid", "mc_cid", "mc_eid", "_ga", "_gl"
+        ]
+    UNRESERVED = frozenset(string.ascii_letters + string.digits + "-._~")
+    PERCENT_PATTERN = re.compile(r"%([0-9a-fA-F]{2})")
+
+    def __init__ (self, strip_params=DEFAULT_STRIP_PARAMS, sort_query=True,
+                  collapse_trailing_slash=False):
+        self._strip_params = list(strip_params)
+        self._sort_query = sort_query
+        self._collapse_trailing_slash = collapse_trailing_slash
+
+    @classmethod
+    def _normalize_percent_encoding (cls, s):
+        '''
+        Decodes percent-encoded unreserved characters and
+        uppercases the hex digits of all others.
+        '''
+        def replace (match):
+            c = chr(int(match.group(1), 16))
+
+            if c in cls.UNRESERVED:
+                return c
+
+            return "%" + match.group(1).upper()
+
+        return cls.PERCENT_PATTERN.sub(replace, s)
+
+    @classmethod
+    def _remove_dot_segments (cls, path):
+        # RFC 3986, section 5.2.4
+        output = []
+
+        for segment in path.split("/"):
+            if segment == "..":
+                if len(output) > 1:
+                    output.pop()
+            elif segment != ".":
+                output.append(segment)
+
+        result = "/".join(output)
+
+        if path.endswith("/.") or path.endswith("/.."):
+            result += "/"
+
+        if path.startswith("/") and not result.startswith("/"):
+            result = "/" + result
+
+        return result
+
+    @classmethod
+    def _is_stripped (cls, name, patterns):
+        name = name.lower()
+        return any(fnmatch.fnmatchcase(name, x) for x in patterns)
+
+    def _normalize_netloc (self, scheme, netloc):
+        userinfo, at, hostport = netloc.rpartition("@")
+        host, colon, port = hostport.rpartition(":")
+
+        # No port or an IPv6 address without one
+        if colon == "" or "]" in port:
+            host = hostport
+            port = ""
+
+        host = host.lower().rstrip(".")
+
+        if port == self.DEFAULT_PORTS.get(scheme, None):
+            port = ""
+
+        hostport = host + (":" + port if port != "" else "")
+        return userinfo + at + hostport
+
+    def _normalize_query (self, query, strip_params):
+        params = [
+                self._normalize_percent_encoding(x)
+                for x in query.split("&")
+                if x != ""
+            ]
+
+        params = [
+                x for x in params
+                if not self._is_stripped(x.split("=", 1)[0], strip_params)
+            ]
+
+        if self._sort_query:
+            # Stable, repeated keys keep their relative order
+            params = sorted(params, key=lambda x: x.split("=", 1)[0])
+
+        return "&".join(params)
+
+    def canonicalize (self, url, strip_params=(), collapse_trailing_slash=None):
+        '''
+        Returns the canonical form of the given url. The given
+        strip parameters extend the configured ones.
+        '''
+        if collapse_trailing_slash is None:
+            collapse_trailing_slash = self._collapse_trailing_slash
+
+        parsed = urlparse(url.strip())
+        scheme = parsed.scheme.lower()
+        netloc = self._normalize_netloc(scheme, parsed.netloc)
+
+        path = self._normalize_percent_encoding(parsed.path)
+        path = self._remove_dot_segments(path)
+
+        if path == "" and netloc != "":
+            path = "/"
+
+        if collapse_trailing_slash and path != "/":
+            path = path.rstrip("/")
+
+        query = self._normalize_query(parsed.query,
+                                      self._strip_params + list(strip_params))
+
+        return urlunparse((scheme, netloc, path, parsed.params, query, ""))